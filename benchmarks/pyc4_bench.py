@@ -0,0 +1,530 @@
+#!/usr/bin/python
+""" Benchmark pyc4 hashing engines against reproducible synthetic datasets.
+
+Usage:
+    python pyc4_bench.py generate DIR [--dataset NAME] [--scale SCALE]
+    python pyc4_bench.py run DIR [--engine NAME] [--dataset NAME] [-o results.json]
+    python pyc4_bench.py compare baseline.json results.json [--threshold 0.1]
+
+Each engine/dataset case runs in its own process so peak RSS and CPU time are
+measured for that case alone.
+"""
+from __future__ import division
+import os
+import sys
+import json
+import time
+import random
+import functools
+import shutil
+import platform
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+try:
+    import resource
+except ImportError: # pragma: no cover "Windows"
+    resource = None
+
+# Make the pyc4 checkout importable when running from the benchmarks folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pyc4
+
+KB = 2**10
+MB = 2**20
+GB = 2**30
+
+# Dataset definitions. files and the size range are multiplied by --scale so
+# the same shapes can be run quickly on a laptop or at full size on a server.
+#   files: number of files to create.
+#   size: (min, max) bytes of each file.
+#   depth: number of nested directories the files are spread across.
+#   sparse: create files by seeking instead of writing data.
+DATASETS = {
+    'tiny': {'files': 1000000, 'size': (0, 4 * KB), 'depth': 2},
+    'medium': {'files': 1000, 'size': (8 * MB, 16 * MB), 'depth': 1},
+    'large-sparse': {'files': 3, 'size': (50 * GB, 50 * GB), 'depth': 0, 'sparse': True},
+    'large-dense': {'files': 2, 'size': (50 * GB, 50 * GB), 'depth': 0},
+    'deep': {'files': 10000, 'size': (0, 64 * KB), 'depth': 64},
+    'flat': {'files': 10000, 'size': (0, 64 * KB), 'depth': 0},
+}
+
+# The seed used to generate file sizes and contents, so every machine
+# generates the same bytes for a dataset.
+SEED = 4
+
+
+def dataset_files(root, name):
+    """ List the files in a generated dataset in a stable order.
+
+    Args:
+        root (str): The folder passed to generate.
+        name (str): The name of the dataset.
+
+    Returns:
+        list: The paths of all files in the dataset.
+    """
+    ret = []
+    for dirpath, dirs, files in os.walk(os.path.join(root, name)):
+        dirs.sort()
+        for f in sorted(files):
+            if f != '.complete':
+                ret.append(os.path.join(dirpath, f))
+    return ret
+
+
+def dataset_scale(root, name):
+    """ The scale a dataset was generated at.
+
+    Returns:
+        float or None: None if the dataset hasn't been generated, or was
+            generated before the scale was recorded.
+    """
+    try:
+        with open(os.path.join(root, name, '.complete')) as f:
+            return json.load(f)['scale']
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _write_dense(f, size, index, block):
+    """ Write size reproducible pseudo random bytes to f.
+
+    Args:
+        f (file): The file to write to.
+        size (int): The number of bytes to write.
+        index (int): The file number, makes each file's content unique.
+        block (bytearray): A MB of pseudo random bytes, modified in place.
+    """
+    written = 0
+    counter = 0
+    while written < size:
+        # Vary each block so files don't dedup to the same blocks.
+        block[:16] = '{:08x}{:08x}'.format(index, counter).encode('ascii')
+        chunk = block[:min(MB, size - written)]
+        f.write(chunk)
+        written += len(chunk)
+        counter += 1
+
+
+def generate(root, name, scale=1.0):
+    """ Generate a dataset under root/name.
+
+    Existing datasets generated at the same scale are left as is, datasets
+    generated at another scale are replaced.
+
+    Args:
+        root (str): The folder to create datasets in.
+        name (str): The name of the dataset in DATASETS.
+        scale (float, optional): Multiplies the file count and file sizes.
+
+    Returns:
+        list: The paths of all files in the dataset.
+    """
+    spec = DATASETS[name]
+    folder = os.path.join(root, name)
+    marker = os.path.join(folder, '.complete')
+    if dataset_scale(root, name) == scale:
+        return dataset_files(root, name)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+
+    rand = random.Random(SEED)
+    block = bytearray(rand.getrandbits(8) for i in range(MB))
+    count = max(1, int(spec['files'] * scale))
+    low, high = [int(size * scale) for size in spec['size']]
+    depth = spec['depth']
+    for i in range(count):
+        # Spread files across depth nested folders.
+        parts = [folder] + ['d{:02d}'.format(level) for level in range(i % (depth + 1))]
+        dirname = os.path.join(*parts)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        size = rand.randint(low, high)
+        with open(os.path.join(dirname, 'f{:07d}.bin'.format(i)), 'wb') as f:
+            if spec.get('sparse'):
+                if size:
+                    f.seek(size - 1)
+                    f.write(b'\0')
+            else:
+                _write_dense(f, size, i, block)
+    with open(marker, 'w') as f:
+        json.dump({'scale': scale}, f)
+    return dataset_files(root, name)
+
+
+def run_c4(files, threads):
+    """ Hash files one at a time in the main thread using pyc4.C4.
+    """
+    c4 = pyc4.C4()
+    for path in files:
+        c4.from_file(path)
+
+
+def run_c4queue(files, threads):
+    """ Hash files using pyc4.C4Queue with threads worker threads.
+    """
+    c4 = pyc4.C4Queue()
+    c4.max_threads = threads
+    c4.files = files
+    c4.start()
+    c4.join()
+
+
+def run_c4copy(files, threads, mode='auto'):
+    """ Copy files to two temporary targets using pyc4.C4Copy.
+
+    By default the targets are created next to the dataset, on the same
+    filesystem, so the kernel copy modes can be used. Set PYC4_BENCH_TARGETS
+    to a os.pathsep separated list of folders to benchmark copying to
+    specific devices.
+    """
+    targets = os.environ.get('PYC4_BENCH_TARGETS')
+    if targets:
+        targets = targets.split(os.pathsep)
+    else:
+        targets = [os.path.dirname(os.path.commonprefix(files))] * 2
+    targets = [tempfile.mkdtemp(dir=target) for target in targets]
+    try:
+        c4 = pyc4.C4Copy(targets)
+        c4.mode = mode
+        for i, path in enumerate(files):
+            # Number the copies so files with the same name don't collide.
+            c4.copy_file(path, [os.path.join(target, str(i)) for target in targets])
+    finally:
+        for target in targets:
+            shutil.rmtree(target)
+
+
+def run_from_buffers(files, threads, batch=64 * MB):
+    """ Read files into memory in batches and hash them with C4.from_buffers.
+
+    Files larger than batch are hashed with C4.from_file instead of being
+    read into memory.
+    """
+    c4 = pyc4.C4()
+    buffers = []
+    size = 0
+    for path in files:
+        if os.path.getsize(path) > batch:
+            c4.from_file(path)
+            continue
+        with open(path, 'rb') as f:
+            buffers.append(f.read())
+        size += len(buffers[-1])
+        if size >= batch:
+            c4.from_buffers(buffers)
+            buffers = []
+            size = 0
+    c4.from_buffers(buffers)
+
+
+def run_c4processqueue(files, threads):
+    """ Hash files using pyc4.C4ProcessQueue with threads processes.
+    """
+    c4 = pyc4.C4ProcessQueue()
+    c4.max_processes = threads
+    c4.files = files
+    c4.start()
+    c4.join()
+
+
+def setup_c4verify(files):
+    """ Write a manifest of files for run_c4verify, before it is timed.
+    """
+    fd, manifest = tempfile.mkstemp(suffix='.c4m')
+    os.close(fd)
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 8
+    c4.files = files
+    c4.manifest = pyc4.C4ManifestWriter(manifest)
+    c4.start()
+    c4.join()
+    c4.manifest.close()
+    return {'manifest': manifest}
+
+
+def run_c4verify(files, threads, manifest):
+    """ Verify files against the manifest written by setup_c4verify.
+    """
+    try:
+        c4 = pyc4.C4Verify()
+        c4.max_threads = threads
+        c4.load(manifest)
+        c4.start()
+        c4.join()
+    finally:
+        os.remove(manifest)
+
+
+def run_c4dedup(files, threads):
+    """ Find duplicate files using pyc4.C4Dedup.
+    """
+    c4 = pyc4.C4Dedup()
+    c4.max_threads = threads
+    c4.find(files)
+
+
+def run_c4store(files, threads):
+    """ Ingest files into a temporary pyc4.C4Store next to the dataset.
+    """
+    root = tempfile.mkdtemp(dir=os.path.dirname(os.path.commonprefix(files)))
+    try:
+        store = pyc4.C4Store(root)
+        store.max_threads = threads
+        store.ingest_all(files)
+    finally:
+        shutil.rmtree(root)
+
+
+# Engines that can be benchmarked. Each is called with the list of files in
+# a dataset and the number of threads to use, and the keyword arguments
+# returned by its SETUP function if it has one.
+ENGINES = {
+    'C4': run_c4,
+    'C4-from_buffers': run_from_buffers,
+    'C4Queue': run_c4queue,
+    'C4ProcessQueue': run_c4processqueue,
+    'C4Verify': run_c4verify,
+    'C4Dedup': run_c4dedup,
+    'C4Store': run_c4store,
+    'C4Copy': run_c4copy,
+    'C4Copy-reflink': functools.partial(run_c4copy, mode='reflink'),
+    'C4Copy-copy_file_range': functools.partial(run_c4copy, mode='copy_file_range'),
+    'C4Copy-buffered': functools.partial(run_c4copy, mode='buffered'),
+}
+
+# Work an engine needs done before it is timed, like writing a manifest.
+SETUP = {
+    'C4Verify': setup_c4verify,
+}
+
+
+def peak_rss(children=False):
+    """ The peak resident set size of this process in bytes, or None.
+
+    Args:
+        children (bool, optional): The peak of the largest child process
+            that has been waited for instead.
+    """
+    if resource is None: # pragma: no cover "Windows"
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KB, macOS reports bytes.
+    return rss if sys.platform == 'darwin' else rss * KB
+
+
+def run_setup(root, engine, dataset):
+    """ Run the SETUP function of engine, in its own process so it isn't
+    included in the peak RSS and CPU time of the case.
+
+    Returns:
+        dict: The keyword arguments for the engine.
+    """
+    files = dataset_files(root, dataset)
+    return SETUP[engine](files)
+
+
+def run_case(root, engine, dataset, threads, kwargs=None):
+    """ Benchmark a single engine on a single dataset in this process.
+
+    CPU time and peak RSS include any processes the engine starts.
+
+    Args:
+        kwargs (dict or None, optional): The keyword arguments returned by
+            run_setup.
+
+    Returns:
+        dict: The measurements for this case.
+    """
+    files = dataset_files(root, dataset)
+    total = sum(os.path.getsize(path) for path in files)
+    times = os.times()
+    start = time.time()
+    ENGINES[engine](files, threads, **(kwargs or {}))
+    wall = time.time() - start
+    cpu = os.times()
+    return {
+        'engine': engine,
+        'dataset': dataset,
+        'scale': dataset_scale(root, dataset),
+        'threads': threads,
+        'files': len(files),
+        'bytes': total,
+        'wall': wall,
+        # Child processes are included once they have been waited for.
+        'cpu_user': cpu[0] - times[0] + cpu[2] - times[2],
+        'cpu_system': cpu[1] - times[1] + cpu[3] - times[3],
+        'peak_rss': peak_rss(),
+        'peak_rss_children': peak_rss(children=True),
+        'mb_per_s': total / MB / wall if wall else None,
+        'files_per_s': len(files) / wall if wall else None,
+    }
+
+
+def run(root, engines, datasets, threads, repeat=1):
+    """ Benchmark every engine on every dataset, each in a new process.
+
+    Returns:
+        dict: The machine description and results of every case.
+    """
+    results = []
+    for dataset in datasets:
+        for engine in engines:
+            for i in range(repeat):
+                cmd = [sys.executable, os.path.abspath(__file__), '_case', root,
+                    engine, dataset, '--threads', str(threads)]
+                if engine in SETUP:
+                    setup = subprocess.check_output([sys.executable,
+                        os.path.abspath(__file__), '_setup', root, engine, dataset])
+                    cmd += ['--setup', setup.decode('utf-8')]
+                output = subprocess.check_output(cmd)
+                result = json.loads(output.decode('utf-8'))
+                print('{engine:>22} {dataset:>14} {mb_per_s:10.1f} MB/s '
+                    '{files_per_s:10.1f} files/s'.format(**result))
+                results.append(result)
+    return {
+        'pyc4': pyc4.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': _cpu_count(),
+        'time': time.time(),
+        'results': results,
+    }
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError): # pragma: no cover
+        return None
+
+
+def _best(results):
+    """ Keep the fastest result for each engine, dataset and thread count.
+    """
+    ret = {}
+    for result in results:
+        key = (result['engine'], result['dataset'], result['threads'])
+        if key not in ret or result['wall'] < ret[key]['wall']:
+            ret[key] = result
+    return ret
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Find cases where current is slower than baseline.
+
+    Args:
+        baseline (dict): Results returned by run.
+        current (dict): Results returned by run.
+        threshold (float, optional): The fraction MB/s or files/s may drop
+            before it is flagged as a regression. Defaults to 0.1.
+
+    Returns:
+        list: (key, metric, baseline value, current value) for each regression.
+
+    Raises:
+        ValueError: If a case was run on datasets generated at different
+            scales, or of a different size.
+    """
+    regressions = []
+    old = _best(baseline['results'])
+    new = _best(current['results'])
+    for key in sorted(set(old) & set(new)):
+        for field in ('scale', 'files', 'bytes'):
+            if old[key].get(field) != new[key].get(field):
+                raise ValueError('{} {} threads={} was run on different datasets, '
+                    '{} {} != {}'.format(key[0], key[1], key[2], field,
+                    old[key].get(field), new[key].get(field)))
+        for metric in ('mb_per_s', 'files_per_s'):
+            before = old[key][metric]
+            after = new[key][metric]
+            if before and after is not None and after < before * (1 - threshold):
+                regressions.append((key, metric, before, after))
+    return regressions
+
+
+def parseArguments():
+    parser = ArgumentParser(description='Benchmark pyc4 hashing engines.')
+    sub = parser.add_subparsers(dest='command')
+
+    gen = sub.add_parser('generate', help='Create the synthetic datasets.')
+    gen.add_argument('root', help='Folder to create the datasets in.')
+    gen.add_argument('-d', '--dataset', action='append', choices=sorted(DATASETS),
+        help='Dataset to create. Can be repeatedly used. (default all)')
+    gen.add_argument('-s', '--scale', type=float, default=1.0,
+        help='Multiply the number of files and file sizes. (default 1.0)')
+
+    bench = sub.add_parser('run', help='Benchmark engines on generated datasets.')
+    bench.add_argument('root', help='Folder the datasets were generated in.')
+    bench.add_argument('-e', '--engine', action='append', choices=sorted(ENGINES),
+        help='Engine to benchmark. Can be repeatedly used. (default all)')
+    bench.add_argument('-d', '--dataset', action='append', choices=sorted(DATASETS),
+        help='Dataset to benchmark. Can be repeatedly used. (default all '
+            'generated datasets)')
+    bench.add_argument('-T', '--threads', type=int, default=8,
+        help='Number of threads for threaded engines. (default 8)')
+    bench.add_argument('-r', '--repeat', type=int, default=1,
+        help='Run each case this many times, compare uses the fastest.')
+    bench.add_argument('-o', '--output', help='Write the json results to this file.')
+
+    cmp = sub.add_parser('compare', help='Flag regressions against a baseline.')
+    cmp.add_argument('baseline', help='Results json from a previous run.')
+    cmp.add_argument('current', help='Results json to check.')
+    cmp.add_argument('-t', '--threshold', type=float, default=0.1,
+        help='Fraction MB/s or files/s may drop before failing. (default 0.1)')
+
+    case = sub.add_parser('_case')
+    case.add_argument('root')
+    case.add_argument('engine')
+    case.add_argument('dataset')
+    case.add_argument('--threads', type=int, default=8)
+    case.add_argument('--setup', type=json.loads)
+
+    setup = sub.add_parser('_setup')
+    setup.add_argument('root')
+    setup.add_argument('engine')
+    setup.add_argument('dataset')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    if args.command == 'generate':
+        for name in args.dataset or sorted(DATASETS):
+            start = time.time()
+            files = generate(args.root, name, args.scale)
+            print('{}: {} files in {:.1f}s'.format(name, len(files), time.time() - start))
+    elif args.command == 'run':
+        datasets = args.dataset or [name for name in sorted(DATASETS)
+            if os.path.exists(os.path.join(args.root, name, '.complete'))]
+        results = run(args.root, args.engine or sorted(ENGINES), datasets,
+            args.threads, args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        try:
+            regressions = compare(baseline, current, args.threshold)
+        except ValueError as e:
+            sys.exit('Can not compare: {}'.format(e))
+        for (engine, dataset, threads), metric, before, after in regressions:
+            print('REGRESSION {} {} threads={} {}: {:.1f} -> {:.1f} ({:+.1%})'.format(
+                engine, dataset, threads, metric, before, after, after / before - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regressions.')
+    elif args.command == '_case':
+        print(json.dumps(run_case(args.root, args.engine, args.dataset,
+            args.threads, args.setup)))
+    elif args.command == '_setup':
+        print(json.dumps(run_setup(args.root, args.engine, args.dataset)))
+    else:
+        print(__doc__)
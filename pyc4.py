@@ -11,6 +11,57 @@ except ImportError: # pragma: no cover "Not testable"
 import threading
 from argparse import ArgumentParser
 import codecs
+import base64
+import io
+import shutil
+import errno
+try:
+    import fcntl
+except ImportError: # pragma: no cover "Not available on windows"
+    fcntl = None
+import json
+import math
+import gzip
+import heapq
+import tempfile
+import mmap
+import struct
+from collections import namedtuple, OrderedDict
+import socket
+import select
+import signal
+try:
+    import zstandard
+except ImportError: # pragma: no cover "Optional dependency"
+    zstandard = None
+try:
+    from multiprocessing import shared_memory
+except ImportError: # pragma: no cover "Python < 3.8"
+    shared_memory = None
+import multiprocessing
+import cProfile
+import pstats
+
+# High resolution timer used for instrumentation, perf_counter is python 3 only.
+_timer = getattr(time, 'perf_counter', time.time)
+# Atomic rename that replaces the destination, os.replace is python 3 only.
+_replace = getattr(os, 'replace', os.rename)
+# The umask of the process, read once at import since os.umask can only be
+# read by setting it.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+# Linux ioctl that shares the data blocks of one file with another (reflink).
+_FICLONE = 0x40049409
+# Errors meaning a kernel copy is not supported between two files.
+_KERNEL_COPY_UNSUPPORTED = set(getattr(errno, name) for name in (
+    'EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EBADF')
+    if hasattr(errno, name))
+
+# Errors that may succeed when retried, mostly from network filesystems.
+_TRANSIENT_ERRORS = set(getattr(errno, name) for name in (
+    'EIO', 'ESTALE', 'ETIMEDOUT', 'EAGAIN', 'EINTR', 'EBUSY', 'ENETDOWN',
+    'ENETUNREACH', 'ENETRESET', 'ECONNRESET', 'ECONNABORTED', 'EHOSTDOWN',
+    'EHOSTUNREACH', 'ENOLCK') if hasattr(errno, name))
 
 __version__ = '0.2'
 __version_c4__ = '0.7.0'
@@ -18,6 +69,491 @@ __version_c4__ = '0.7.0'
 class HashIncomplete(Exception):
     """ Raised if the c4 hash calculation was canceled before finishing. """
 
+class C4VerifyError(Exception):
+    """ Raised if a copy does not have the same c4 id as its source.
+
+    Args:
+        c4id (C4id): The c4id of the source file.
+        mismatches (list): A (path, C4id or Exception) tuple for each copy
+            that didn't match, or couldn't be read.
+
+    Attributes:
+        c4id (C4id): The c4id of the source file.
+        mismatches (list): A (path, C4id or Exception) tuple for each copy
+            that didn't match, or couldn't be read.
+    """
+    def __init__(self, c4id, mismatches):
+        msg = '{} of the copies of "{}" do not match {}: {}'.format(
+            len(mismatches), c4id.path, c4id,
+            ', '.join(path for path, result in mismatches))
+        super(C4VerifyError, self).__init__(msg)
+        self.c4id = c4id
+        self.mismatches = mismatches
+
+def drop_cache(fd):
+    """ Flush fd to disk and drop its pages from the operating system cache.
+
+    Reading the file after this reads it from disk, not from memory. Only
+    supported where os.posix_fadvise is available (Linux), elsewhere the file
+    is only flushed.
+
+    Args:
+        fd (int): The file descriptor of the file.
+
+    Returns:
+        bool: If the cached pages were dropped.
+    """
+    getattr(os, 'fdatasync', os.fsync)(fd)
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None: # pragma: no cover "Not available on this platform"
+        return False
+    fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return True
+
+def mtime_ns(statinfo):
+    """ The modification time of a os.stat result as integer nanoseconds.
+    """
+    mtime = getattr(statinfo, 'st_mtime_ns', None)
+    if mtime is None: # pragma: no cover "Python 2"
+        mtime = int(statinfo.st_mtime * 1e9)
+    return mtime
+
+class C4Histogram(object):
+    """ Low overhead histogram of durations using power of two buckets.
+
+    Bucket i counts durations less than 2**i nanoseconds and at least
+    2**(i-1) nanoseconds, so adding a value is a bit_length and a list index.
+
+    Attributes:
+        count (int): The number of durations added.
+        total (float): The sum of all durations in seconds.
+        min (float or None): The shortest duration in seconds.
+        max (float or None): The longest duration in seconds.
+        buckets (list): The number of durations in each bucket.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+    bucket_count = 64
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.bucket_count
+
+    def add(self, seconds):
+        """ Add a duration to the histogram.
+
+        Args:
+            seconds (float): The duration to add.
+        """
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        index = int(seconds * 1e9).bit_length()
+        self.buckets[min(index, self.bucket_count - 1)] += 1
+
+    def merge(self, other):
+        """ Add all durations recorded in other to this histogram.
+
+        Args:
+            other (C4Histogram): The histogram to merge into this one.
+        """
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        for i, value in enumerate(other.buckets):
+            self.buckets[i] += value
+
+    @classmethod
+    def bucket_bound(cls, index):
+        """ The upper bound in seconds of the bucket at index.
+        """
+        return (2 ** index) / 1e9
+
+    def percentile(self, percent):
+        """ Estimate a percentile from the bucket upper bounds.
+
+        Args:
+            percent (float): The percentile to calculate 0-100.
+
+        Returns:
+            float or None: The estimated duration in seconds.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for i, value in enumerate(self.buckets):
+            seen += value
+            if seen >= rank:
+                return min(self.bucket_bound(i), self.max)
+        return self.max # pragma: no cover "Buckets always add up to count"
+
+    def to_dict(self):
+        """ Convert to a json serializable dict.
+        """
+        last = max([i for i, value in enumerate(self.buckets) if value] or [0])
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': [[self.bucket_bound(i), self.buckets[i]] for i in range(last + 1)],
+        }
+
+class C4MetricsRecorder(dict):
+    """ The histograms recorded by a single thread, keyed by phase name.
+
+    Missing phases are created on first use, so recording a duration is
+    ``recorder['read'].add(seconds)``.
+    """
+    def __missing__(self, phase):
+        histogram = C4Histogram()
+        self[phase] = histogram
+        return histogram
+
+    def add(self, phase, start, end, args=None):
+        """ Record a phase that ran from start to end.
+
+        Args:
+            phase (str): The name of the phase.
+            start (float): The _timer value when the phase started.
+            end (float): The _timer value when the phase ended.
+            args (dict or None, optional): Ignored, used by C4TraceRecorder.
+        """
+        self[phase].add(end - start)
+
+class C4TraceRecorder(list):
+    """ The trace events recorded by a single thread.
+
+    Events are stored as (phase, start, end, args) tuples and only converted
+    to trace event dicts when the trace is written.
+
+    Attributes:
+        thread_id (int): The thread ident of the recording thread.
+        thread_name (str): The name of the recording thread.
+        max_events (int): Events added after this many are dropped.
+        dropped (int): The number of events dropped.
+    """
+    def __init__(self, max_events):
+        super(C4TraceRecorder, self).__init__()
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.max_events = max_events
+        self.dropped = 0
+
+    def add(self, phase, start, end, args=None):
+        """ Record a phase that ran from start to end.
+
+        Args:
+            phase (str): The name of the phase.
+            start (float): The _timer value when the phase started.
+            end (float): The _timer value when the phase ended.
+            args (dict or None, optional): Shown with the event in the viewer.
+        """
+        if len(self) < self.max_events:
+            self.append((phase, start, end, args))
+        else:
+            self.dropped += 1
+
+class C4RecorderGroup(tuple):
+    """ Sends each recorded phase to several recorders.
+    """
+    def add(self, phase, start, end, args=None):
+        """ Record a phase in all recorders, see C4MetricsRecorder.add.
+        """
+        for recorder in self:
+            recorder.add(phase, start, end, args)
+
+class C4Metrics(object):
+    """ Opt in per phase timing instrumentation for C4 and C4Queue.
+
+    Each thread records into its own C4MetricsRecorder so instrumented code
+    never takes a lock. Histograms are merged only when exported.
+
+    Phases recorded:
+        open: stat and open the file.
+        read: read a single block.
+        hash: update the sha512 hash with a single block.
+        encode: base58 encode the digest.
+        file: hash a file from open through encode.
+        queue_get: a C4Queue worker waiting for the next file.
+        callback: a C4Queue worker calling worker_finished_callback.
+        lock_wait: waiting to acquire C4Queue.lock to print results.
+
+    Example:
+        metrics = C4Metrics()
+        c4 = C4Queue()
+        c4.metrics = metrics
+        metrics.start_export(json_path='metrics.json', interval=10)
+        c4.start()
+        c4.join()
+        metrics.stop_export()
+
+    Attributes:
+        json_path (str or None): Written by export with the json report.
+        prometheus_path (str or None): Written by export with the
+            Prometheus text format report.
+        interval (float): Seconds between periodic exports.
+    """
+    prometheus_name = 'pyc4_phase_seconds'
+
+    def __init__(self):
+        self.json_path = None
+        self.prometheus_path = None
+        self.interval = 10.0
+        self._local = threading.local()
+        self._recorders = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def recorder(self):
+        """ The C4MetricsRecorder for the current thread.
+
+        Returns:
+            C4MetricsRecorder: The recorder only updated by this thread.
+        """
+        recorder = getattr(self._local, 'recorder', None)
+        if recorder is None:
+            recorder = C4MetricsRecorder()
+            self._local.recorder = recorder
+            with self._lock:
+                self._recorders.append(recorder)
+        return recorder
+
+    def record(self, phase, seconds):
+        """ Add a duration for phase in the current thread.
+
+        Args:
+            phase (str): The name of the phase.
+            seconds (float): The duration to add.
+        """
+        self.recorder()[phase].add(seconds)
+
+    def histograms(self):
+        """ Merge the histograms recorded by all threads.
+
+        Returns:
+            dict: A C4Histogram for each phase name.
+        """
+        ret = {}
+        with self._lock:
+            recorders = list(self._recorders)
+        for recorder in recorders:
+            for phase, histogram in list(recorder.items()):
+                merged = ret.get(phase)
+                if merged is None:
+                    merged = ret[phase] = C4Histogram()
+                merged.merge(histogram)
+        return ret
+
+    def summary(self):
+        """ The total time spent in each phase.
+
+        Returns:
+            dict: count, seconds and mean seconds for each phase name.
+        """
+        phases = self.histograms()
+        return {phase: {
+            'count': histogram.count,
+            'seconds': histogram.total,
+            'mean': histogram.total / histogram.count if histogram.count else None,
+        } for phase, histogram in phases.items()}
+
+    def to_json(self):
+        """ The merged histograms as a json string.
+        """
+        phases = self.histograms()
+        data = {
+            'pyc4': __version__,
+            'time': time.time(),
+            'phases': {phase: phases[phase].to_dict() for phase in sorted(phases)},
+        }
+        return json.dumps(data, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """ The merged histograms in the Prometheus text exposition format.
+        """
+        name = self.prometheus_name
+        ret = [
+            '# HELP {} Time spent in each phase of c4 id generation.'.format(name),
+            '# TYPE {} histogram'.format(name),
+        ]
+        phases = self.histograms()
+        for phase in sorted(phases):
+            histogram = phases[phase]
+            cumulative = 0
+            for le, value in histogram.to_dict()['buckets']:
+                cumulative += value
+                ret.append('{}_bucket{{phase="{}",le="{!r}"}} {}'.format(
+                    name, phase, le, cumulative))
+            ret.append('{}_bucket{{phase="{}",le="+Inf"}} {}'.format(
+                name, phase, histogram.count))
+            ret.append('{}_sum{{phase="{}"}} {!r}'.format(name, phase, histogram.total))
+            ret.append('{}_count{{phase="{}"}} {}'.format(name, phase, histogram.count))
+        return '\n'.join(ret) + '\n'
+
+    @classmethod
+    def _write(cls, path, text):
+        """ Atomically replace path with text so readers never see a partial file.
+        """
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'w') as f:
+            f.write(text)
+        _replace(temp, path)
+
+    def export(self):
+        """ Write json_path and prometheus_path if they are set.
+        """
+        if self.json_path:
+            self._write(self.json_path, self.to_json())
+        if self.prometheus_path:
+            self._write(self.prometheus_path, self.to_prometheus())
+
+    def start_export(self, json_path=None, prometheus_path=None, interval=None):
+        """ Start a thread that calls export every interval seconds.
+
+        Args:
+            json_path (str or None, optional): Overrides self.json_path.
+            prometheus_path (str or None, optional): Overrides
+                self.prometheus_path.
+            interval (float or None, optional): Overrides self.interval.
+        """
+        if json_path is not None:
+            self.json_path = json_path
+        if prometheus_path is not None:
+            self.prometheus_path = prometheus_path
+        if interval is not None:
+            self.interval = interval
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_export(self):
+        """ Stop the periodic export thread and export the final results.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def _run(self):
+        """ Method run by the periodic export thread.
+        """
+        while not self._stop_event.wait(self.interval):
+            self.export()
+
+class C4Tracer(object):
+    """ Records a timeline of what each thread is doing while hashing.
+
+    The timeline is written in the Chrome trace event format, which can be
+    viewed in Perfetto (https://ui.perfetto.dev) or chrome://tracing. Each
+    thread appends events to its own buffer without locking, so recording
+    costs little more than reading the timer.
+
+    Phases recorded are the same as C4Metrics, with file events including
+    the path being hashed.
+
+    Example:
+        tracer = C4Tracer()
+        c4 = C4Queue()
+        c4.tracer = tracer
+        c4.start()
+        c4.join()
+        tracer.write('trace.json')
+
+    Args:
+        max_events (int, optional): The maximum number of events recorded by
+            each thread. Events after this are dropped to limit memory use.
+            Defaults to 1,000,000.
+    """
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+        self.origin = _timer()
+        self._local = threading.local()
+        self._recorders = []
+        self._lock = threading.Lock()
+
+    def recorder(self):
+        """ The C4TraceRecorder for the current thread.
+
+        Returns:
+            C4TraceRecorder: The recorder only updated by this thread.
+        """
+        recorder = getattr(self._local, 'recorder', None)
+        if recorder is None:
+            recorder = C4TraceRecorder(self.max_events)
+            self._local.recorder = recorder
+            with self._lock:
+                self._recorders.append(recorder)
+        return recorder
+
+    @property
+    def dropped(self):
+        """ The number of events dropped by all threads.
+        """
+        return sum(recorder.dropped for recorder in list(self._recorders))
+
+    def events(self):
+        """ Convert the recorded events to Chrome trace event dicts.
+
+        Returns:
+            list: Complete ("X") events and thread name metadata events.
+        """
+        pid = os.getpid()
+        origin = self.origin
+        ret = []
+        with self._lock:
+            recorders = list(self._recorders)
+        for recorder in recorders:
+            tid = recorder.thread_id
+            ret.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': recorder.thread_name}})
+            for phase, start, end, args in list(recorder):
+                event = {
+                    'name': phase,
+                    'cat': 'pyc4',
+                    'ph': 'X',
+                    'pid': pid,
+                    'tid': tid,
+                    # Chrome trace timestamps are in microseconds
+                    'ts': (start - origin) * 1e6,
+                    'dur': (end - start) * 1e6,
+                }
+                if args:
+                    event['args'] = args
+                ret.append(event)
+        return ret
+
+    def write(self, path):
+        """ Write the recorded events to path as a Chrome trace json file.
+
+        Args:
+            path (str): The file to write.
+        """
+        data = {
+            'traceEvents': self.events(),
+            'displayTimeUnit': 'ms',
+            'otherData': {'pyc4': __version__, 'dropped': self.dropped},
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
 class C4id(object):
     """ Data store object for a C4id.
 
@@ -36,6 +572,10 @@ class C4id(object):
             metadata_from_path is called.
         link (bool or None): This object is a link. This is None until
             metadata_from_path is called.
+        digests (dict): Other digests calculated while generating the c4id,
+            keyed by hashlib algorithm name. See C4.digests.
+        mtime (int or None): The modification time of the file in
+            nanoseconds, from the stat taken before it was read.
     """
     def __init__(self, c4id, path=None, bytes=None):
         self.c4id = c4id
@@ -44,11 +584,40 @@ class C4id(object):
         self.name = None
         self.folder = None
         self.link = None
+        self.digests = {}
+        self.mtime = None
 
     def __str__(self):
         return self.c4id
 
-    def format(self, show_metadata=False, show_path=False, absolute=False, fmt='id'):
+    @property
+    def digest(self):
+        """ The raw 64 byte sha512 digest this c4id was generated from.
+        """
+        value = C4.b58decode(self.c4id[2:])
+        return codecs.decode('{:0128x}'.format(value), 'hex_codec')
+
+    def encode(self, encoding='c4', algorithm='sha512'):
+        """ The digest for algorithm as text.
+
+        Args:
+            encoding (str, optional): One of C4.encodings. Defaults to "c4".
+                Digests other than sha512 use "hex" in place of "c4".
+            algorithm (str, optional): "sha512" or a key in digests.
+
+        Returns:
+            str: The encoded digest.
+        """
+        if algorithm == 'sha512':
+            if encoding == 'c4':
+                return self.c4id
+            return C4.encode_digest(self.digest, encoding)
+        if encoding == 'c4':
+            encoding = 'hex'
+        return C4.encode_digest(self.digests[algorithm], encoding)
+
+    def format(self, show_metadata=False, show_path=False, absolute=False, fmt='id',
+            encoding='c4'):
         """ Convert to a standard string representation.
 
         Args:
@@ -60,19 +629,27 @@ class C4id(object):
                 is returned.
             fmt (str, optional): Output formatting options. "id": c4id oriented.
                 "path": path oriented. (default "id")
+            encoding (str, optional): How the c4id and digests are encoded,
+                one of C4.encodings. (default "c4")
 
         Returns:
             str: The formatted text representation of this c4id.
         """
-        if not (show_path or show_metadata):
-            return self.c4id
-
-        path = self.path_absolute if absolute else self.path_relative
+        c4id = self.encode(encoding)
+        if not (show_path or show_metadata or self.digests):
+            return c4id
 
+        path = None
         # TODO: Would this be better handled by a python yaml library?
-        ret = ['{c4id}:', '  path: "{path}"']
-        if fmt == 'path':
-            ret = ['{path}:', '  c4id: {c4id}']
+        if not (show_path or show_metadata):
+            ret = ['{c4id}:']
+        else:
+            path = self.path_absolute if absolute else self.path_relative
+            ret = ['{c4id}:', '  path: "{path}"']
+            if fmt == 'path':
+                ret = ['{path}:', '  c4id: {c4id}']
+        for algorithm in sorted(self.digests):
+            ret.append('  {}: {}'.format(algorithm, self.encode(encoding, algorithm)))
         if show_metadata:
             if self.name is None:
                 # populate the metadata info
@@ -82,7 +659,7 @@ class C4id(object):
             ret.append('  link:  {}'.format(self.link).lower())
             ret.append('  bytes:  {}'.format(self.bytes))
 
-        return '\n'.join(ret).format(c4id=self.c4id, path=path)
+        return '\n'.join(ret).format(c4id=c4id, path=path)
 
     @property
     def path_absolute(self):
@@ -125,14 +702,58 @@ class C4(object):
             representing the progress of the hash generation.
         progress_bar_length (int): The size of the text progress bar printed
             when using the progress_default callback.
+        progress_counter (C4ProgressCounter or None): If set, the number of
+            bytes read by calculate_hash_512 is added to this counter. Used by
+            C4Progress to aggregate progress across worker threads.
+        metrics (C4Metrics or None): If set, the time spent opening, reading,
+            hashing and encoding each file is recorded. Defaults to None.
+        tracer (C4Tracer or None): If set, a timeline of opening, reading,
+            hashing and encoding each file is recorded. Defaults to None.
+        drop_cache (bool): Drop each file from the operating system's page
+            cache before reading it, so it is read from disk. Used to verify
+            files that were just written. Defaults to False.
+        digests (list): Names of hashlib algorithms, like "md5" or "sha256",
+            calculated in the same read pass as the c4 id and stored in
+            C4id.digests. Defaults to an empty list.
+        server (str or None): The socket of a C4Server. If it is running,
+            from_file asks it for the c4 id instead of reading the file,
+            unless digests or drop_cache are set, and hashes the file itself
+            when the server isn't running. Defaults to the PYC4_SERVER
+            environment variable.
     """
     c4_id_length = 90
+    # Text encodings supported by encode_digest.
+    encodings = ('c4', 'base10', 'base64', 'base64old', 'hex', 'HEX', 'h:e:x')
+    _b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
     def __init__(self, block_size=100 * (2**20)):
         # Magic number: 100 * 1MB blocks
         self.block_size = block_size
         self.progress_callback = None
         self.progress_bar_length = 50
+        self.progress_counter = None
+        self.metrics = None
+        self.tracer = None
+        self.drop_cache = False
+        self.digests = []
+        self.server = os.environ.get('PYC4_SERVER') or None
+        # Read buffers are reused, but each thread needs its own.
+        self._local = threading.local()
+
+    def _recorder(self):
+        """ The instrumentation recorder for the current thread.
+
+        Returns:
+            C4MetricsRecorder, C4TraceRecorder, C4RecorderGroup or None: None
+                if neither metrics or tracer are set.
+        """
+        if self.metrics is None and self.tracer is None:
+            return None
+        if self.tracer is None:
+            return self.metrics.recorder()
+        if self.metrics is None:
+            return self.tracer.recorder()
+        return C4RecorderGroup((self.metrics.recorder(), self.tracer.recorder()))
 
     def __stopped__(self):
         """ Checked by calculate_hash_512. If True, it will raise HashIncomplete.
@@ -150,20 +771,24 @@ class C4(object):
         # Use the bitcoin base58 character set.
         # This insures that sorting of C4 ID's produces the same order as sorting
         # the raw bytes. https://github.com/Avalanche-io/c4/issues/21
-        __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+        __b58chars = cls._b58chars
         __b58base = len(__b58chars)
 
-        long_value = int(codecs.encode(bytes, "hex_codec"), 16)
+        if hasattr(int, 'from_bytes'):
+            long_value = int.from_bytes(bytes, 'big')
+        else: # pragma: no cover "Python 2"
+            long_value = int(codecs.encode(bytes, "hex_codec"), 16)
 
-        result = ''
+        # Collect the characters in reverse and join once, instead of
+        # building a new string for every character.
+        result = []
         while long_value >= __b58base:
-            div, mod = divmod(long_value, __b58base)
-            result = __b58chars[mod] + result
-            long_value = div
+            long_value, mod = divmod(long_value, __b58base)
+            result.append(__b58chars[mod])
 
-        result = __b58chars[long_value] + result
+        result.append(__b58chars[long_value])
 
-        return result
+        return ''.join(reversed(result))
 
     def calculate_hash_512(self, path):
         """ SHA512 Hash Digest
@@ -179,29 +804,241 @@ class C4(object):
             HashIncomplete: If self.__stopped__() returns True. Used to stop
                 the calculation early.
         """
+        digests, bytes = self.calculate_hashes(path)
+        return digests['sha512'], bytes
+
+    def calculate_hashes(self, path, algorithms=('sha512',)):
+        """ Calculate several hashlib digests while reading path once.
+
+        Args:
+            path (str): The path to a file or directory to hash.
+            algorithms (iterable, optional): hashlib algorithm names, like
+                "sha512", "md5" or "sha256". Defaults to sha512 only.
+
+        Returns:
+            digests (dict): The digest for each algorithm.
+            bytes (int): The total size of the file in bytes.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True. Used to stop
+                the calculation early.
+        """
+        digests, statinfo = self._hash_file(path, algorithms)
+        return digests, statinfo.st_size
 
-        sha512_hash = hashlib.sha512()
+    def _hash_file(self, path, algorithms):
+        """ Calculate the digests for calculate_hashes.
+
+        Returns:
+            digests (dict): The digest for each algorithm.
+            statinfo (os.stat_result): The stat of path before it was read.
+        """
+        hashes = [hashlib.new(name) for name in algorithms]
+        recorder = self._recorder()
+        if recorder is not None:
+            start = _timer()
 
         statinfo = os.stat(path)
-        bytes = statinfo.st_size
         with open(path, 'rb') as f:
-            # Calculate percent using ints in python 3
-            # https://www.python.org/dev/peps/pep-0238/
-            nb_blocks = (bytes // self.block_size) + 1
-            cnt_blocks = 0
+            if self.drop_cache:
+                drop_cache(f.fileno())
+            if recorder is not None:
+                recorder.add('open', start, _timer())
+            self._update_from_stream(hashes, f, statinfo.st_size, recorder)
 
-            while True:
-                if self.__stopped__():
-                    raise HashIncomplete('__stopped__ returned True')
-                block = f.read(self.block_size)
-                if not block: break
-                sha512_hash.update(block)
-                if self.progress_callback is not None:
-                    cnt_blocks = cnt_blocks + 1
-                    progress = 100 * cnt_blocks // nb_blocks
-                    self.progress_callback(progress)
+        return {name: h.digest() for name, h in zip(algorithms, hashes)}, statinfo
+
+    def _read_buffer(self, size):
+        """ A reusable memoryview of size bytes for the current thread.
+
+        The buffer only grows as large as the files read need, up to
+        block_size, so small files don't allocate a full block.
+        """
+        size = min(size, self.block_size)
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = memoryview(bytearray(size))
+            self._local.buffer = buffer
+        return buffer[:size]
+
+    def _update_from_stream(self, hashes, stream, bytes=None, recorder=None):
+        """ Add everything read from stream to each hash in hashes.
+
+        Blocks are read into a reused buffer with readinto if the stream
+        supports it, so no memory is allocated per block.
+
+        Args:
+            hashes (list): The hashlib objects to update.
+            stream (file): The file object to read until it is exhausted.
+            bytes (int or None, optional): The expected size, used to report
+                progress_callback. No progress is reported if None.
+            recorder (C4MetricsRecorder or None, optional): The result of
+                self._recorder.
+
+        Returns:
+            int: The number of bytes read.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True.
+        """
+        counter = self.progress_counter
+        if len(hashes) == 1:
+            update = hashes[0].update
+        else:
+            update = lambda block: self._update_hashes(hashes, block)
+        readinto = getattr(stream, 'readinto', None)
+        if readinto is not None:
+            # Read a unknown amount of data from streams in 1MB blocks.
+            view = self._read_buffer(2**20 if bytes is None else bytes + 1)
+        # Calculate percent using ints in python 3
+        # https://www.python.org/dev/peps/pep-0238/
+        nb_blocks = None if bytes is None else (bytes // self.block_size) + 1
+        cnt_blocks = 0
+        total = 0
+
+        while True:
+            if self.__stopped__():
+                raise HashIncomplete('__stopped__ returned True')
+            if recorder is not None:
+                start = _timer()
+            if readinto is None:
+                block = stream.read(self.block_size)
+                size = len(block)
+            else:
+                size = readinto(view)
+                block = view[:size] if size else None
+            if recorder is None:
+                if not size: break
+                update(block)
+            else:
+                read = _timer()
+                recorder.add('read', start, read)
+                if not size: break
+                update(block)
+                recorder.add('hash', read, _timer())
+            total += size
+            if counter is not None:
+                counter.bytes += size
+            if self.progress_callback is not None and nb_blocks is not None:
+                cnt_blocks = cnt_blocks + 1
+                progress = 100 * cnt_blocks // nb_blocks
+                self.progress_callback(progress)
+        return total
+
+    @classmethod
+    def _update_hashes(cls, hashes, block, chunk_size=2**20):
+        """ Update every hash in hashes with block.
+
+        The block is passed to the hashes in chunks, so each chunk is still
+        in the CPU cache when the next hash reads it.
+        """
+        view = memoryview(block)
+        for offset in range(0, len(view), chunk_size):
+            chunk = view[offset:offset + chunk_size]
+            for h in hashes:
+                h.update(chunk)
+
+    def _new_hashes(self):
+        """ A new sha512 hash followed by a hash for each of self.digests.
+        """
+        return [hashlib.sha512()] + [hashlib.new(name) for name in self.digests]
+
+    def _add_digests(self, c4id, hashes):
+        """ Store the digests of the hashes returned by _new_hashes on c4id.
+        """
+        for name, h in zip(self.digests, hashes[1:]):
+            c4id.digests[name] = h.digest()
+        return c4id
+
+    def from_stream(self, stream, path=None):
+        """ Calculate a C4id object for everything read from stream.
+
+        Use this for pipes, sockets and sys.stdin. The stream is read until
+        it is exhausted using readinto on a reused buffer if possible.
+
+        Args:
+            stream (file): A binary file object opened for reading.
+            path (str or None, optional): Stored on the returned C4id.
+
+        Returns:
+            C4id: The C4id object for the data read.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True.
+        """
+        recorder = self._recorder()
+        start = None if recorder is None else _timer()
+        hashes = self._new_hashes()
+        bytes = self._update_from_stream(hashes, stream, recorder=recorder)
+        c4id = self._encode(hashes[0].digest(), path, bytes, recorder, start)
+        return self._add_digests(c4id, hashes)
+
+    def from_buffer(self, data, path=None):
+        """ Calculate a C4id object for an in memory buffer.
+
+        Args:
+            data (bytes-like): Any object supporting the buffer protocol,
+                like bytes, bytearray, mmap or a numpy array. Multi byte and
+                multi dimensional buffers are hashed as their raw bytes.
+            path (str or None, optional): Stored on the returned C4id.
+
+        Returns:
+            C4id: The C4id object for data.
+        """
+        recorder = self._recorder()
+        start = None if recorder is None else _timer()
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast('B')
+        hashes = self._new_hashes()
+        self._update_hashes(hashes, view)
+        if self.progress_counter is not None:
+            self.progress_counter.bytes += len(view)
+        c4id = self._encode(hashes[0].digest(), path, len(view), recorder, start)
+        return self._add_digests(c4id, hashes)
+
+    def from_buffers(self, buffers):
+        """ Calculate a C4id object for each in memory buffer.
+
+        This avoids the per call overhead of from_buffer, which adds up when
+        hashing many small buffers. Instrumentation is not recorded.
+
+        Args:
+            buffers (iterable): Objects supporting the buffer protocol.
+
+        Returns:
+            list: A C4id object for each buffer, in order.
+        """
+        sha512 = hashlib.sha512
+        from_digest = self.from_digest
+        ret = []
+        append = ret.append
+        total = 0
+        for data in buffers:
+            view = memoryview(data)
+            if view.ndim != 1 or view.itemsize != 1:
+                view = view.cast('B')
+            size = len(view)
+            total += size
+            append(from_digest(sha512(view).digest(), bytes=size))
+        if self.progress_counter is not None:
+            self.progress_counter.bytes += total
+        return ret
+
+    @classmethod
+    def format_progress_bar(cls, percent, barLen = 50):
+        """ Build the text of a simple command line progress bar.
+
+        Args:
+            percent (int): Current value of the progress 0-100.
+            barLen (int, optional): How long the bar is drawn in character.
 
-        return sha512_hash.digest(), bytes
+        Returns:
+            str: The progress bar text.
+        """
+        filled = max(0, min(barLen, int(barLen * percent // 100)))
+        progress = "=" * filled + " " * (barLen - filled)
+        return "[ %s ] %.2f%%" % (progress, percent)
 
     @classmethod
     def draw_progress_bar(cls, percent, barLen = 50):
@@ -213,14 +1050,7 @@ class C4(object):
             percent (int): Current value of the progress 0-100.
             barLen (int, optional): How long the bar is drawn in character.
         """
-        sys.stdout.write("\r")
-        progress = ""
-        for i in range(barLen):
-            if i < int(barLen * percent // 100):
-                progress += "="
-            else:
-                progress += " "
-        sys.stdout.write("[ %s ] %.2f%%" % (progress, percent))
+        sys.stdout.write("\r" + cls.format_progress_bar(percent, barLen))
         sys.stdout.flush()
 
     def from_file(self, path):
@@ -236,214 +1066,3968 @@ class C4(object):
             HashIncomplete: If self.__stopped__() returns True. Used to stop
                 the calculation early.
         """
-        #Calculate SHA512 Hash
-        hash_sha512, bytes = self.calculate_hash_512(path)
-        b58_hash = self.b58encode(hash_sha512)
+        if self.server is not None and not (self.digests or self.drop_cache):
+            c4id = self._from_server(path)
+            if c4id is not None:
+                if self.progress_counter is not None:
+                    self.progress_counter.bytes += c4id.bytes or 0
+                return c4id
+        recorder = self._recorder()
+        start = None if recorder is None else _timer()
+        # Calculate SHA512 Hash, and any other digests while reading the file once.
+        digests, statinfo = self._hash_file(path, ('sha512',) + tuple(self.digests))
+        c4id = self._encode(digests.pop('sha512'), path, statinfo.st_size, recorder, start)
+        c4id.mtime = mtime_ns(statinfo)
+        c4id.digests.update(digests)
+        return c4id
 
-        #Pad with '1's if needed
-        padding = ''
-        if len(b58_hash) < (self.c4_id_length - 2): # pragma: no cover
-            # Unable to generate a hash that requires padding, but leaving this
-            # code for completeness.
-            padding = ('1' * (self.c4_id_length - 2 - len(b58_hash)))
+    def _from_server(self, path):
+        """ Ask the C4Server at self.server for the c4id of path.
 
-        #Combine to form C4 ID
-        c4id = 'c4' + padding + b58_hash
-        return C4id(c4id, path=path, bytes=bytes)
+        Returns:
+            C4id or None: None if the server isn't running.
+        """
+        client = getattr(self._local, 'client', None)
+        try:
+            if client is None:
+                client = self._local.client = C4Client(self.server)
+            c4id = client.hash([path])[0]
+        except (socket.error, AttributeError):
+            # The server isn't running, or Unix sockets aren't supported.
+            self._local.client = None
+            return None
+        if isinstance(c4id, Exception):
+            if c4id.errno in (errno.ECANCELED, errno.EINTR):
+                # The server stopped before hashing it, not a file error.
+                return None
+            raise c4id
+        return c4id
 
-    def progress_default(self, percent):
-        """ Default progress reporting, prints a progress bar.
+    def _encode(self, digest, path, bytes, recorder, start=None):
+        """ Call from_digest, recording the encode and file phases.
 
         Args:
-            percent (int): How much of the progress bar to fill in.
-                Passed values between 0-100.
+            recorder (C4MetricsRecorder or None): The result of self._recorder.
+            start (float or None): The _timer value when hashing path started.
         """
-        self.draw_progress_bar(percent, self.progress_bar_length)
+        if recorder is None:
+            return self.from_digest(digest, path=path, bytes=bytes)
+        encode = _timer()
+        c4id = self.from_digest(digest, path=path, bytes=bytes)
+        end = _timer()
+        recorder.add('encode', encode, end)
+        recorder.add('file', start, end, {'path': path, 'bytes': bytes})
+        return c4id
 
     @classmethod
-    def versionString(cls):
-        """ The current version spec of c4 and the version of pyc4.
-        """
-        msg = 'c4 version {c4} ({platform}) pyc4 version: {pyc4}'
-        return msg.format(c4=__version_c4__, platform=sys.platform, pyc4=__version__)
+    def b58decode(cls, string):
+        """ Base58 Decode a string to an int.
 
-class C4Queue(C4):
-    """ Preform C4 hashing operations using multiple threads.
+        Args:
+            string (str): The base58 encoded string, without the "c4" prefix.
 
-    Example:
+        Returns:
+            int: The decoded value.
+        """
+        index = {char: i for i, char in enumerate(cls._b58chars)}
+        value = 0
+        for char in string:
+            value = value * 58 + index[char]
+        return value
+
+    @classmethod
+    def encode_digest(cls, digest, encoding='c4'):
+        """ Convert a raw digest to text.
+
+        Args:
+            digest (bytes): The raw digest.
+            encoding (str, optional): One of C4.encodings. "c4": a c4 id,
+                only meaningful for sha512 digests. "base10": the digest as a
+                decimal integer. "base64": url safe base64. "base64old":
+                standard base64. "hex": lower case hex. "HEX": upper case hex.
+                "h:e:x": lower case hex bytes separated by ":". Defaults to
+                "c4".
+
+        Returns:
+            str: The encoded digest.
+        """
+        if encoding == 'c4':
+            return str(cls.from_digest(digest))
+        hexed = codecs.encode(digest, 'hex_codec').decode('ascii')
+        if encoding == 'hex':
+            return hexed
+        if encoding == 'HEX':
+            return hexed.upper()
+        if encoding == 'h:e:x':
+            return ':'.join(hexed[i:i + 2] for i in range(0, len(hexed), 2))
+        if encoding == 'base10':
+            return str(int(hexed, 16))
+        if encoding == 'base64':
+            return base64.urlsafe_b64encode(digest).decode('ascii')
+        if encoding == 'base64old':
+            return base64.b64encode(digest).decode('ascii')
+        raise ValueError('Unknown encoding "{}", use one of: {}'.format(
+            encoding, ', '.join(cls.encodings)))
+
+    @classmethod
+    def from_digest(cls, digest, path=None, bytes=None):
+        """ Create a C4id object from a sha512 digest.
+
+        Args:
+            digest (bytes): The raw 64 byte sha512 digest.
+            path (str or None, optional): Stored on the returned C4id.
+            bytes (int or None, optional): Stored on the returned C4id.
+
+        Returns:
+            C4id: The C4id object for digest.
+        """
+        b58_hash = cls.b58encode(digest)
+
+        #Pad with '1's if needed
+        padding = ''
+        if len(b58_hash) < (cls.c4_id_length - 2): # pragma: no cover
+            # Unable to generate a hash that requires padding, but leaving this
+            # code for completeness.
+            padding = ('1' * (cls.c4_id_length - 2 - len(b58_hash)))
+
+        #Combine to form C4 ID
+        c4id = 'c4' + padding + b58_hash
+        return C4id(c4id, path=path, bytes=bytes)
+
+    def progress_default(self, percent):
+        """ Default progress reporting, prints a progress bar.
+
+        Args:
+            percent (int): How much of the progress bar to fill in.
+                Passed values between 0-100.
+        """
+        self.draw_progress_bar(percent, self.progress_bar_length)
+
+    @classmethod
+    def versionString(cls):
+        """ The current version spec of c4 and the version of pyc4.
+        """
+        msg = 'c4 version {c4} ({platform}) pyc4 version: {pyc4}'
+        return msg.format(c4=__version_c4__, platform=sys.platform, pyc4=__version__)
+
+class C4Writer(io.RawIOBase):
+    """ A writable file object that generates the c4 id of the data written.
+
+    Every write is passed to raw and added to the sha512 hash using a
+    memoryview of the data, so nothing is copied. The c4 id is available as
+    soon as the writer is closed, without reading the file back.
+
+    Example:
+        with C4Writer.open('render.0001.exr') as f:
+            f.write(pixels)
+        print(f.c4id)
+
+    Args:
+        raw (file): Any writable file object. It must accept memoryviews.
+        path (str or None, optional): Stored on the C4id. Defaults to
+            raw.name if it exists.
+        close_raw (bool, optional): Close raw when this writer is closed,
+            otherwise raw is only flushed. Defaults to True.
+
+    Attributes:
+        raw (file): The file object data is written to.
+        path (str or None): Stored on the C4id.
+        bytes (int): The number of bytes written.
+        c4id (C4id or None): The c4 id of the data written. None until the
+            writer is closed.
+    """
+    def __init__(self, raw, path=None, close_raw=True):
+        super(C4Writer, self).__init__()
+        self.raw = raw
+        self.path = path if path is not None else getattr(raw, 'name', None)
+        self.bytes = 0
+        self.c4id = None
+        self._close_raw = close_raw
+        self._hash = hashlib.sha512()
+
+    @classmethod
+    def open(cls, path):
+        """ Open path for writing in binary mode.
+
+        Args:
+            path (str): The file to create or truncate.
+
+        Returns:
+            C4Writer: A writer for path.
+        """
+        return cls(open(path, 'wb'), path=path)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """ Write data to raw and add it to the hash.
+
+        Args:
+            data (bytes-like): Any object supporting the buffer protocol.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            # Hash multi byte and multi dimensional buffers as raw bytes.
+            view = view.cast('B')
+        written = self.raw.write(view)
+        if written is None:
+            # Python 2 files don't return the number of bytes written.
+            written = len(view)
+        self._hash.update(view[:written])
+        self.bytes += written
+        return written
+
+    def flush(self):
+        if not self.closed:
+            self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def digest(self):
+        """ The sha512 digest of the data written so far.
+        """
+        return self._hash.digest()
+
+    def close(self):
+        """ Close or flush raw and generate the c4id.
+        """
+        if self.closed:
+            return
+        try:
+            # Flushes raw before marking this writer closed.
+            super(C4Writer, self).close()
+        finally:
+            if self._close_raw:
+                self.raw.close()
+            self.c4id = C4.from_digest(self._hash.digest(), path=self.path,
+                bytes=self.bytes)
+
+# A single manifest entry. Field order makes entries sort by path.
+C4ManifestEntry = namedtuple('C4ManifestEntry', 'path c4id bytes mtime')
+
+def _manifest_escape(path):
+    """ Escape a path so it fits on a single manifest line.
+    """
+    if '\\' in path or '\n' in path or '\r' in path:
+        path = path.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+    return path
+
+def _manifest_unescape(path):
+    """ Reverse _manifest_escape.
+    """
+    chars = iter(path)
+    result = []
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '\\')
+            char = {'n': '\n', 'r': '\r'}.get(char, char)
+        result.append(char)
+    return ''.join(result)
+
+def _manifest_lines(lines):
+    """ Parse manifest lines into C4ManifestEntry tuples, skipping comments.
+    """
+    for line in lines:
+        if line[0] == '#':
+            continue
+        c4id, bytes, mtime, path = line.rstrip('\n').split(' ', 3)
+        if '\\' in path:
+            path = _manifest_unescape(path)
+        yield C4ManifestEntry(path, c4id,
+            None if bytes == '-' else int(bytes),
+            None if mtime == '-' else int(mtime))
+
+def _manifest_compression(path):
+    """ The compression implied by the extension of path, or None.
+    """
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+class C4ManifestWriter(object):
+    """ Stream c4 ids to a manifest file.
+
+    A manifest has a line per file with its c4 id, size in bytes,
+    modification time in nanoseconds and path, separated by single spaces.
+    Unknown sizes and times are written as "-". The path is last so it can
+    contain spaces, backslashes, newlines and carriage returns are escaped
+    with a backslash. The first line is a "# pyc4 manifest 1" header, it
+    ends with "sorted" if the entries are sorted by path.
+
+    Writes are thread safe, so a single writer can be shared by all the
+    threads of a C4Queue.
+
+    Example:
+        with C4ManifestWriter('renders.c4m.gz', sort=True) as manifest:
+            for path in paths:
+                manifest.write(c4.from_file(path))
+
+    Args:
+        output (str or file): The path of the manifest, or a binary file
+            object to write it to. File objects are flushed, not closed.
+        sort (bool, optional): Sort the entries by path. Entries are held in
+            memory, spilling sorted runs to temporary files every
+            max_entries, and merged when the writer is closed.
+            Defaults to False.
+        compression (str or None, optional): "gzip", "zstd" or None. Defaults
+            to the compression implied by a ".gz" or ".zst" path extension.
+            zstd requires the zstandard package.
+        max_entries (int, optional): The number of entries sorted in memory
+            before they are spilled to a temporary file. Defaults to 1000000.
+
+    Attributes:
+        sort (bool): Entries are sorted by path.
+        compression (str or None): The compression of the manifest.
+        entries (int): The number of entries written.
+    """
+    compressions = ('gzip', 'zstd')
+    header = '# pyc4 manifest 1'
+
+    def __init__(self, output, sort=False, compression=None, max_entries=1000000):
+        if compression is None and not hasattr(output, 'write'):
+            compression = _manifest_compression(output)
+        if compression not in (None,) + self.compressions:
+            raise ValueError('Unknown manifest compression "{}", use one of: {}'.format(
+                compression, ', '.join(self.compressions)))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd manifests require the zstandard package')
+        self.sort = sort
+        self.compression = compression
+        self.max_entries = max_entries
+        self.entries = 0
+        self._lock = threading.Lock()
+        self._sorted = []
+        self._runs = []
+        self._streams = []
+        self._file = None
+        raw = output
+        if hasattr(output, 'write'):
+            self._file = output
+        else:
+            raw = open(output, 'wb')
+            self._streams.append(raw)
+        if compression == 'gzip':
+            raw = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+            self._streams.append(raw)
+        elif compression == 'zstd':
+            raw = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+            self._streams.append(raw)
+        self._output = self._text(raw)
+        self._output.write(self.header + (' sorted\n' if sort else '\n'))
+
+    @staticmethod
+    def _text(raw):
+        return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogateescape',
+            newline='\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _line(entry):
+        return '{} {} {} {}\n'.format(entry.c4id,
+            '-' if entry.bytes is None else entry.bytes,
+            '-' if entry.mtime is None else entry.mtime,
+            _manifest_escape(entry.path))
+
+    def write(self, c4id):
+        """ Add a c4 id to the manifest.
+
+        Args:
+            c4id (C4id or C4ManifestEntry): Any object with c4id, bytes, path
+                and optionally mtime attributes.
+        """
+        # Piped data has no path, "-" is used like on the command line.
+        path = '-' if c4id.path is None else c4id.path
+        entry = C4ManifestEntry(path, str(c4id.c4id), c4id.bytes,
+            getattr(c4id, 'mtime', None))
+        with self._lock:
+            self.entries += 1
+            if not self.sort:
+                self._output.write(self._line(entry))
+                return
+            self._sorted.append(entry)
+            if len(self._sorted) >= self.max_entries:
+                self._spill()
+
+    def _spill(self):
+        """ Write the sorted entries in memory to a temporary file.
+        """
+        self._sorted.sort(key=lambda entry: entry.path)
+        run = self._text(tempfile.TemporaryFile())
+        run.writelines(self._line(entry) for entry in self._sorted)
+        run.flush()
+        self._runs.append(run)
+        self._sorted = []
+
+    @staticmethod
+    def _by_path(entries, run):
+        """ Key sorted entries for heapq.merge by path only. The run and
+        position break ties, so entries are never compared.
+        """
+        for i, entry in enumerate(entries):
+            yield entry.path, run, i, entry
+
+    def close(self):
+        """ Write any sorted entries and close the manifest.
+        """
+        if self._output is None:
+            return
+        try:
+            if self.sort:
+                self._sorted.sort(key=lambda entry: entry.path)
+                for run in self._runs:
+                    run.seek(0)
+                # The entries still in memory were written after every run.
+                runs = [_manifest_lines(run) for run in self._runs] + [self._sorted]
+                keyed = [self._by_path(run, i) for i, run in enumerate(runs)]
+                self._output.writelines(self._line(entry)
+                    for path, i, j, entry in heapq.merge(*keyed))
+            self._output.flush()
+            # Don't let the text wrapper close the file objects it wraps.
+            self._output.detach()
+            for stream in reversed(self._streams):
+                stream.close()
+            if self._file is not None:
+                self._file.flush()
+        finally:
+            for run in self._runs:
+                run.close()
+            self._runs = []
+            self._sorted = []
+            self._output = None
+
+class C4ManifestReader(object):
+    """ Read the entries of a manifest written by C4ManifestWriter.
+
+    gzip and zstd manifests are detected from their content.
+
+    Example:
+        with C4ManifestReader('renders.c4m.gz') as manifest:
+            for entry in manifest:
+                print(entry.c4id, entry.path)
+
+    Args:
+        input (str or file): The path of the manifest, or a binary file
+            object to read it from. File objects are not closed.
+
+    Attributes:
+        sorted (bool): The entries are sorted by path.
+        compression (str or None): "gzip", "zstd" or None.
+
+    Raises:
+        ValueError: If input isn't a manifest.
+    """
+    def __init__(self, input):
+        self._streams = []
+        raw = input
+        if not hasattr(input, 'read'):
+            raw = open(input, 'rb')
+            self._streams.append(raw)
+        if not hasattr(raw, 'peek'):
+            raw = io.BufferedReader(raw)
+        magic = raw.peek(4)[:4]
+        self.compression = None
+        if magic[:2] == b'\x1f\x8b':
+            self.compression = 'gzip'
+            raw = gzip.GzipFile(fileobj=raw, mode='rb')
+            self._streams.append(raw)
+        elif magic == b'\x28\xb5\x2f\xfd':
+            self.compression = 'zstd'
+            if zstandard is None:
+                raise ValueError('zstd manifests require the zstandard package')
+            raw = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+                raw, closefd=False))
+            self._streams.append(raw)
+        self._input = io.TextIOWrapper(raw, encoding='utf-8',
+            errors='surrogateescape', newline='\n')
+        header = self._input.readline().split()
+        if ' '.join(header[:4]) != C4ManifestWriter.header:
+            self.close()
+            raise ValueError('{} is not a pyc4 manifest'.format(
+                getattr(input, 'name', input)))
+        self.sorted = 'sorted' in header[4:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return _manifest_lines(self._input)
+
+    def close(self):
+        if self._input is None:
+            return
+        self._input.detach()
+        for stream in reversed(self._streams):
+            stream.close()
+        self._input = None
+
+class C4Journal(object):
+    """ A durable log of c4 ids, so a long job can resume after a crash.
+
+    The journal is a manifest that results are appended to. It is flushed
+    and fsynced every sync_interval seconds and when closed, so at most that
+    much work is lost. When a journal is opened again its entries are read
+    back, dropping a final line that was only partly written, and completed
+    returns the c4 id of files whose size and modification time haven't
+    changed, so they aren't hashed again.
+
+    Example:
+        with C4Journal('job.c4j') as journal:
+            for path in paths:
+                c4id = journal.completed(path)
+                if c4id is None:
+                    c4id = c4.from_file(path)
+                    journal.write(c4id)
+
+    Args:
+        path (str): The journal file, created if it doesn't exist.
+        sync_interval (float, optional): The most seconds between fsyncs.
+            Defaults to 5.
+
+    Attributes:
+        path (str): The journal file.
+        sync_interval (float): The most seconds between fsyncs.
+        entries (dict): The C4ManifestEntry of each path in the journal when
+            it was opened.
+        resumed (int): The number of c4 ids returned by completed.
+    """
+    def __init__(self, path, sync_interval=5.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.entries = {}
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._last_sync = _timer()
+        self._file = self._open()
+
+    def _open(self):
+        """ Read the existing entries and open the journal for appending.
+        """
+        header = (C4ManifestWriter.header + '\n').encode('utf-8')
+        f = open(self.path, 'a+b')
+        f.seek(0)
+        good = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Interrupted while writing this line.
+                break
+            if good == 0:
+                if line != header:
+                    f.close()
+                    raise ValueError('{} is not a pyc4 journal'.format(self.path))
+            else:
+                for entry in _manifest_lines([line.decode('utf-8', 'surrogateescape')]):
+                    self.entries[entry.path] = entry
+            good += len(line)
+        f.truncate(good)
+        f.seek(good)
+        if good == 0:
+            f.write(header)
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def completed(self, path):
+        """ The c4 id of path if it is in the journal and hasn't changed.
+
+        Args:
+            path (str): The file path, as it was written to the journal.
+
+        Returns:
+            C4id or None: None if path isn't in the journal, or its size or
+                modification time changed.
+        """
+        entry = self.entries.get(path)
+        if entry is None or entry.mtime is None:
+            return None
+        try:
+            statinfo = os.stat(path)
+        except OSError:
+            return None
+        if statinfo.st_size != entry.bytes or mtime_ns(statinfo) != entry.mtime:
+            return None
+        c4id = C4id(entry.c4id, path=path, bytes=entry.bytes)
+        c4id.mtime = entry.mtime
+        self.resumed += 1
+        return c4id
+
+    def write(self, c4id):
+        """ Append a c4 id to the journal, fsyncing every sync_interval.
+
+        Args:
+            c4id (C4id): The result to record. Entries without an mtime are
+                recorded, but never resumed.
+        """
+        entry = C4ManifestEntry('-' if c4id.path is None else c4id.path,
+            str(c4id), c4id.bytes, getattr(c4id, 'mtime', None))
+        line = C4ManifestWriter._line(entry).encode('utf-8', 'surrogateescape')
+        with self._lock:
+            self._file.write(line)
+            if _timer() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = _timer()
+
+    def close(self):
+        """ fsync and close the journal.
+        """
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+# A difference between two manifests, old or new is None if added or removed.
+C4DiffEntry = namedtuple('C4DiffEntry', 'status old new')
+
+class C4Diff(object):
+    """ Compare two manifests sorted by path in a single streaming pass.
+
+    Both manifests are merge joined by path. A path in both with a
+    different c4 id is "modified". Paths only in old are "removed" and only
+    in new are "added", unless the same c4 id is removed from one path and
+    added to another, which is "moved". Only entries that could be part of
+    a move are held in memory, so memory use depends on the number of
+    changes, not the size of the manifests. Modified entries are produced as
+    they are found, moves when both sides have been seen, and the remaining
+    added and removed entries at the end.
+
+    Example:
+        for change in C4Diff('monday.c4m.gz', 'tuesday.c4m.gz'):
+            print(change.status, (change.new or change.old).path)
+
+    Args:
+        old (str, file or iterable): A sorted manifest path or binary file
+            object, or C4ManifestEntry objects sorted by path.
+        new (str, file or iterable): Like old.
+
+    Attributes:
+        counts (dict): The number of each status found so far, including
+            "unchanged".
+
+    Raises:
+        ValueError: If a manifest isn't sorted by path.
+    """
+    statuses = ('added', 'removed', 'modified', 'moved')
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.counts = dict.fromkeys(self.statuses + ('unchanged',), 0)
+
+    @staticmethod
+    def _entries(manifest):
+        """ Iterate the entries of manifest, checking they are sorted.
+        """
+        reader = None
+        if isinstance(manifest, str) or hasattr(manifest, 'read'):
+            name = getattr(manifest, 'name', manifest)
+            reader = manifest = C4ManifestReader(manifest)
+            if not reader.sorted:
+                reader.close()
+                raise ValueError('{} is not sorted by path, write it with '
+                    'sort=True or --sorted'.format(name))
+        try:
+            last = None
+            for entry in manifest:
+                if last is not None and entry.path <= last:
+                    raise ValueError('Manifest entries are not sorted by path: '
+                        '"{}" follows "{}"'.format(entry.path, last))
+                last = entry.path
+                yield entry
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def __iter__(self):
+        counts = self.counts
+        removed = {}
+        added = {}
+        old = self._entries(self.old)
+        new = self._entries(self.new)
+        a = next(old, None)
+        b = next(new, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a.path < b.path):
+                # a is not in new, pair it with an added entry if it moved.
+                moved = added.get(a.c4id)
+                if moved:
+                    counts['moved'] += 1
+                    yield C4DiffEntry('moved', a, moved.pop())
+                else:
+                    removed.setdefault(a.c4id, []).append(a)
+                a = next(old, None)
+            elif a is None or b.path < a.path:
+                moved = removed.get(b.c4id)
+                if moved:
+                    counts['moved'] += 1
+                    yield C4DiffEntry('moved', moved.pop(), b)
+                else:
+                    added.setdefault(b.c4id, []).append(b)
+                b = next(new, None)
+            else:
+                if a.c4id == b.c4id:
+                    counts['unchanged'] += 1
+                else:
+                    counts['modified'] += 1
+                    yield C4DiffEntry('modified', a, b)
+                a = next(old, None)
+                b = next(new, None)
+        for entries in removed.values():
+            for a in entries:
+                counts['removed'] += 1
+                yield C4DiffEntry('removed', a, None)
+        for entries in added.values():
+            for b in entries:
+                counts['added'] += 1
+                yield C4DiffEntry('added', None, b)
+
+def _thread_map(function, items, max_threads):
+    """ Call function for each item using up to max_threads threads.
+
+    Returns:
+        results (dict): The result for each item.
+        errors (dict): The exception raised for each item that failed,
+            these items have no result.
+    """
+    work = queue.Queue()
+    for item in items:
+        work.put(item)
+    results = {}
+    errors = {}
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[item] = function(item)
+            except Exception as error:
+                # Keep going, a failed item mustn't stop the other items.
+                errors[item] = error
+
+    threads = [threading.Thread(target=worker)
+        for i in range(min(work.qsize(), max_threads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+def _c4_digest(c4id):
+    """ The raw sha512 digest of a C4id, c4 id string or 64 byte digest.
+    """
+    if isinstance(c4id, (bytes, bytearray)) and len(c4id) == 64:
+        return bytes(c4id)
+    if not isinstance(c4id, C4id):
+        c4id = C4id(str(c4id))
+    return c4id.digest
+
+class C4Index(object):
+    """ A binary index of c4 ids for fast lookups, opened with mmap.
+
+    The index is a header, a table of records sorted by the raw 64 byte
+    sha512 digest each followed by the offset of its path, then a table of
+    newline terminated paths escaped like manifest paths. Raw digests sort in
+    the same order as c4 ids, see C4.b58encode. Opening an index only maps
+    it into memory, each lookup is a binary search touching log2(n) records.
+
+    Example:
+        C4Index.build('archive.c4x', C4ManifestReader('archive.c4m'))
+        with C4Index('archive.c4x') as index:
+            if c4id in index:
+                print(index.lookup(c4id))
+
+    Args:
+        path (str): The index file written by C4Index.build.
+
+    Raises:
+        ValueError: If path isn't a pyc4 index.
+    """
+    magic = b'PYC4IDX1'
+    # magic, record count, path table offset, padded to 64 bytes.
+    _header = struct.Struct('<8sQQ40x')
+    # raw sha512 digest, offset into the path table.
+    _record = struct.Struct('<64sQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(self._header.size)
+            if len(header) != self._header.size:
+                raise ValueError('{} is not a pyc4 index'.format(path))
+            magic, self._count, self._paths = self._header.unpack(header)
+            if magic != self.magic:
+                raise ValueError('{} is not a pyc4 index'.format(path))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, path, entries, max_entries=1000000):
+        """ Write an index of entries, sorting them in bounded memory.
+
+        Records are sorted in memory, spilling sorted runs to temporary files
+        every max_entries, then merged into the index. Paths are written to a
+        temporary path table as they arrive, so memory use doesn't depend on
+        the length of paths.
+
+        Args:
+            path (str): The index file to create. It is written to a
+                temporary file that replaces path when complete.
+            entries (iterable): C4id, C4ManifestEntry or any objects with
+                c4id and path attributes.
+            max_entries (int, optional): The number of records sorted in
+                memory before spilling them to a temporary file. Defaults to
+                1000000.
+
+        Returns:
+            int: The number of entries in the index.
+        """
+        record = cls._record
+        records = []
+        runs = []
+        paths = tempfile.TemporaryFile()
+        offset = 0
+        count = 0
+        temp = path + '.{}.tmp'.format(os.getpid())
+        try:
+            for entry in entries:
+                line = (_manifest_escape('-' if entry.path is None else entry.path)
+                    + '\n').encode('utf-8', 'surrogateescape')
+                records.append(record.pack(_c4_digest(entry.c4id), offset))
+                paths.write(line)
+                offset += len(line)
+                count += 1
+                if len(records) >= max_entries:
+                    records.sort()
+                    run = tempfile.TemporaryFile()
+                    run.write(b''.join(records))
+                    run.seek(0)
+                    runs.append(run)
+                    records = []
+            records.sort()
+            readers = [iter(lambda run=run: run.read(record.size), b'')
+                for run in runs]
+            with open(temp, 'wb') as f:
+                table = cls._header.size + count * record.size
+                f.write(cls._header.pack(cls.magic, count, table))
+                for packed in heapq.merge(records, *readers):
+                    f.write(packed)
+                paths.seek(0)
+                shutil.copyfileobj(paths, f)
+            _replace(temp, path)
+        finally:
+            paths.close()
+            for run in runs:
+                run.close()
+            if os.path.isfile(temp):
+                os.remove(temp)
+        return count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, c4id):
+        digest = _c4_digest(c4id)
+        i = self._search(digest, 0)
+        return i < self._count and self._digest(i) == digest
+
+    def _digest(self, i):
+        start = self._header.size + i * self._record.size
+        return self._map[start:start + 64]
+
+    def _path(self, i):
+        start = self._header.size + i * self._record.size + 64
+        offset = self._paths + struct.unpack('<Q', self._map[start:start + 8])[0]
+        path = self._map[offset:self._map.find(b'\n', offset)].decode(
+            'utf-8', 'surrogateescape')
+        return _manifest_unescape(path) if '\\' in path else path
+
+    def _search(self, digest, lo):
+        """ The first record at or after lo with a digest >= digest.
+        """
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _paths_from(self, digest, i):
+        paths = []
+        while i < self._count and self._digest(i) == digest:
+            paths.append(self._path(i))
+            i += 1
+        return paths, i
+
+    def lookup(self, c4id):
+        """ Find the paths of a c4 id.
+
+        Args:
+            c4id (C4id, str or bytes): A C4id, c4 id string or raw sha512
+                digest.
+
+        Returns:
+            list: The path of every entry with this c4 id, empty if there are
+                none.
+        """
+        digest = _c4_digest(c4id)
+        return self._paths_from(digest, self._search(digest, 0))[0]
+
+    def lookup_many(self, c4ids):
+        """ Find the paths of many c4 ids.
+
+        The queries are sorted so each binary search starts where the
+        previous one ended, and records near each other are read together.
+
+        Args:
+            c4ids (iterable): C4ids, c4 id strings or raw sha512 digests.
+
+        Returns:
+            dict: The list of paths for each query that was found.
+        """
+        queries = sorted(((_c4_digest(c4id), c4id) for c4id in c4ids),
+            key=lambda query: query[0])
+        results = {}
+        i = 0
+        for digest, c4id in queries:
+            i = self._search(digest, i)
+            paths = self._paths_from(digest, i)[0]
+            if paths:
+                results[c4id] = paths
+        return results
+
+    def close(self):
+        self._map.close()
+
+class C4IdSet(object):
+    """ A sorted set of c4 ids stored as raw 64 byte sha512 digests.
+
+    Sets support union, intersection, difference and symmetric difference
+    by merging their sorted digests in a single pass, without creating a
+    C4id per entry. Sets loaded from a file are mapped with mmap, so only
+    the result of an operation is held in memory.
+
+    Example:
+        a = C4IdSet.load('site_a.c4s')
+        b = C4IdSet.from_ids(C4ManifestReader('site_b.c4m.gz'))
+        missing = a - b
+        missing.save('missing_from_b.c4s')
+        for c4id in missing.ids():
+            print(c4id)
+
+    Args:
+        digests (bytes-like, optional): Sorted, unique 64 byte digests.
+            Defaults to an empty set.
+    """
+    def __init__(self, digests=b''):
+        if len(digests) % 64:
+            raise ValueError('C4IdSet digests must be a multiple of 64 bytes')
+        self.digests = digests
+        self._map = None
+
+    @classmethod
+    def from_ids(cls, c4ids):
+        """ Create a set from c4 ids in any order.
+
+        Args:
+            c4ids (iterable): C4ids, C4ManifestEntries, c4 id strings or raw
+                sha512 digests.
+
+        Returns:
+            C4IdSet: The set of c4ids.
+        """
+        digests = sorted(set(_c4_digest(getattr(c4id, 'c4id', c4id))
+            for c4id in c4ids))
+        return cls(b''.join(digests))
+
+    @classmethod
+    def from_index(cls, index):
+        """ Create a set of the c4 ids in a C4Index, which are already sorted.
+
+        Args:
+            index (C4Index): The index.
+
+        Returns:
+            C4IdSet: The set of c4 ids in index.
+        """
+        digests = bytearray()
+        last = None
+        for i in range(len(index)):
+            digest = index._digest(i)
+            if digest != last:
+                digests += digest
+                last = digest
+        return cls(bytes(digests))
+
+    @classmethod
+    def load(cls, path):
+        """ Map a set written by save into memory.
+
+        Args:
+            path (str): The file of digests.
+
+        Returns:
+            C4IdSet: The set stored in path.
+        """
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return cls()
+            map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        idset = cls(map)
+        idset._map = map
+        return idset
+
+    def save(self, path):
+        """ Write the digests to path.
+        """
+        with open(path, 'wb') as f:
+            f.write(self.digests)
+
+    def close(self):
+        """ Unmap a set opened with load.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return len(self.digests) // 64
+
+    def __iter__(self):
+        digests = self.digests
+        for i in range(0, len(digests), 64):
+            yield digests[i:i + 64]
+
+    def __eq__(self, other):
+        return isinstance(other, C4IdSet) and self.digests[:] == other.digests[:]
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, c4id):
+        digest = _c4_digest(getattr(c4id, 'c4id', c4id))
+        digests = self.digests
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if digests[mid * 64:mid * 64 + 64] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return digests[lo * 64:lo * 64 + 64] == digest
+
+    def ids(self):
+        """ Iterate the c4 id strings of the set in sorted order.
+        """
+        for digest in self:
+            yield str(C4.from_digest(digest))
+
+    def _merge(self, other, left, both, right):
+        """ Merge the sorted digests of self and other.
+
+        Args:
+            other (C4IdSet): The other set.
+            left (bool): Keep digests only in self.
+            both (bool): Keep digests in both sets.
+            right (bool): Keep digests only in other.
+
+        Returns:
+            C4IdSet: The digests kept.
+        """
+        a, b = self.digests, other.digests
+        na, nb = len(a), len(b)
+        result = bytearray()
+        i = j = 0
+        x = a[0:64]
+        y = b[0:64]
+        while i < na and j < nb:
+            if x < y:
+                if left:
+                    result += x
+                i += 64
+                x = a[i:i + 64]
+            elif y < x:
+                if right:
+                    result += y
+                j += 64
+                y = b[j:j + 64]
+            else:
+                if both:
+                    result += x
+                i += 64
+                j += 64
+                x = a[i:i + 64]
+                y = b[j:j + 64]
+        if left:
+            result += a[i:]
+        if right:
+            result += b[j:]
+        return C4IdSet(bytes(result))
+
+    def union(self, *others):
+        """ The c4 ids in any of the sets. """
+        result = self
+        for other in others:
+            result = result._merge(other, True, True, True)
+        return result
+
+    def intersection(self, *others):
+        """ The c4 ids in all of the sets. """
+        result = self
+        for other in others:
+            result = result._merge(other, False, True, False)
+        return result
+
+    def difference(self, *others):
+        """ The c4 ids in this set, but not in any of the others. """
+        result = self
+        for other in others:
+            result = result._merge(other, True, False, False)
+        return result
+
+    def symmetric_difference(self, other):
+        """ The c4 ids in only one of the two sets. """
+        return self._merge(other, True, False, True)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+class C4Filter(object):
+    """ A Bloom filter of c4 ids, for a fast "definitely not present" check.
+
+    sha512 digests are already uniformly distributed, so the bit positions
+    of each c4 id are taken straight from its digest instead of hashing it
+    again: bit i is (h1 + i * h2) mod bits, where h1 and h2 are the first
+    two 64 bit words of the digest.
+
+    Example:
+        remote = C4Filter(capacity=len(ids))
+        remote.add_many(ids)
+        remote.save('site_b.c4f')
+        ...
+        site_b = C4Filter.load('site_b.c4f')
+        to_send = [c4id for c4id, found in
+            zip(local, site_b.contains_many(local)) if not found]
+
+    Args:
+        capacity (int, optional): The number of c4 ids the filter is sized
+            for. Defaults to 1000000.
+        error_rate (float, optional): The false positive rate when capacity
+            c4 ids have been added. Defaults to 0.01.
+
+    Attributes:
+        bits (int): The size of the filter in bits.
+        hashes (int): The number of bits set for each c4 id.
+        count (int): The number of c4 ids added, including duplicates.
+    """
+    magic = b'PYC4BLM1'
+    # magic, bits, hashes, count
+    _header = struct.Struct('<8sQQQ')
+    _words = struct.Struct('>QQ')
+    # The number of 64 bit words merged at a time by update.
+    _merge_words = 8192
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        capacity = max(1, capacity)
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.bits = max(64, int(math.ceil(bits / 64)) * 64)
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.count = 0
+        self._array = bytearray(self.bits // 8)
+
+    @property
+    def error_rate(self):
+        """ The estimated false positive rate for the c4 ids added so far.
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def _positions(self, c4id):
+        h1, h2 = self._words.unpack_from(_c4_digest(getattr(c4id, 'c4id', c4id)))
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def add(self, c4id):
+        """ Add a C4id, c4 id string or raw sha512 digest to the filter.
+        """
+        array = self._array
+        for bit in self._positions(c4id):
+            array[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def add_many(self, c4ids):
+        """ Add C4ids, C4ManifestEntries, c4 id strings or raw digests.
+        """
+        for c4id in c4ids:
+            self.add(c4id)
+
+    def __contains__(self, c4id):
+        array = self._array
+        for bit in self._positions(c4id):
+            if not array[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def contains_many(self, c4ids):
+        """ Check many c4 ids.
+
+        Returns:
+            list: False for each c4 id that is definitely not in the filter,
+                True if it probably is.
+        """
+        # The same checks as __contains__ with the lookups hoisted out of the loop.
+        array = self._array
+        bits = self.bits
+        hashes = range(self.hashes)
+        unpack = self._words.unpack_from
+        results = []
+        append = results.append
+        for c4id in c4ids:
+            if not isinstance(c4id, bytes) or len(c4id) != 64:
+                c4id = _c4_digest(getattr(c4id, 'c4id', c4id))
+            h1, h2 = unpack(c4id)
+            for i in hashes:
+                bit = (h1 + i * h2) % bits
+                if not array[bit >> 3] & (1 << (bit & 7)):
+                    append(False)
+                    break
+            else:
+                append(True)
+        return results
+
+    def update(self, other):
+        """ Add every c4 id in other to this filter.
+
+        Args:
+            other (C4Filter): A filter with the same bits and hashes.
+
+        Raises:
+            ValueError: If other has a different size.
+        """
+        if (other.bits, other.hashes) != (self.bits, self.hashes):
+            raise ValueError('Only filters with the same bits and hashes can '
+                'be merged')
+        # OR 64 bit words a chunk at a time, rather than one huge integer.
+        array, other_array = self._array, other._array
+        words = struct.Struct('<{}Q'.format(self._merge_words))
+        size = words.size
+        for offset in range(0, len(array), size):
+            end = min(offset + size, len(array))
+            if end - offset == size:
+                pack = words
+            else:
+                pack = struct.Struct('<{}Q'.format((end - offset) // 8))
+            merged = [a | b for a, b in zip(pack.unpack_from(array, offset),
+                pack.unpack_from(other_array, offset))]
+            pack.pack_into(array, offset, *merged)
+        self.count += other.count
+
+    def __or__(self, other):
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def copy(self):
+        result = C4Filter.__new__(C4Filter)
+        result.bits = self.bits
+        result.hashes = self.hashes
+        result.count = self.count
+        result._array = bytearray(self._array)
+        return result
+
+    def save(self, path):
+        """ Write the filter to path.
+        """
+        with open(path, 'wb') as f:
+            f.write(self._header.pack(self.magic, self.bits, self.hashes, self.count))
+            f.write(self._array)
+
+    @classmethod
+    def load(cls, path):
+        """ Read a filter written by save.
+
+        Raises:
+            ValueError: If path isn't a pyc4 filter.
+        """
+        with open(path, 'rb') as f:
+            header = f.read(cls._header.size)
+            array = bytearray(f.read())
+        if len(header) != cls._header.size:
+            raise ValueError('{} is not a pyc4 filter'.format(path))
+        magic, bits, hashes, count = cls._header.unpack(header)
+        if magic != cls.magic or len(array) * 8 != bits:
+            raise ValueError('{} is not a pyc4 filter'.format(path))
+        result = cls.__new__(cls)
+        result.bits = bits
+        result.hashes = hashes
+        result.count = count
+        result._array = array
+        return result
+
+class C4ProgressCounter(object):
+    """ Per thread byte and file counter updated by the hashing hot loop.
+
+    Each worker thread owns its own counter so updating it never requires a
+    lock. C4Progress sums all of its counters when it renders.
+
+    Attributes:
+        bytes (int): The number of bytes hashed by this thread.
+        files (int): The number of files finished by this thread.
+    """
+    __slots__ = ('bytes', 'files')
+
+    def __init__(self):
+        self.bytes = 0
+        self.files = 0
+
+class C4Progress(object):
+    """ Byte weighted progress aggregated across all worker threads.
+
+    Example:
+        progress = C4Progress(total_bytes=size, total_files=count)
+        c4 = C4()
+        c4.progress_counter = progress.counter()
+        progress.start()
+        c4.from_file(path)
+        progress.stop()
+
+    Args:
+        total_bytes (int, optional): The number of bytes that will be hashed.
+        total_files (int, optional): The number of files that will be hashed.
+        refresh_rate (float, optional): Seconds between calls to callback
+            while running. Defaults to 0.5.
+
+    Attributes:
+        callback (callable or None): Called with this C4Progress instance every
+            refresh_rate seconds from a single thread started by start().
+        total_bytes (int): The number of bytes that will be hashed.
+        total_files (int): The number of files that will be hashed.
+        refresh_rate (float): Seconds between calls to callback.
+    """
+    def __init__(self, total_bytes=0, total_files=0, refresh_rate=0.5):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.refresh_rate = refresh_rate
+        self.callback = None
+        self._counters = []
+        self._lock = threading.Lock()
+        self._start_time = None
+        self._stop_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._sizers = []
+
+    def counter(self):
+        """ Create a new counter that is included in this progress.
+
+        Returns:
+            C4ProgressCounter: A counter that should only be updated by a
+                single thread.
+        """
+        counter = C4ProgressCounter()
+        with self._lock:
+            self._counters.append(counter)
+        return counter
+
+    def add_file(self, path):
+        """ Add the size of path to total_bytes and count it in total_files.
+
+        Args:
+            path (str): The file that will be hashed.
+        """
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            # The worker reports missing files, just don't count its bytes.
+            size = 0
+        with self._lock:
+            self.total_bytes += size
+        self.total_files += 1
+
+    def add_files(self, paths):
+        """ Count paths in total_files and add their sizes to total_bytes from
+        a background thread.
+
+        Hashing can start right away instead of waiting to stat every file,
+        total_bytes grows while they are sized. Until every size is known the
+        percent is weighted by the number of files.
+
+        Args:
+            paths (list): The files that will be hashed.
+        """
+        paths = list(paths)
+        self.total_files += len(paths)
+        thread = threading.Thread(target=self._add_sizes, args=(paths,))
+        thread.daemon = True
+        with self._lock:
+            self._sizers.append(thread)
+        thread.start()
+
+    def _add_sizes(self, paths):
+        """ Method run by the threads started by add_files.
+        """
+        total = 0
+        for i, path in enumerate(paths):
+            if self._stop_event.is_set():
+                return
+            try:
+                total += os.stat(path).st_size
+            except OSError:
+                # The worker reports missing files, just don't count its bytes.
+                pass
+            if i % 1000 == 999:
+                with self._lock:
+                    self.total_bytes += total
+                total = 0
+        with self._lock:
+            self.total_bytes += total
+
+    @property
+    def sizing(self):
+        """ Are the sizes of files passed to add_files still being added?
+        """
+        return any(thread.is_alive() for thread in list(self._sizers))
+
+    @property
+    def bytes_done(self):
+        """ The total number of bytes hashed by all counters.
+        """
+        return sum(counter.bytes for counter in list(self._counters))
+
+    @property
+    def files_done(self):
+        """ The total number of files finished by all counters.
+        """
+        return sum(counter.files for counter in list(self._counters))
+
+    @property
+    def elapsed(self):
+        """ Seconds since start was called.
+        """
+        if self._start_time is None:
+            return 0.0
+        end = self._stop_time if self._stop_time is not None else time.time()
+        return end - self._start_time
+
+    @property
+    def percent(self):
+        """ Percent of total_bytes that has been hashed, 0-100.
+        """
+        if self.total_bytes and not self.sizing:
+            return min(100.0, 100.0 * self.bytes_done / self.total_bytes)
+        if self.total_files:
+            return min(100.0, 100.0 * self.files_done / self.total_files)
+        return 100.0 if self._stop_time is not None else 0.0
+
+    @property
+    def bytes_per_second(self):
+        """ Average hashing throughput in bytes per second.
+        """
+        elapsed = self.elapsed
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def files_per_second(self):
+        """ Average number of files finished per second.
+        """
+        elapsed = self.elapsed
+        return self.files_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """ Estimated seconds remaining, or None if it can't be calculated yet.
+        """
+        rate = self.bytes_per_second
+        if not rate or not self.total_bytes or self.sizing:
+            return None
+        return max(0.0, (self.total_bytes - self.bytes_done) / rate)
+
+    def summary(self):
+        """ The totals and average throughput.
+
+        Returns:
+            dict: files, bytes, elapsed seconds, mb_per_s and files_per_s.
+        """
+        return {
+            'files': self.files_done,
+            'bytes': self.bytes_done,
+            'elapsed': self.elapsed,
+            'mb_per_s': self.bytes_per_second / 2**20,
+            'files_per_s': self.files_per_second,
+        }
+
+    def format(self, barLen=50):
+        """ Build a single line status report.
+
+        Args:
+            barLen (int, optional): How long the bar is drawn in character.
+
+        Returns:
+            str: The progress bar followed by MB/s, files/s and ETA.
+        """
+        eta = self.eta
+        if eta is None:
+            eta = '--:--:--'
+        else:
+            minutes, seconds = divmod(int(eta), 60)
+            hours, minutes = divmod(minutes, 60)
+            eta = '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+        return '{bar} {mbs:.1f} MB/s {fps:.1f} files/s ETA {eta}'.format(
+            bar=C4.format_progress_bar(self.percent, barLen),
+            mbs=self.bytes_per_second / 2**20,
+            fps=self.files_per_second,
+            eta=eta,
+        )
+
+    def start(self):
+        """ Start timing and, if callback is set, the reporting thread.
+        """
+        self._start_time = time.time()
+        self._stop_time = None
+        self._stop_event.clear()
+        if self.callback is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stop timing and the reporting thread, then report one last time.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._start_time is not None and self._stop_time is None:
+            self._stop_time = time.time()
+        if self.callback is not None:
+            self.callback(self)
+
+    def _run(self):
+        """ Method run by the reporting thread.
+        """
+        while not self._stop_event.wait(self.refresh_rate):
+            self.callback(self)
+
+class C4Queue(C4):
+    """ Preform C4 hashing operations using multiple threads.
+
+    Example:
         c4 = C4Queue()
         c4.files = files
         c4.start()
-        c4.join()
-        hashes = c4.hashes
+        c4.join()
+        hashes = c4.hashes
+
+    Args:
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        files (list): A list of all file paths to process.
+        hashes (dict): This dict will be updated to contain the file path
+            and C4id object generated for each file path.
+        queue (queue.Queue): The Queue object used to manage processing of
+            files by the child threads.
+        max_threads (int): Use this to limit the number of threads used to
+            process C4 hashes. This class will use a thread per file up to
+            this total. Defaults to 100.
+        worker_started_callback (callable or None): Called each time a c4id
+            starts processing. The callable will be passed the C4Queue
+            instance and the file path that will have a c4id generated.
+        worker_finished_callback (callable or None): Called each time a c4id
+            finishes processing. The callable will be passed the C4id object
+            that was just generated.
+        show_progress (bool): If using worker_finished_default, should a
+            progress bar be drawn? Defaults to False.
+        show_path (bool): If using worker_finished_default, this is passed to
+            c4id.format. Defaults to False.
+        show_metadata (bool): If using worker_finished_default, this is passed
+            to c4id.format. Defaults to False.
+        show_absolute (bool): If using worker_finished_default, this is passed
+            to c4id.format. Defaults to False.
+        show_formatting (bool): If using worker_finished_default, this is
+            passed to c4id.format. Defaults to False.
+        show_encoding (str): If using worker_finished_default, this is
+            passed to c4id.format. Defaults to "c4".
+        progress (C4Progress): Aggregates the bytes and files hashed by all
+            worker threads. Used to report progress, throughput and ETA.
+        profile (bool): Run each worker thread under cProfile. Use
+            profile_stats to get the combined results. Defaults to False.
+        destinations (dict): Files in this dict are copied to the list of
+            destination paths stored for them using C4Copy while their c4id
+            is generated.
+        verify (bool): Verify each copy made for destinations by reading it
+            back from disk, see C4Copy.verify. Defaults to False.
+        copy_mode (str): The C4Copy.mode used to copy destinations.
+            Defaults to "auto".
+        verify_errors (list): A C4VerifyError for each file with a copy that
+            didn't match.
+        manifest (C4ManifestWriter or None): If set, every c4id is written
+            to this manifest as soon as it is generated. Defaults to None.
+        journal (C4Journal or None): If set, every c4id generated is written
+            to this journal, and files it has already completed are reported
+            by start without hashing them again. Defaults to None.
+        errors (list): A (path, exception) tuple for each file that couldn't
+            be processed. Worker threads keep processing the other files.
+        error_callback (callable or None): Called from the worker thread with
+            the path and exception of each file added to errors.
+        retries (int): The number of times a file is retried after a
+            transient error, like EIO or ESTALE on network filesystems.
+            Defaults to 3.
+        retry_delay (float): Seconds before the first retry, doubled for each
+            attempt. Defaults to 0.5.
+    """
+
+    # This class property is used to ensure correct printing across threads.
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super(C4Queue, self).__init__(*args, **kwargs)
+        self.files = []
+        self.hashes = {}
+        self.queue = queue.Queue()
+        self.max_threads = 100
+        self.worker_started_callback = None
+        self.worker_finished_callback = None
+        self.show_progress = False
+        self.show_path = False
+        self.show_metadata = False
+        self.show_absolute = False
+        self.show_formatting = 'id'
+        self.show_encoding = 'c4'
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._progress_shown = False
+        self._progress_line = ''
+        self._progress_percent = None
+        self.progress = C4Progress()
+        self.profile = False
+        self.destinations = {}
+        self.verify = False
+        self.copy_mode = 'auto'
+        self.verify_errors = []
+        self.manifest = None
+        self.journal = None
+        self.errors = []
+        self.error_callback = None
+        self.retries = 3
+        self.retry_delay = 0.5
+        self._profiles = []
+
+    def join(self):
+        """ Blocks until all items in the queue have been processed.
+
+        If progress_callback is set, it will be called with the percent of
+        bytes hashed by all threads. It is called from a single reporting
+        thread every progress.refresh_rate seconds, only when the percent
+        changes.
+        """
+        try:
+            # using self.queue.join() will prevent detection of KeyboardInterrupt
+            self._join_threads()
+        except KeyboardInterrupt: # pragma: no cover "Not testable"
+            # The user canceled the operation, stop processing and exit
+            self.stop()
+            self._join_threads()
+        self.progress.stop()
+        if self.show_progress and self._progress_shown:
+            # Leave the final progress report on its own line.
+            with self.lock:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+                self._progress_shown = False
+
+    def _join_threads(self):
+        """ Wait for all worker threads to exit, without blocking signals.
+        """
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+    def start(self):
+        """ Create worker threads and add all files to the queue for processing
+        """
+        report = self.show_progress or self.progress_callback is not None
+        files = self.files
+        if self.journal is not None and self.journal.entries:
+            files = self._resume(files)
+        # Add all files we need to process to the queue before starting any
+        # threads so they don't exit early thinking there is nothing to do.
+        files = list(files)
+        for filename in files:
+            self.queue.put(filename)
+
+        if report:
+            # Progress is weighted by bytes, the files are sized in the
+            # background so hashing starts right away.
+            self.progress.add_files(files)
+            self.progress.callback = self._progress_report
+        self.progress.start()
+
+        # If less than max_threads, use a thread per file to hash.
+        for i in range(min(self.queue.qsize(), self.max_threads)):
+            t = threading.Thread(target=self._worker)
+            t.start()
+            self._threads.append(t)
+
+    def _resume(self, files):
+        """ Report the files the journal already completed.
+
+        They are counted in progress as if they were hashed.
+
+        Returns:
+            list: The files that still need to be hashed.
+        """
+        remaining = []
+        counter = self.progress.counter()
+        for filename in files:
+            c4id = self.journal.completed(filename)
+            if c4id is None:
+                remaining.append(filename)
+                continue
+            counter.files += 1
+            counter.bytes += c4id.bytes or 0
+            self.progress.total_files += 1
+            self.progress.total_bytes += c4id.bytes or 0
+            self._result(filename, c4id)
+            if self.worker_finished_callback is not None:
+                self.worker_finished_callback(c4id)
+        return remaining
+
+    def stop(self):
+        """ Stop processing and close all threads before the queue is empty.
+
+        See: https://stackoverflow.com/a/325528
+        """
+        self._stop_event.set() # pragma: no cover "Not testable"
+
+    def __stopped__(self):
+        return self._stop_event.is_set()
+
+    def profile_stats(self, stats=None):
+        """ Combine the cProfile results of all worker threads.
+
+        Args:
+            stats (pstats.Stats or None, optional): If provided, the worker
+                results are added to these stats.
+
+        Returns:
+            pstats.Stats or None: The combined stats, None if profile was not
+                enabled when the threads ran.
+        """
+        for profiler in self._profiles:
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        return stats
+
+    def _worker(self):
+        """ Method run by worker threads, profiling them if requested.
+        """
+        if not self.profile:
+            return self._work()
+        # cProfile only profiles the thread that enabled it, so each worker
+        # needs its own profiler.
+        profiler = cProfile.Profile()
+        with self.lock:
+            self._profiles.append(profiler)
+        profiler.runcall(self._work)
+
+    def _work(self):
+        """ Process items in the queue until it is empty.
+        """
+        # Create a new C4 object to hash per thread without progress_report
+        c4 = C4(self.block_size)
+        c4.progress_bar_length = self.progress_bar_length
+        counter = self.progress.counter()
+        c4.progress_counter = counter
+        c4.metrics = self.metrics
+        c4.tracer = self.tracer
+        c4.digests = self.digests
+        c4.drop_cache = self.drop_cache
+        c4.server = self.server
+        recorder = c4._recorder()
+        copier = None
+        if self.destinations:
+            copier = C4Copy()
+            copier.progress_counter = counter
+            copier.metrics = self.metrics
+            copier.tracer = self.tracer
+            copier.verify = self.verify
+            copier.mode = self.copy_mode
+            copier.digests = self.digests
+
+        # process any remaining items in the queue
+        while not self.__stopped__():
+            if recorder is not None:
+                start = _timer()
+            try:
+                filename = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                # Nothing to do, the queue is empty
+                if self._wait_for_work():
+                    continue
+                break
+            if recorder is not None:
+                recorder.add('queue_get', start, _timer())
+            # Every item is marked done, whatever happens to it, so
+            # queue.join() never waits on a file that failed.
+            try:
+                try:
+                    # if requested, report that a c4id is starting processing.
+                    if self.worker_started_callback is not None:
+                        self.worker_started_callback(self, filename)
+                    c4id = self._process(c4, copier, filename)
+                except HashIncomplete: # pragma: no cover "Not testable"
+                    break
+                except C4VerifyError as error:
+                    self.verify_errors.append(error)
+                    continue
+                except Exception as error:
+                    self._error(filename, error)
+                    continue
+                self._result(filename, c4id)
+                if self.journal is not None:
+                    self.journal.write(c4id)
+                counter.files += 1
+                # If requested, report that c4id finished processing.
+                if self.worker_finished_callback is not None:
+                    try:
+                        if recorder is None:
+                            self.worker_finished_callback(c4id)
+                        else:
+                            start = _timer()
+                            self.worker_finished_callback(c4id)
+                            recorder.add('callback', start, _timer())
+                    except Exception as error:
+                        self._error(filename, error)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, c4, copier, filename):
+        """ Hash or copy filename, retrying transient errors.
+
+        Args:
+            c4 (C4): The worker thread's C4 object.
+            copier (C4Copy or None): The worker thread's C4Copy object, used
+                if filename has destinations.
+            filename (str): The file to process.
+
+        Returns:
+            C4id: The c4id of filename.
+
+        Raises:
+            Exception: The error raised by the last attempt.
+        """
+        destinations = self.destinations.get(filename)
+        attempt = 0
+        while True:
+            try:
+                if destinations is None:
+                    return c4.from_file(filename)
+                return copier.copy_file(filename, destinations)
+            except (IOError, OSError) as error:
+                if (attempt >= self.retries or self.__stopped__() or
+                        getattr(error, 'errno', None) not in _TRANSIENT_ERRORS):
+                    raise
+            time.sleep(self.retry_delay * 2**attempt)
+            attempt += 1
+
+    def _error(self, filename, error):
+        """ Record a file that couldn't be processed, called by worker threads.
+        """
+        self.errors.append((filename, error))
+        if self.error_callback is not None:
+            self.error_callback(filename, error)
+
+    def _result(self, filename, c4id):
+        """ Store the c4id generated for filename, called by worker threads.
+        """
+        self.hashes[filename] = c4id
+        if self.manifest is not None:
+            self.manifest.write(c4id)
+
+    def _wait_for_work(self):
+        """ Should workers wait for more files once the queue is empty?
+        """
+        return False
+
+    def worker_finished_default(self, c4id):
+        """ Default progress reporting.
+
+        Prints each c4id info as soon as it finishes processing.
+
+        Args:
+            c4id (C4id): The c4id that was just generated.
+        """
+        output = c4id.format(
+            show_metadata=self.show_metadata,
+            show_path=self.show_path,
+            absolute=self.show_absolute,
+            fmt=self.show_formatting,
+            encoding=self.show_encoding,
+        )
+
+        recorder = self._recorder()
+        if recorder is not None:
+            start = _timer()
+        # prevent any other threads from printing while we update the console
+        with self.lock:
+            if recorder is not None:
+                recorder.add('lock_wait', start, _timer())
+            if self.show_progress and self._progress_shown:
+                # Clear the progress bar we printed to the console only if it
+                # was already shown.
+                sys.stdout.write("\r" + " " * len(self._progress_line) + "\r")
+            # Show the result of the current hash output.
+            print(output)
+            if self.show_progress and self._progress_shown:
+                # Redraw the last progress report, it is only recalculated by
+                # the progress reporting thread.
+                sys.stdout.write(self._progress_line)
+                sys.stdout.flush()
+
+    def _progress_report(self, progress):
+        """ Called by the progress reporting thread every refresh_rate seconds.
+
+        Args:
+            progress (C4Progress): The aggregated progress of all workers.
+        """
+        percent = progress.percent
+        if self.progress_callback is not None and percent != self._progress_percent:
+            # Only emit the callback if the percent changes
+            self._progress_percent = percent
+            self.progress_callback(percent)
+        if self.show_progress:
+            line = progress.format(self.progress_bar_length)
+            with self.lock:
+                # Pad the line so a shorter report hides the previous one.
+                padding = " " * max(0, len(self._progress_line) - len(line))
+                sys.stdout.write("\r" + line + padding)
+                sys.stdout.flush()
+                self._progress_line = line
+                self._progress_shown = True
+
+# A file that doesn't match its manifest entry. See C4Verify.
+C4Mismatch = namedtuple('C4Mismatch', 'reason path expected actual')
+
+class C4Verify(C4Queue):
+    """ Verify files still match the c4 ids stored in a manifest.
+
+    Every file is checked with os.stat before any data is read, so missing
+    and truncated files are found immediately. The rest are hashed by the
+    C4Queue worker threads, largest first, so a large file doesn't start
+    last and leave a single thread running at the end.
+
+    Example:
+        c4 = C4Verify()
+        c4.load('archive.c4m.gz')
+        c4.start()
+        c4.join()
+        c4.write_report('mismatches.tsv')
+
+    Args:
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        entries (dict): The C4ManifestEntry to verify for each path.
+        root (str or None): If set, manifest paths are relative to this
+            folder. Defaults to None.
+        fail_fast (bool): Stop verifying at the first mismatch. Defaults to
+            False.
+        mismatches (list): A C4Mismatch for each file that didn't match.
+            The reason is "missing" if the file couldn't be found, "size" if
+            its size changed, in which case it isn't read, "error" if it
+            couldn't be read, or "c4id".
+        verified (int): The number of files that matched.
+    """
+    def __init__(self, *args, **kwargs):
+        super(C4Verify, self).__init__(*args, **kwargs)
+        # A server answers from its cache, files have to be read to verify them.
+        self.server = None
+        self.entries = {}
+        self.root = None
+        self.fail_fast = False
+        self.mismatches = []
+        self.verified = 0
+
+    def load(self, manifest):
+        """ Add the entries of a manifest to verify.
+
+        Args:
+            manifest (str, file or iterable): A manifest path or binary file
+                object, or C4ManifestEntry objects.
+        """
+        reader = None
+        if isinstance(manifest, str) or hasattr(manifest, 'read'):
+            reader = manifest = C4ManifestReader(manifest)
+        try:
+            for entry in manifest:
+                path = entry.path
+                if self.root is not None:
+                    path = os.path.join(self.root, path)
+                self.entries[path] = entry
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def start(self):
+        """ Check the size of every file, then hash the rest largest first.
+        """
+        sizes = []
+        for path, entry in self.entries.items():
+            if self.__stopped__():
+                break
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                self._mismatch(C4Mismatch('missing', path, entry.c4id, None))
+                continue
+            if entry.bytes is not None and size != entry.bytes:
+                self._mismatch(C4Mismatch('size', path, entry.bytes, size))
+                continue
+            sizes.append((size, path))
+        sizes.sort(reverse=True)
+        self.files = [] if self.__stopped__() else [path for size, path in sizes]
+        super(C4Verify, self).start()
+
+    def _result(self, filename, c4id):
+        super(C4Verify, self)._result(filename, c4id)
+        expected = self.entries[filename].c4id
+        if str(c4id) == expected:
+            with self.lock:
+                self.verified += 1
+        else:
+            self._mismatch(C4Mismatch('c4id', filename, expected, str(c4id)))
+
+    def _error(self, filename, error):
+        super(C4Verify, self)._error(filename, error)
+        self._mismatch(C4Mismatch('error', filename,
+            self.entries[filename].c4id, str(error)))
+
+    def _mismatch(self, mismatch):
+        self.mismatches.append(mismatch)
+        if self.fail_fast:
+            self.stop()
+
+    def write_report(self, output):
+        """ Write the mismatches as tab separated reason, path, expected and
+        actual values, with a header line.
+
+        Args:
+            output (str or file): The path of the report, or a text file
+                object to write it to.
+        """
+        if not hasattr(output, 'write'):
+            with open(output, 'w') as f:
+                return self.write_report(f)
+        output.write('reason\tpath\texpected\tactual\n')
+        for mismatch in self.mismatches:
+            output.write('{}\t{}\t{}\t{}\n'.format(mismatch.reason,
+                _manifest_escape(mismatch.path),
+                '-' if mismatch.expected is None else mismatch.expected,
+                '-' if mismatch.actual is None else mismatch.actual))
+
+# A set of files with the same content. See C4Dedup.
+C4Duplicates = namedtuple('C4Duplicates', 'c4id bytes copies paths')
+
+class C4Dedup(C4):
+    """ Find duplicate files, reading as little of them as possible.
+
+    Files are compared in tiers, each one only looking at the files that
+    still collide:
+
+    1. The size of every file, from os.stat without reading any data. Hard
+       links to the same file are counted once.
+    2. A sha512 of the first and last edge_size bytes of each file.
+    3. The c4 id of each file, generated by a C4Queue.
+
+    Example:
+        c4 = C4Dedup()
+        for duplicates in c4.find(paths):
+            print(duplicates.c4id, duplicates.paths)
+        print(c4.reclaimable, c4.bytes_read, c4.bytes_total)
+
+    Args:
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        max_threads (int): The number of threads reading files. Defaults to
+            16.
+        edge_size (int): The number of bytes hashed from the start and end
+            of files in tier 2. Files up to twice this size skip straight to
+            tier 3. Defaults to 4MB.
+        min_size (int): Smaller files are ignored. Defaults to 1, empty files
+            are never worth reclaiming.
+        duplicates (list): A C4Duplicates for each set of files with the
+            same content found by find, most reclaimable bytes first. copies
+            is the number of distinct files, paths that are hard links to
+            the same file are all listed in paths.
+        bytes_total (int): The size of every file given to find.
+        bytes_read (int): The number of bytes read to find the duplicates.
+        errors (dict): The exception raised for each file that couldn't be
+            compared by find.
+    """
+    def __init__(self, *args, **kwargs):
+        super(C4Dedup, self).__init__(*args, **kwargs)
+        self.max_threads = 16
+        self.edge_size = 4 * (2**20)
+        self.min_size = 1
+        self.duplicates = []
+        self.bytes_total = 0
+        self.bytes_read = 0
+        self.errors = {}
+
+    @property
+    def reclaimable(self):
+        """ The bytes saved by keeping a single copy of each set of duplicates.
+        """
+        return sum(duplicates.bytes * (duplicates.copies - 1)
+            for duplicates in self.duplicates)
+
+    def find(self, paths):
+        """ Find the files in paths with the same content.
+
+        Files that can't be read are left out and recorded in errors.
+
+        Args:
+            paths (iterable): The file paths to compare.
+
+        Returns:
+            list: The duplicates attribute.
+        """
+        self.duplicates = []
+        self.bytes_total = 0
+        self.bytes_read = 0
+        self.errors = {}
+
+        # Tier 1, group by size. Each group maps inodes to their paths.
+        sizes = {}
+        for path in paths:
+            try:
+                statinfo = os.stat(path)
+            except OSError as error:
+                self.errors[path] = error
+                continue
+            self.bytes_total += statinfo.st_size
+            if statinfo.st_size < self.min_size:
+                continue
+            inodes = sizes.setdefault(statinfo.st_size, {})
+            inodes.setdefault((statinfo.st_dev, statinfo.st_ino), []).append(path)
+        groups = [(size, list(inodes.values()))
+            for size, inodes in sizes.items() if len(inodes) > 1]
+
+        # Tier 2, group large files by the hash of their first and last bytes.
+        edges = [paths[0] for size, files in groups
+            if size > 2 * self.edge_size for paths in files]
+        edge_hashes, errors = _thread_map(self._edge_hash, edges, self.max_threads)
+        self.errors.update(errors)
+        self.bytes_read += 2 * self.edge_size * len(edges)
+        candidates = []
+        for size, files in groups:
+            if size <= 2 * self.edge_size:
+                candidates.append((size, files))
+                continue
+            collisions = {}
+            for paths in files:
+                digest = edge_hashes.get(paths[0])
+                if digest is not None:
+                    collisions.setdefault(digest, []).append(paths)
+            candidates.extend((size, files) for files in collisions.values()
+                if len(files) > 1)
+
+        # Tier 3, group by c4 id.
+        c4 = C4Queue(self.block_size)
+        c4.max_threads = self.max_threads
+        c4.metrics = self.metrics
+        c4.tracer = self.tracer
+        c4.server = self.server
+        c4.files = [paths[0] for size, files in candidates for paths in files]
+        c4.start()
+        c4.join()
+        self.errors.update(c4.errors)
+        for size, files in candidates:
+            ids = {}
+            for paths in files:
+                c4id = c4.hashes.get(paths[0])
+                if c4id is not None:
+                    self.bytes_read += c4id.bytes
+                    ids.setdefault(c4id.c4id, []).append(paths)
+            self.duplicates.extend(C4Duplicates(key, size, len(same),
+                [path for paths in same for path in paths])
+                for key, same in ids.items() if len(same) > 1)
+        self.duplicates.sort(key=lambda duplicates:
+            -duplicates.bytes * (duplicates.copies - 1))
+        return self.duplicates
+
+    def _edge_hash(self, path):
+        """ The sha512 digest of the first and last edge_size bytes of path.
+        """
+        hash = hashlib.sha512()
+        with open(path, 'rb') as f:
+            hash.update(f.read(self.edge_size))
+            f.seek(-self.edge_size, os.SEEK_END)
+            hash.update(f.read(self.edge_size))
+        return hash.digest()
+
+# inotify event masks, see inotify(7).
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_inotify_event = struct.Struct('iIII')
+
+def _inotify():
+    """ libc if it supports inotify, otherwise None.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError): # pragma: no cover "Not linux"
+        return None
+    return libc
+
+class C4Watch(C4Queue):
+    """ Generate the c4 id of files as they are written to folders.
+
+    On Linux the folders are watched with inotify, a file is hashed once it
+    is closed after writing or moved into a watched folder. Elsewhere, or if
+    use_inotify is False, the folders are scanned every poll_interval
+    seconds and a file is hashed once its size and modification time stop
+    changing. Either way a file is only hashed after debounce seconds
+    without any changes. Files are hashed by the C4Queue worker threads and
+    reported with worker_finished_callback and manifest, like C4Queue.
+
+    Example:
+        c4 = C4Watch()
+        c4.paths = ['renders']
+        c4.worker_finished_callback = lambda c4id: print(c4id.path, c4id)
+        c4.start()
+        c4.join() # until c4.stop() is called
+
+    Args:
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        max_threads (int): The number of worker threads, they keep running
+            until stop is called. Defaults to 8.
+        paths (list): The folders to watch, including their sub folders.
+        debounce (float): Seconds without changes before a file is hashed.
+            Defaults to 0.2.
+        poll_interval (float): Seconds between scans when not using inotify.
+            Defaults to 1.0.
+        use_inotify (bool): Use inotify if it is available. Defaults to True.
+        existing (bool): Also hash the files in paths when started.
+            Defaults to False.
+    """
+    def __init__(self, *args, **kwargs):
+        super(C4Watch, self).__init__(*args, **kwargs)
+        self.max_threads = 8
+        self.paths = []
+        self.debounce = 0.2
+        self.poll_interval = 1.0
+        self.use_inotify = True
+        self.existing = False
+        self._pending = {}
+        self._seen = {}
+        self._watches = {}
+        self._watched = set()
+        self._fd = None
+
+    def start(self):
+        """ Start the worker threads and watching paths.
+        """
+        libc = _inotify() if self.use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+                self._libc = libc
+        for path in self.paths:
+            self._add(path, self.existing)
+        for i in range(self.max_threads):
+            t = threading.Thread(target=self._worker)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._watch)
+        t.start()
+        self._threads.append(t)
+
+    def _wait_for_work(self):
+        # Keep the workers running until stop is called.
+        return True
+
+    @staticmethod
+    def _signature(statinfo):
+        return statinfo.st_size, mtime_ns(statinfo)
+
+    def _add(self, folder, pending):
+        """ Watch folder and its sub folders, and scan their files.
+
+        Args:
+            folder (str): The folder to add.
+            pending (bool): Hash the files found, otherwise they are only
+                hashed once they change.
+        """
+        for dirpath, dirs, files in os.walk(folder):
+            if self._fd is not None and dirpath not in self._watched:
+                wd = self._libc.inotify_add_watch(self._fd,
+                    dirpath.encode('utf-8', 'surrogateescape'),
+                    _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE)
+                if wd >= 0:
+                    self._watches[wd] = dirpath
+                    self._watched.add(dirpath)
+            for f in files:
+                self._scanned(os.path.join(dirpath, f), pending)
+
+    def _scanned(self, path, pending):
+        """ Record the signature of a file found by a scan.
+        """
+        try:
+            signature = self._signature(os.stat(path))
+        except OSError:
+            return
+        if self._seen.get(path) == signature:
+            return
+        if not pending:
+            self._seen[path] = signature
+            return
+        last = self._pending.get(path)
+        if last is None or last[1] != signature:
+            self._pending[path] = (_timer(), signature)
+
+    def _watch(self):
+        """ Run by the watching thread until stop is called.
+        """
+        last_scan = _timer()
+        while not self.__stopped__():
+            if self._fd is None:
+                time.sleep(min(self.debounce, self.poll_interval) / 2)
+                if _timer() - last_scan >= self.poll_interval:
+                    last_scan = _timer()
+                    for path in self.paths:
+                        self._add(path, True)
+            else:
+                self._read_events()
+            self._flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_events(self):
+        """ Wait for inotify events and add the files they name to _pending.
+        """
+        readable = select.select([self._fd], [], [], min(self.debounce / 2, 0.1))[0]
+        if not readable:
+            return
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as error: # pragma: no cover "Not testable"
+            if error.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        now = _timer()
+        while offset < len(data):
+            wd, mask, cookie, size = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + size].rstrip(b'\0').decode(
+                'utf-8', 'surrogateescape')
+            offset += size
+            if mask & _IN_Q_OVERFLOW: # pragma: no cover "Not testable"
+                # Events were lost, find changed files by scanning.
+                for path in self.paths:
+                    self._add(path, True)
+                continue
+            if mask & _IN_IGNORED:
+                # The folder was removed, watch it again if it is recreated.
+                folder = self._watches.pop(wd, None)
+                if folder is not None:
+                    self._watched.discard(folder)
+                continue
+            folder = self._watches.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & _IN_ISDIR:
+                # Watch new folders, their files may be written already.
+                self._add(path, True)
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                self._pending[path] = (now, None)
+
+    def _flush(self):
+        """ Queue the pending files that haven't changed for debounce seconds.
+        """
+        now = _timer()
+        for path, (changed, signature) in list(self._pending.items()):
+            if now - changed < self.debounce:
+                continue
+            del self._pending[path]
+            try:
+                current = self._signature(os.stat(path))
+            except OSError:
+                # Temporary files may be renamed or removed before hashing.
+                continue
+            if signature is not None and current != signature:
+                # Still being written, wait for it to stop changing.
+                self._pending[path] = (now, current)
+                continue
+            if self._seen.get(path) == current:
+                continue
+            self._seen[path] = current
+            self.queue.put(path)
+
+class C4Copy(C4):
+    """ Copy files to several destinations while generating their C4 id.
+
+    Each source file is read once. Every block read is handed to a hashing
+    thread and a writing thread per destination through bounded queues, so
+    reading, hashing and writing overlap and the copy runs at the speed of the
+    slowest destination instead of reading the source once per destination.
+
+    Destinations are written to a temporary file next to the destination and
+    renamed into place once the copy succeeds.
+
+    Example:
+        c4 = C4Copy(targets=['/mnt/nas_a/shots', '/mnt/nas_b/shots'])
+        c4id = c4.copy_file('plates/plate.0001.exr')
+
+    Args:
+        targets (list, optional): Directories that copy_file copies files
+            into when destinations are not given.
+        block_size (int, optional): Read, hash and write each file in byte
+            chunks of this size. Defaults to 8MB chunks.
+        queue_depth (int, optional): The number of blocks each hashing and
+            writing thread may fall behind the reader. Defaults to 4.
+
+    Attributes:
+        targets (list): Directories that copy_file copies files into.
+        queue_depth (int): The number of blocks each thread may buffer.
+        copy_stat (bool): Copy the permission bits and modification times
+            to each destination. Defaults to True.
+        sync (bool): Flush each destination to disk before it is renamed into
+            place. Defaults to False.
+        verify (bool): Flush each destination to disk, drop it from the page
+            cache and hash it again before it is renamed into place. Raises
+            C4VerifyError if any copy doesn't match. Defaults to False.
+        mode (str): How destinations on the same filesystem as the source
+            are copied. "auto" tries a reflink (FICLONE), then
+            os.copy_file_range, and falls back to "buffered". "reflink" and
+            "copy_file_range" only try that method before falling back to
+            "buffered". "buffered" always copies through python. Defaults to
+            "auto".
+        copy_modes (dict): The mode used to copy each destination by the
+            most recent call to copy_and_hash.
+    """
+    modes = ('auto', 'reflink', 'copy_file_range', 'buffered')
+
+    def __init__(self, targets=None, block_size=8 * (2**20), queue_depth=4):
+        super(C4Copy, self).__init__(block_size)
+        self.targets = list(targets or [])
+        self.queue_depth = queue_depth
+        self.copy_stat = True
+        self.sync = False
+        self.verify = False
+        self.mode = 'auto'
+        self.copy_modes = {}
+
+    def destinations(self, path, root=None):
+        """ The destination path of path in each target.
+
+        Args:
+            path (str): The source file path.
+            root (str or None, optional): Keep the path of path relative to
+                root in each target. By default only the filename is kept.
+
+        Returns:
+            list: A destination file path for each target.
+        """
+        if root is None:
+            relative = os.path.basename(path)
+        else:
+            relative = os.path.relpath(path, root)
+        return [os.path.join(target, relative) for target in self.targets]
+
+    @staticmethod
+    def _temp_path(path):
+        """ Create a unique temporary file to write before renaming it to path.
+
+        Several threads may copy to the same destination at once, so the name
+        can't only depend on path and the process.
+        """
+        dirname, basename = os.path.split(path)
+        fd, temp = tempfile.mkstemp(dir=dirname or os.curdir,
+            prefix='.{}.'.format(basename), suffix='.c4copy')
+        os.close(fd)
+        # mkstemp creates the file readable only by its owner.
+        os.chmod(temp, 0o666 & ~_UMASK)
+        return temp
+
+    def copy_file(self, path, destinations=None, c4id=None):
+        """ Copy path to each destination and calculate its C4id.
+
+        Args:
+            path (str): The file to copy.
+            destinations (list or None, optional): The file paths to copy to.
+                Defaults to self.destinations(path).
+            c4id (C4id, str or None, optional): The known c4 id of path, for
+                example from a manifest validated against the file's stat
+                info. If every destination is copied by the kernel the source
+                is not read at all.
+
+        Returns:
+            C4id: The C4id object for the source path.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True. No destination
+                is left behind.
+            C4VerifyError: If verify is True and a copy doesn't match. No
+                destination is left behind.
+        """
+        if destinations is None:
+            destinations = self.destinations(path)
+        recorder = self._recorder()
+        start = None if recorder is None else _timer()
+        for destination in destinations:
+            dirname = os.path.dirname(destination)
+            if dirname and not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Another thread may have created it at the same time.
+                    if not os.path.isdir(dirname):
+                        raise
+        temps = []
+        digests = {}
+        try:
+            for destination in destinations:
+                temps.append(self._temp_path(destination))
+            # The source has to be read to calculate any other digests.
+            digest, bytes = self.copy_and_hash(path, temps,
+                read=c4id is None or bool(self.digests), digests=digests)
+            if digest is None:
+                source = C4id(str(c4id), path=path, bytes=bytes)
+            else:
+                source = self._encode(digest, path, bytes, recorder, start)
+                source.digests.update(digests)
+            if self.verify:
+                mismatches = self.verify_copies(source, temps)
+                if mismatches:
+                    # Report the destination paths, not the temporary files.
+                    names = dict(zip(temps, destinations))
+                    raise C4VerifyError(source, [(names[temp], result)
+                        for temp, result in mismatches])
+            for temp, destination in zip(temps, destinations):
+                if self.copy_stat:
+                    shutil.copystat(path, temp)
+                _replace(temp, destination)
+        except BaseException:
+            for temp in temps:
+                if os.path.isfile(temp):
+                    os.remove(temp)
+            raise
+        return source
+
+    def verify_copies(self, c4id, paths):
+        """ Check that each path has the same c4 id as c4id.
+
+        Each file is flushed and dropped from the page cache before it is
+        read, so the data is read back from disk. Files on different devices
+        are hashed in parallel, files on the same device one at a time.
+
+        Args:
+            c4id (C4id or str): The expected c4 id.
+            paths (list): The files to check.
+
+        Returns:
+            list: A (path, C4id or Exception) tuple for each path that didn't
+                match, or couldn't be read. Empty if all paths match.
+        """
+        devices = {}
+        for path in paths:
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                device = None
+            devices.setdefault(device, []).append(path)
+
+        mismatches = []
+        def check(paths):
+            c4 = C4(self.block_size)
+            c4.drop_cache = True
+            c4.server = None
+            c4.metrics = self.metrics
+            c4.tracer = self.tracer
+            for path in paths:
+                try:
+                    result = c4.from_file(path)
+                except EnvironmentError as error:
+                    mismatches.append((path, error))
+                    continue
+                if str(result) != str(c4id):
+                    mismatches.append((path, result))
+
+        threads = [threading.Thread(target=check, args=(group,))
+            for group in devices.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Report in the order the paths were given.
+        order = {path: i for i, path in enumerate(paths)}
+        return sorted(mismatches, key=lambda item: order[item[0]])
+
+    def copy_and_hash(self, path, destinations, read=True, digests=None):
+        """ Copy path to each destination and calculate its SHA512 digest.
+
+        Destinations on the same filesystem as path are copied by the kernel
+        if mode allows it, the rest are written from the blocks read to
+        calculate the digest.
+
+        Args:
+            path (str): The file to copy.
+            destinations (list): The file paths to write.
+            read (bool, optional): If False and every destination was copied
+                by the kernel, path is not read and None is returned as the
+                digest. Defaults to True.
+            digests (dict or None, optional): If provided, the digest of each
+                algorithm in self.digests is added to it when path is read.
+
+        Returns:
+            digest (str or None): The sha512 digest for path.
+            bytes (int): The total size of the file in bytes.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True.
+        """
+        if self.mode not in self.modes:
+            raise ValueError('Unknown copy mode "{}", use one of: {}'.format(
+                self.mode, ', '.join(self.modes)))
+        self.copy_modes = {}
+        threads = []
+        errors = []
+        with open(path, 'rb') as f:
+            statinfo = os.fstat(f.fileno())
+            bytes = statinfo.st_size
+            buffered = []
+            try:
+                for destination in destinations:
+                    mode = self._kernel_copy(f, statinfo, destination, threads, errors)
+                    if mode is None:
+                        mode = 'buffered'
+                        buffered.append(destination)
+                    self.copy_modes[destination] = mode
+                if not (read or buffered):
+                    if self.progress_counter is not None:
+                        self.progress_counter.bytes += bytes
+                    return None, bytes
+                hashes = [hashlib.new(name) for name in ('sha512',) + tuple(self.digests)]
+                if bytes < self.block_size:
+                    # Not worth starting threads for a single block.
+                    bytes = self._copy_block(f, hashes, buffered)
+                else:
+                    bytes = self._copy_pipelined(f, bytes, hashes, buffered)
+                if digests is not None:
+                    digests.update((name, h.digest()) for name, h
+                        in zip(self.digests, hashes[1:]))
+                return hashes[0].digest(), bytes
+            finally:
+                for thread in threads:
+                    thread.join()
+                if errors:
+                    raise errors[0]
+
+    def _kernel_copy(self, f, statinfo, destination, threads, errors):
+        """ Try to copy f to destination without reading it into python.
+
+        A reflink is made immediately. copy_file_range copies the first block
+        to make sure it is supported, then copies the rest in a new thread
+        that is added to threads. Errors from that thread are added to errors.
+
+        Returns:
+            str or None: The mode used, None if destination must be buffered.
+        """
+        if self.mode == 'buffered':
+            return None
+        dirname = os.path.dirname(os.path.abspath(destination))
+        if os.stat(dirname).st_dev != statinfo.st_dev:
+            return None
+        out = open(destination, 'wb')
+        try:
+            if self.mode in ('auto', 'reflink') and fcntl is not None \
+                    and sys.platform.startswith('linux'):
+                try:
+                    fcntl.ioctl(out.fileno(), _FICLONE, f.fileno())
+                except EnvironmentError as error:
+                    if error.errno not in _KERNEL_COPY_UNSUPPORTED:
+                        raise
+                else:
+                    self._sync(out)
+                    out.close()
+                    return 'reflink'
+            copy_file_range = getattr(os, 'copy_file_range', None)
+            if self.mode in ('auto', 'copy_file_range') and copy_file_range is not None:
+                try:
+                    offset = self._copy_range(f, out, 0, min(statinfo.st_size, self.block_size))
+                except EnvironmentError as error:
+                    if error.errno not in _KERNEL_COPY_UNSUPPORTED:
+                        raise
+                else:
+                    def copy_rest():
+                        try:
+                            with out:
+                                self._copy_range(f, out, offset, statinfo.st_size)
+                                self._sync(out)
+                        except Exception as error:
+                            errors.append(error)
+                    thread = threading.Thread(target=copy_rest)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                    return 'copy_file_range'
+        except BaseException:
+            out.close()
+            raise
+        out.close()
+        return None
+
+    def _copy_range(self, f, out, offset, end):
+        """ Copy f to out from offset to end using os.copy_file_range.
+
+        Returns:
+            int: The offset copying stopped at.
+        """
+        recorder = self._recorder()
+        while offset < end:
+            if self.__stopped__():
+                raise HashIncomplete('__stopped__ returned True')
+            start = None if recorder is None else _timer()
+            count = min(self.block_size, end - offset)
+            copied = os.copy_file_range(f.fileno(), out.fileno(), count,
+                offset, offset)
+            if recorder is not None:
+                recorder.add('copy_file_range', start, _timer())
+            if not copied:
+                break
+            offset += copied
+        return offset
+
+    def _sync(self, f):
+        """ Flush f to disk if sync or verify are enabled.
+        """
+        if self.sync or self.verify:
+            f.flush()
+            drop_cache(f.fileno())
+
+    def _copy_block(self, f, hashes, destinations):
+        """ Copy a file that fits in a single block without extra threads.
+
+        Returns:
+            int: The number of bytes copied.
+        """
+        recorder = self._recorder()
+        if self.__stopped__():
+            raise HashIncomplete('__stopped__ returned True')
+        start = None if recorder is None else _timer()
+        block = f.read()
+        read = None if recorder is None else _timer()
+        for h in hashes:
+            h.update(block)
+        if recorder is not None:
+            recorder.add('read', start, read)
+            recorder.add('hash', read, _timer())
+        if self.progress_counter is not None:
+            self.progress_counter.bytes += len(block)
+        for destination in destinations:
+            start = None if recorder is None else _timer()
+            with open(destination, 'wb') as out:
+                out.write(block)
+                self._sync(out)
+            if recorder is not None:
+                recorder.add('write', start, _timer(), {'path': destination})
+        if self.progress_callback is not None:
+            self.progress_callback(100)
+        return len(block)
+
+    def _copy_pipelined(self, f, bytes, hashes, destinations):
+        """ Read f once, hashing and writing each block in their own threads.
+
+        Returns:
+            int: The number of bytes copied.
+        """
+        errors = []
+        stages = []
+
+        def hasher(blocks):
+            # hashlib releases the GIL while hashing large blocks, so this
+            # runs in parallel with the reader and writers.
+            counter = self.progress_counter
+            recorder = self._recorder()
+            while True:
+                block = blocks.get()
+                if block is None:
+                    break
+                start = None if recorder is None else _timer()
+                for h in hashes:
+                    h.update(block)
+                if recorder is not None:
+                    recorder.add('hash', start, _timer())
+                if counter is not None:
+                    counter.bytes += len(block)
+
+        def writer(blocks, destination):
+            recorder = self._recorder()
+            try:
+                with open(destination, 'wb') as out:
+                    while True:
+                        block = blocks.get()
+                        if block is None:
+                            self._sync(out)
+                            return
+                        start = None if recorder is None else _timer()
+                        out.write(block)
+                        if recorder is not None:
+                            recorder.add('write', start, _timer(), {'path': destination})
+            except Exception as error:
+                errors.append(error)
+                # Keep consuming so the reader never blocks on this queue.
+                while blocks.get() is not None:
+                    pass
+
+        stages.append((queue.Queue(self.queue_depth), hasher, ()))
+        for destination in destinations:
+            stages.append((queue.Queue(self.queue_depth), writer, (destination,)))
+        threads = []
+        for blocks, target, args in stages:
+            thread = threading.Thread(target=target, args=(blocks,) + args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        recorder = self._recorder()
+        nb_blocks = (bytes // self.block_size) + 1
+        cnt_blocks = 0
+        total = 0
+        try:
+            while not errors:
+                if self.__stopped__():
+                    raise HashIncomplete('__stopped__ returned True')
+                start = None if recorder is None else _timer()
+                block = f.read(self.block_size)
+                if recorder is not None:
+                    recorder.add('read', start, _timer())
+                if not block:
+                    break
+                total += len(block)
+                # Every stage shares the same immutable block, nothing is copied.
+                for blocks, target, args in stages:
+                    blocks.put(block)
+                if self.progress_callback is not None:
+                    cnt_blocks = cnt_blocks + 1
+                    self.progress_callback(100 * cnt_blocks // nb_blocks)
+        finally:
+            for blocks, target, args in stages:
+                blocks.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return total
+
+class C4Store(C4Copy):
+    """ A content addressable store of files named by their c4 id.
+
+    Each file is stored as root/c4/xx/yy/<c4 id>, where xx and yy are the
+    4th to 7th characters of its c4 id. The 3rd character is skipped as it
+    only has a few possible values. Files are written to root/tmp and
+    renamed into place, so the store never contains partial files. Content
+    already in the store is not stored again.
+
+    Files are copied with C4Copy while they are hashed, using a reflink or
+    copy_file_range when the store is on the same filesystem. ingest_all
+    ingests in parallel, threads only wait for each other when storing into
+    the same shard.
+
+    Example:
+        store = C4Store('/mnt/store')
+        c4id = store.ingest('delivery/plate.0001.exr')
+        print(store.path(c4id))
+
+    Args:
+        root (str): The folder of the store, created if needed.
+        block_size (int, optional): Copy and hash each file in byte chunks
+            of this size. Defaults to 8MB chunks.
+
+    Attributes:
+        root (str): The folder of the store.
+        link (bool): Hard link files into the store instead of copying them,
+            if they are on the same filesystem. Defaults to False.
+        hash_first (bool): Hash files before copying them, so content
+            already in the store is never written. New files are read twice.
+            Defaults to False.
+        max_threads (int): The number of threads used by ingest_all.
+            Defaults to 8.
+        added (int): The number of files added to the store.
+        skipped (int): The number of files already in the store.
+        bytes_added (int): The bytes added to the store.
+        errors (dict): The exception for each path ingest_all couldn't
+            ingest.
+    """
+    # Threads storing to shards with the same lock wait for each other.
+    _lock_count = 256
+
+    def __init__(self, root, *args, **kwargs):
+        super(C4Store, self).__init__(None, *args, **kwargs)
+        self.root = root
+        self.copy_stat = False
+        self.link = False
+        self.hash_first = False
+        self.max_threads = 8
+        self.added = 0
+        self.skipped = 0
+        self.bytes_added = 0
+        self.errors = {}
+        self._counts_lock = threading.Lock()
+        self._locks = [threading.Lock() for i in range(self._lock_count)]
+        self._tmp = os.path.join(root, 'tmp')
+        if not os.path.isdir(self._tmp):
+            os.makedirs(self._tmp)
+
+    def path(self, c4id):
+        """ The path of c4id in the store.
+
+        Args:
+            c4id (C4id or str): The c4 id.
+
+        Returns:
+            str: The path c4id is stored at, it may not exist.
+        """
+        c4id = str(c4id)
+        return os.path.join(self.root, 'c4', c4id[3:5], c4id[5:7], c4id)
+
+    def __contains__(self, c4id):
+        return os.path.isfile(self.path(c4id))
+
+    def _lock(self, c4id):
+        """ The lock for the shard of c4id.
+        """
+        return self._locks[hash(str(c4id)[3:7]) % self._lock_count]
+
+    def ingest(self, path):
+        """ Add a file to the store.
+
+        Args:
+            path (str): The file to add.
+
+        Returns:
+            C4id: The c4 id of path. Use path to find it in the store.
+
+        Raises:
+            HashIncomplete: If self.__stopped__() returns True.
+        """
+        if self.link or self.hash_first:
+            c4id = self.from_file(path)
+            if c4id in self:
+                self._count(None)
+                return c4id
+            if self.link:
+                try:
+                    self._store(c4id, path, link=True)
+                    return c4id
+                except OSError as error:
+                    if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+        fd, temp = tempfile.mkstemp(dir=self._tmp, suffix='.c4store')
+        os.close(fd)
+        try:
+            digest, bytes = self.copy_and_hash(path, [temp])
+            c4id = self.from_digest(digest, path=path, bytes=bytes)
+            self._store(c4id, temp)
+        finally:
+            if os.path.isfile(temp):
+                os.remove(temp)
+        return c4id
+
+    def _store(self, c4id, source, link=False):
+        """ Rename or link source into the store, unless c4id is already in it.
+        """
+        destination = self.path(c4id)
+        with self._lock(c4id):
+            if os.path.isfile(destination):
+                self._count(None)
+                return
+            dirname = os.path.dirname(destination)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # A shard with a different lock may share the parent.
+                    if not os.path.isdir(dirname):
+                        raise
+            if link:
+                os.link(source, destination)
+            else:
+                # Stored files never change.
+                os.chmod(source, 0o444)
+                _replace(source, destination)
+        self._count(c4id)
+
+    def _count(self, added):
+        with self._counts_lock:
+            if added is None:
+                self.skipped += 1
+            else:
+                self.added += 1
+                self.bytes_added += added.bytes
+
+    def ingest_all(self, paths):
+        """ Add many files to the store using max_threads threads.
+
+        Args:
+            paths (iterable): The files to add.
+
+        Returns:
+            dict: The C4id of each path. Paths that couldn't be read are in
+                errors instead.
+        """
+        results, errors = _thread_map(self.ingest, paths, self.max_threads)
+        self.errors.update(errors)
+        return results
+
+def _send_frame(sock, message):
+    """ Send message as json, framed by its 4 byte big endian length.
+    """
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def _recv_frame(sock):
+    """ Receive a message sent by _send_frame, None if the socket closed.
+    """
+    header = _recv_exactly(sock, 4)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, struct.unpack('>I', header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+class _C4Pending(object):
+    """ A hash requested by one or more connections, set by a worker.
+    """
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class C4Server(C4):
+    """ A daemon that hashes files for other processes over a Unix socket.
+
+    The c4 id of each file is cached with its stat signature, so files that
+    haven't changed are never hashed twice. Files are hashed by a shared pool
+    of max_threads worker threads, and requests for a file that is already
+    being hashed wait for that result instead of reading it again.
+
+    Messages are json, framed by their 4 byte big endian length. A request
+    is {"op": "hash" or "lookup", "paths": [...]}, lookups only return
+    cached c4 ids. The response has a result for each path, either
+    {"path", "c4id", "bytes", "mtime"} or {"path", "error", "errno"}.
+    {"op": "stats"} returns the cache statistics.
+
+    Example:
+        server = C4Server('/tmp/pyc4.sock')
+        server.serve_forever()
+
+    Set PYC4_SERVER to the socket path to make C4.from_file use the server
+    while it is running, see C4Client.
+
+    Args:
+        path (str): The Unix socket to listen on. Only the current user can
+            connect to it.
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        path (str): The Unix socket.
+        max_threads (int): The number of worker threads. Defaults to 8.
+        max_cache (int): The number of c4 ids cached, the least recently used
+            are removed first. Defaults to 1000000.
+        hits (int): Requests answered from the cache.
+        misses (int): Requests that hashed a file.
+    """
+    def __init__(self, path, *args, **kwargs):
+        super(C4Server, self).__init__(*args, **kwargs)
+        self.server = None
+        self.path = path
+        self.max_threads = 8
+        self.max_cache = 1000000
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._socket = None
+        self._threads = []
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _signature(statinfo):
+        return (statinfo.st_dev, statinfo.st_ino, statinfo.st_size,
+            mtime_ns(statinfo))
+
+    def start(self):
+        """ Listen on path and start the worker threads.
+        """
+        if os.path.exists(self.path):
+            # Remove the socket of a server that didn't exit cleanly.
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self._socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        self._socket.listen(64)
+        for i in range(self.max_threads):
+            self._threads.append(threading.Thread(target=self._work))
+        self._threads.append(threading.Thread(target=self._accept))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def serve_forever(self):
+        """ Start the server and block until stop is called.
+        """
+        self.start()
+        try:
+            while not self._stop_event.wait(0.1):
+                pass
+        except KeyboardInterrupt: # pragma: no cover "Not testable"
+            pass
+        self.stop()
+
+    def stop(self):
+        """ Stop accepting connections, stop the workers and remove the socket.
+        """
+        self._stop_event.set()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        for i in range(self.max_threads):
+            self._jobs.put(None)
+        # Answer the requests still waiting for a worker.
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for (path, signature), item in pending:
+            item.result = {'path': path, 'error': 'The server stopped',
+                'errno': errno.ECANCELED}
+            item.event.set()
+
+    def __stopped__(self):
+        return self._stop_event.is_set()
+
+    def _accept(self):
+        while not self.__stopped__():
+            try:
+                connection, address = self._socket.accept()
+            except (socket.error, AttributeError):
+                # The socket was closed by stop.
+                return
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        """ Answer the requests of a single connection until it is closed.
+        """
+        try:
+            while True:
+                request = _recv_frame(connection)
+                if request is None:
+                    return
+                op = request.get('op')
+                if op == 'hash':
+                    response = {'results': self.hash(request['paths'])}
+                elif op == 'lookup':
+                    response = {'results': self.lookup(request['paths'])}
+                elif op == 'stats':
+                    response = self.stats()
+                else:
+                    response = {'error': 'Unknown op "{}"'.format(op)}
+                _send_frame(connection, response)
+        except socket.error: # pragma: no cover "Client went away"
+            pass
+        finally:
+            connection.close()
+
+    def stats(self):
+        """ The cache statistics.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                'cached': len(self._cache), 'pending': len(self._pending)}
+
+    @staticmethod
+    def _error(path, error):
+        return {'path': path, 'error': str(error),
+            'errno': getattr(error, 'errno', None) or errno.EIO}
+
+    def lookup(self, paths):
+        """ The cached result for each path, files are never hashed.
+
+        Args:
+            paths (list): Absolute file paths.
+
+        Returns:
+            list: A result dict for each path, the error is "not cached" if
+                the file isn't cached or changed since it was.
+        """
+        results = []
+        for path in paths:
+            try:
+                signature = self._signature(os.stat(path))
+            except OSError as error:
+                results.append(self._error(path, error))
+                continue
+            with self._lock:
+                cached = self._cache.get(path)
+                if cached is not None and cached[0] == signature:
+                    self._cache.move_to_end(path)
+                    self.hits += 1
+                    results.append(cached[1])
+                else:
+                    results.append({'path': path, 'error': 'not cached',
+                        'errno': None})
+        return results
+
+    def hash(self, paths):
+        """ The c4 id of each path, from the cache or the worker threads.
+
+        Args:
+            paths (list): Absolute file paths.
+
+        Returns:
+            list: A result dict for each path.
+        """
+        waiting = []
+        for path in paths:
+            try:
+                signature = self._signature(os.stat(path))
+            except OSError as error:
+                waiting.append(self._error(path, error))
+                continue
+            key = (path, signature)
+            with self._lock:
+                cached = self._cache.get(path)
+                if cached is not None and cached[0] == signature:
+                    self._cache.move_to_end(path)
+                    self.hits += 1
+                    waiting.append(cached[1])
+                    continue
+                if self.__stopped__():
+                    # There are no workers left to hash it.
+                    waiting.append({'path': path, 'error': 'The server stopped',
+                        'errno': errno.ECANCELED})
+                    continue
+                # Wait for the same file if it is already being hashed.
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = _C4Pending()
+                    self.misses += 1
+                    self._jobs.put(key)
+            waiting.append(pending)
+        results = []
+        for result in waiting:
+            if isinstance(result, _C4Pending):
+                result.event.wait()
+                result = result.result
+            results.append(result)
+        return results
+
+    def _work(self):
+        """ Hash the files requested until stop is called.
+        """
+        c4 = C4(self.block_size)
+        c4.server = None
+        c4.metrics = self.metrics
+        c4.tracer = self.tracer
+        while True:
+            key = self._jobs.get()
+            if key is None:
+                return
+            path, signature = key
+            result = {'path': path, 'error': 'Hashing was interrupted',
+                'errno': errno.EINTR}
+            try:
+                c4id = c4.from_file(path)
+                result = {'path': path, 'c4id': str(c4id), 'bytes': c4id.bytes,
+                    'mtime': c4id.mtime}
+            except Exception as error:
+                result = self._error(path, error)
+            finally:
+                # Always answer, or every request for this file waits forever.
+                self._finish(key, result)
+
+    def _finish(self, key, result):
+        """ Cache the result of hashing a file and wake its requests.
+        """
+        path, signature = key
+        with self._lock:
+            # Pending requests are answered by stop.
+            pending = self._pending.pop(key, None)
+            if 'c4id' in result:
+                self._cache[path] = (signature, result)
+                self._cache.move_to_end(path)
+                while len(self._cache) > self.max_cache:
+                    self._cache.popitem(last=False)
+        if pending is not None:
+            pending.result = result
+            pending.event.set()
+
+class C4Client(object):
+    """ Hash files with a running C4Server.
+
+    Example:
+        client = C4Client('/tmp/pyc4.sock')
+        for c4id in client.hash(paths):
+            print(c4id)
+
+    Args:
+        path (str): The Unix socket of the server.
+
+    Raises:
+        socket.error: If the server isn't running.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except socket.error:
+            self._socket.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._socket.close()
+
+    def _request(self, message):
+        _send_frame(self._socket, message)
+        response = _recv_frame(self._socket)
+        if response is None:
+            raise socket.error(errno.ECONNRESET, 'The pyc4 server closed the connection')
+        return response
+
+    @staticmethod
+    def _c4id(path, result):
+        if 'c4id' not in result:
+            if result.get('errno') is None:
+                return None
+            return OSError(result['errno'], result['error'], path)
+        c4id = C4id(result['c4id'], path=path, bytes=result['bytes'])
+        c4id.mtime = result['mtime']
+        return c4id
+
+    def hash(self, paths):
+        """ The c4 id of each path.
+
+        Args:
+            paths (list): File paths, relative paths are relative to the
+                current directory of this process.
+
+        Returns:
+            list: A C4id for each path, or the OSError for paths the server
+                couldn't read.
+        """
+        results = self._request({'op': 'hash',
+            'paths': [os.path.abspath(path) for path in paths]})['results']
+        return [self._c4id(path, result) for path, result in zip(paths, results)]
+
+    def lookup(self, paths):
+        """ The cached c4 id of each path.
+
+        Returns:
+            list: A C4id for each path, None if it isn't cached, or the
+                OSError for paths the server couldn't stat.
+        """
+        results = self._request({'op': 'lookup',
+            'paths': [os.path.abspath(path) for path in paths]})['results']
+        return [self._c4id(path, result) for path, result in zip(paths, results)]
+
+    def stats(self):
+        """ The cache statistics of the server.
+        """
+        return self._request({'op': 'stats'})
+
+class C4Coordinator(object):
+    """ Share the hashing of a list of files between C4Workers over TCP.
+
+    The files are split into leases of lease_size files that are handed to
+    workers as they ask for work. If a worker disconnects, or doesn't return
+    its results within lease_timeout seconds, its lease is handed to
+    another worker. The results of a lease are only recorded once, so a
+    slow worker can't add duplicates. Workers must see the files at the
+    same paths, for example on a shared filesystem.
+
+    There is no encryption, only run coordinators on trusted networks. If
+    token is set, workers must send the same token.
+
+    Example:
+        coordinator = C4Coordinator(files, address=('0.0.0.0', 4242))
+        coordinator.manifest = C4ManifestWriter('archive.c4m.gz', sort=True)
+        coordinator.start()
+        coordinator.join() # run C4Worker(('coordinator', 4242)).run() on each host
+        coordinator.manifest.close()
 
     Args:
-        block_size (int, optional): Read and hash each file in byte chunks
-            of this size. Defaults to 100MB chunks.
+        files (list): The file paths to hash.
+        address (tuple, optional): The (host, port) to listen on. Defaults
+            to ('127.0.0.1', 0), a free port on localhost.
+        lease_size (int, optional): The number of files in each lease.
+            Defaults to 100.
 
     Attributes:
-        files (list): A list of all file paths to process.
-        hashes (dict): This dict will be updated to contain the file path
-            and C4id object generated for each file path.
-        queue (queue.Queue): The Queue object used to manage processing of
-            files by the child threads.
-        max_threads (int): Use this to limit the number of threads used to
-            process C4 hashes. This class will use a thread per file up to
-            this total. Defaults to 100.
-        worker_started_callback (callable or None): Called each time a c4id
-            starts processing. The callable will be passed the C4Queue
-            instance and the file path that will have a c4id generated.
-        worker_finished_callback (callable or None): Called each time a c4id
-            finishes processing. The callable will be passed the C4id object
-            that was just generated.
-        show_progress (bool): If using worker_finished_default, should a
-            progress bar be drawn? Defaults to False.
-        show_path (bool): If using worker_finished_default, this is passed to
-            c4id.format. Defaults to False.
-        show_metadata (bool): If using worker_finished_default, this is passed
-            to c4id.format. Defaults to False.
-        show_absolute (bool): If using worker_finished_default, this is passed
-            to c4id.format. Defaults to False.
-        show_formatting (bool): If using worker_finished_default, this is
-            passed to c4id.format. Defaults to False.
+        address (tuple): The (host, port) the coordinator is listening on,
+            once started.
+        lease_timeout (float): Seconds a worker has to return a lease before
+            it is handed to another worker. Defaults to 600.
+        token (str or None): Workers must send this token. Defaults to None.
+        manifest (C4ManifestWriter or None): If set, each c4id is written to
+            this manifest as the results of each lease arrive.
+        hashes (dict): The C4id of each file hashed.
+        errors (dict): The error message for each file a worker couldn't
+            hash.
+        leases (int): The number of leases.
+        released (int): The number of leases handed to another worker.
     """
-
-    # This class property is used to ensure correct printing across threads.
-    lock = threading.Lock()
-
-    def __init__(self, *args, **kwargs):
-        super(C4Queue, self).__init__(*args, **kwargs)
-        self.files = []
+    def __init__(self, files, address=('127.0.0.1', 0), lease_size=100):
+        files = list(files)
+        self.address = address
+        self.lease_timeout = 600.0
+        self.token = None
+        self.manifest = None
         self.hashes = {}
-        self.queue = queue.Queue()
-        self.max_threads = 100
-        self.worker_started_callback = None
-        self.worker_finished_callback = None
-        self.show_progress = False
-        self.show_path = False
-        self.show_metadata = False
-        self.show_absolute = False
-        self.show_formatting = 'id'
+        self.errors = {}
+        self.released = 0
+        self._leases = [files[i:i + lease_size]
+            for i in range(0, len(files), lease_size)]
+        self.leases = len(self._leases)
+        self._pending = list(range(self.leases - 1, -1, -1))
+        self._active = {}
+        self._done = set()
+        self._condition = threading.Condition()
+        self._socket = None
         self._stop_event = threading.Event()
-        self._threads = []
-        self._progress_shown = False
+
+    def start(self):
+        """ Listen for workers.
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(self.address)
+        self._socket.listen(64)
+        self.address = self._socket.getsockname()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
 
     def join(self):
-        """ Blocks until all items in the queue have been processed.
+        """ Block until every lease has been hashed.
+        """
+        with self._condition:
+            while len(self._done) < self.leases and not self._stop_event.is_set():
+                self._expire()
+                self._condition.wait(0.1)
 
-        If progress_callback is set, it will be called with the percent
-        of items remaining in the queue. Note, this is updated when a item
-        starts processing in a thread, not when it finishes.
+    def stop(self):
+        """ Stop listening, workers exit when they next ask for work.
+        """
+        self._stop_event.set()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        with self._condition:
+            self._condition.notify_all()
+
+    def _accept(self):
+        while not self._stop_event.is_set():
+            try:
+                connection, address = self._socket.accept()
+            except (socket.error, AttributeError):
+                # The socket was closed by stop.
+                return
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        """ Serve a single worker until it disconnects.
         """
-        percent = 0
-        # Note: at this point the qsize is less than len(self.files).
-        # There may be a huge jump in percent at the start of processing.
-        total = len(self.files)
+        held = set()
         try:
-            # using self.queue.join() will prevent detection of KeyboardInterrupt
-            while not self.queue.empty():
-                time.sleep(0.1)
-                if total and self.progress_callback:
-                    # If there are still items in the queue, provide progress reporting
-                    newPercent = 100 - 100 * (self.queue.qsize() / total)
-                    # Only emit the callback if the percent changes
-                    if newPercent != percent:
-                        percent = newPercent
-                        self.progress_callback(percent)
-            # Note: We are done processing queue items, but the threads
-            # need to finish processing, so we still need to call join.
-            if not self.__stopped__():
-                # Finish processing all threads
-                self.queue.join()
-        except KeyboardInterrupt: # pragma: no cover "Not testable"
-            # The user canceled the operation, stop processing and exit
-            self.stop()
-        # Wait for all threads to complete
-        for thread in self._threads:
-            thread.join()
+            while True:
+                request = _recv_frame(connection)
+                if request is None or request.get('token') != self.token:
+                    return
+                if request.get('op') == 'lease':
+                    response = self._lease(held)
+                elif request.get('op') == 'results':
+                    self._complete(request['lease'], request['results'])
+                    held.discard(request['lease'])
+                    response = {'ok': True}
+                else:
+                    response = {'error': 'Unknown op "{}"'.format(request.get('op'))}
+                _send_frame(connection, response)
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+            # Hand the leases of a lost worker to the others.
+            with self._condition:
+                for lease in held:
+                    if lease in self._active:
+                        del self._active[lease]
+                        self._pending.append(lease)
+                        self.released += 1
+                self._condition.notify_all()
 
-    def start(self):
-        """ Create worker threads and add all files to the queue for processing
+    def _expire(self):
+        """ Return leases held longer than lease_timeout to the pending list.
+
+        Called with _condition held.
         """
-        # If less than max_threads, use a thread per file to hash.
-        for i in range(min(len(self.files), self.max_threads)):
-            t = threading.Thread(target=self._worker)
-            t.start()
-            self._threads.append(t)
+        now = _timer()
+        for lease, granted in list(self._active.items()):
+            if now - granted > self.lease_timeout:
+                del self._active[lease]
+                self._pending.append(lease)
+                self.released += 1
 
-        # Add all files we need to process to the queue
-        for filename in self.files:
-            self.queue.put(filename)
+    def _lease(self, held):
+        with self._condition:
+            self._expire()
+            if self._stop_event.is_set() or len(self._done) == self.leases:
+                return {'done': True}
+            if not self._pending:
+                # Every lease is out, wait in case one is handed back.
+                return {'wait': 0.5}
+            lease = self._pending.pop()
+            self._active[lease] = _timer()
+            held.add(lease)
+            return {'lease': lease, 'paths': self._leases[lease]}
 
-    def stop(self):
-        """ Stop processing and close all threads before the queue is empty.
+    def _complete(self, lease, results):
+        with self._condition:
+            if lease in self._done:
+                # Another worker finished this lease after it timed out.
+                return
+            self._done.add(lease)
+            self._active.pop(lease, None)
+            if lease in self._pending:
+                self._pending.remove(lease)
+            for result in results:
+                path = result['path']
+                if 'c4id' not in result:
+                    self.errors[path] = result['error']
+                    continue
+                c4id = C4id(result['c4id'], path=path, bytes=result['bytes'])
+                c4id.mtime = result['mtime']
+                self.hashes[path] = c4id
+                if self.manifest is not None:
+                    self.manifest.write(c4id)
+            self._condition.notify_all()
 
-        See: https://stackoverflow.com/a/325528
+class C4Worker(C4):
+    """ Hash the leases handed out by a C4Coordinator.
+
+    Each lease is hashed by a C4Queue with max_threads threads.
+
+    Example:
+        C4Worker(('coordinator', 4242)).run()
+
+    Args:
+        address (tuple): The (host, port) of the coordinator.
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        address (tuple): The (host, port) of the coordinator.
+        max_threads (int): The number of threads hashing each lease.
+            Defaults to 8.
+        token (str or None): Sent to the coordinator with each request.
+            Defaults to None.
+        files (int): The number of files hashed.
+    """
+    def __init__(self, address, *args, **kwargs):
+        super(C4Worker, self).__init__(*args, **kwargs)
+        self.address = tuple(address)
+        self.max_threads = 8
+        self.token = None
+        self.files = 0
+
+    def run(self):
+        """ Hash leases until the coordinator has no more work.
+
+        Returns:
+            int: The number of files hashed.
+
+        Raises:
+            socket.error: If the coordinator can't be reached.
         """
-        self._stop_event.set() # pragma: no cover "Not testable"
+        connection = socket.create_connection(self.address)
+        try:
+            while True:
+                _send_frame(connection, {'op': 'lease', 'token': self.token})
+                response = _recv_frame(connection)
+                if response is None or response.get('done'):
+                    break
+                if 'wait' in response:
+                    time.sleep(response['wait'])
+                    continue
+                results = self._hash(response['paths'])
+                _send_frame(connection, {'op': 'results', 'token': self.token,
+                    'lease': response['lease'], 'results': results})
+                if _recv_frame(connection) is None:
+                    break
+        finally:
+            connection.close()
+        return self.files
 
-    def __stopped__(self):
-        return self._stop_event.is_set()
+    def _hash(self, paths):
+        """ The result of hashing each path, as sent to the coordinator.
+        """
+        c4 = C4Queue(self.block_size)
+        c4.max_threads = self.max_threads
+        c4.metrics = self.metrics
+        c4.tracer = self.tracer
+        c4.server = self.server
+        c4.files = paths
+        c4.start()
+        c4.join()
+        results = []
+        for path, c4id in c4.hashes.items():
+            results.append({'path': path, 'c4id': str(c4id), 'bytes': c4id.bytes,
+                'mtime': c4id.mtime})
+        for path, error in c4.errors:
+            results.append({'path': path, 'error': str(error)})
+        self.files += len(c4.hashes)
+        return results
 
-    def _worker(self):
-        """ Method run by worker threads to process items in the queue.
+class C4ResultRing(object):
+    """ A single producer, single consumer ring buffer of hash results in
+    shared memory.
+
+    Each record has a fixed width: the 64 byte sha512 digest, the size and
+    mtime of the file, the index of its path in the list of files being
+    hashed and an errno, 0 if the file was hashed. Records are copied in and
+    out with struct, so passing a result between processes doesn't pickle
+    anything.
+
+    Args:
+        size (int, optional): The number of records the ring holds. Defaults
+            to 4096.
+        name (str or None, optional): The name of an existing ring to
+            attach to, as created in another process. A new ring is created
+            if None.
+
+    Attributes:
+        name (str): The name of the shared memory.
+        size (int): The number of records the ring holds.
+    """
+    _header = struct.Struct('<Q')
+    # head and tail are on separate cache lines so the producer and
+    # consumer don't contend.
+    _head = 0
+    _tail = 64
+    _records = 128
+    record = struct.Struct('<64sQqQi4x')
+
+    def __init__(self, size=4096, name=None):
+        if shared_memory is None: # pragma: no cover "Python < 3.8"
+            raise NotImplementedError(
+                'C4ResultRing requires multiprocessing.shared_memory')
+        self.size = size
+        self._owner = name is None
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(create=True,
+                size=self._records + size * self.record.size)
+            self._memory.buf[:self._records] = bytes(self._records)
+        else:
+            # The processes of a C4ProcessQueue share the parent's resource
+            # tracker, so attaching doesn't register the memory twice.
+            self._memory = shared_memory.SharedMemory(name)
+        self.name = self._memory.name
+
+    def put(self, digest, bytes, mtime, index, error=0):
+        """ Add a record, waiting while the ring is full.
         """
-        # Create a new C4 object to hash per thread without progress_report
-        c4 = C4(self.block_size)
-        c4.progress_bar_length = self.progress_bar_length
+        buf = self._memory.buf
+        head = self._header.unpack_from(buf, self._head)[0]
+        while head - self._header.unpack_from(buf, self._tail)[0] >= self.size:
+            time.sleep(0.0001)
+        self.record.pack_into(buf, self._records + (head % self.size) *
+            self.record.size, digest, bytes, mtime, index, error)
+        # Publish the record only once it has been written.
+        self._header.pack_into(buf, self._head, head + 1)
 
-        # process any remaining items in the queue
-        while not self.__stopped__():
-            try:
-                filename = self.queue.get(timeout=0.1)
-            except queue.Empty:
-                # Nothing to do, the queue is empty
-                break
-            # if requested, report that a c4id is starting processing.
-            if self.worker_started_callback is not None:
-                self.worker_started_callback(self, filename)
+    def get_all(self, output):
+        """ Move every record in the ring to the end of output.
+
+        Args:
+            output (bytearray): Raw records are appended to this.
+
+        Returns:
+            int: The number of records moved.
+        """
+        buf = self._memory.buf
+        head = self._header.unpack_from(buf, self._head)[0]
+        tail = self._header.unpack_from(buf, self._tail)[0]
+        count = head - tail
+        if not count:
+            return 0
+        start = tail % self.size
+        end = start + count
+        width = self.record.size
+        if end <= self.size:
+            output += buf[self._records + start * width:self._records + end * width]
+        else:
+            # The records wrap around the end of the ring.
+            output += buf[self._records + start * width:self._records + self.size * width]
+            output += buf[self._records:self._records + (end - self.size) * width]
+        self._header.pack_into(buf, self._tail, head)
+        return count
+
+    def close(self):
+        """ Detach from the ring, removing it if it was created here.
+        """
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+def _process_worker(name, size, files, start, step, block_size):
+    """ Hash every step'th file from start, in a C4ProcessQueue process.
+    """
+    ring = C4ResultRing(size, name)
+    c4 = C4(block_size)
+    empty = bytes(64)
+    try:
+        for index in range(start, len(files), step):
             try:
-                c4id = c4.from_file(filename)
-            except HashIncomplete: # pragma: no cover "Not testable"
-                break
-            self.hashes[filename] = c4id
-            self.queue.task_done()
-            # If requested, report that c4id finished processing.
-            if self.worker_finished_callback is not None:
-                self.worker_finished_callback(c4id)
+                digests, statinfo = c4._hash_file(files[index], ('sha512',))
+            except (IOError, OSError) as e:
+                ring.put(empty, 0, 0, index, e.errno or errno.EIO)
+                continue
+            ring.put(digests['sha512'], statinfo.st_size, mtime_ns(statinfo), index)
+    finally:
+        ring.close()
 
-    def worker_finished_default(self, c4id):
-        """ Default progress reporting.
+class C4ProcessResults(object):
+    """ The raw results of a C4ProcessQueue, decoded only when read.
 
-        Prints each c4id info as soon as it finishes processing.
+    Iterating yields a C4id for each file that was hashed, in the order they
+    finished.
 
-        Args:
-            c4id (C4id): The c4id that was just generated.
+    Args:
+        records (bytearray): The raw C4ResultRing records.
+        files (list): The paths the record indexes refer to.
+    """
+    def __init__(self, records, files):
+        self._records = records
+        self._files = files
+
+    def __len__(self):
+        return len(self._records) // C4ResultRing.record.size
+
+    def _unpack(self):
+        return C4ResultRing.record.iter_unpack(self._records)
+
+    def __iter__(self):
+        for digest, bytes, mtime, index, error in self._unpack():
+            if not error:
+                c4id = C4.from_digest(digest, self._files[index], bytes)
+                c4id.mtime = mtime
+                yield c4id
+
+    def errors(self):
+        """ Iterate (path, OSError) for each file that couldn't be hashed.
         """
-        output = c4id.format(
-            show_metadata=self.show_metadata,
-            show_path=self.show_path,
-            absolute=self.show_absolute,
-            fmt=self.show_formatting
-        )
+        for digest, bytes, mtime, index, error in self._unpack():
+            if error:
+                path = self._files[index]
+                yield path, OSError(error, os.strerror(error), path)
 
-        # prevent any other threads from printing while we update the console
-        with self.lock:
-            if self.show_progress and self._progress_shown:
-                # Clear the progress bar we printed to the console only if it
-                # was already shown.
-                sys.stdout.write("\r")
-            # Show the result of the current hash output.
-            print(output)
-            if self.show_progress:
-                # Provide the user with progress feedback.
-                total = len(self.files)
-                if total:
-                    # Calculate percent done, not remaining
-                    percent = 100 - 100 * (self.queue.qsize() / total)
-                    self.progress_default(percent)
-                    # Enable clearing the progress bar we just printed.
-                    self._progress_shown = True
+class C4ProcessQueue(C4):
+    """ Hash files in several processes, to use more than one CPU.
+
+    Each process hashes every max_processes'th file and returns the results
+    through its own C4ResultRing in shared memory. The results are only
+    decoded to C4ids when they're read, so hashing many small files isn't
+    limited by moving results between processes.
+
+    Example:
+        c4 = C4ProcessQueue()
+        c4.files = paths
+        c4.start()
+        c4.join()
+        hashes = c4.hashes
+
+    Args:
+        block_size (int, optional): Read and hash each file in byte chunks
+            of this size. Defaults to 100MB chunks.
+
+    Attributes:
+        files (list): The file paths to hash.
+        max_processes (int): The number of processes hashing files. Defaults
+            to the number of CPUs.
+        ring_size (int): The number of results each process can queue before
+            it waits for the parent. Defaults to 4096.
+        results (C4ProcessResults or None): The results, once joined.
+    """
+    def __init__(self, *args, **kwargs):
+        super(C4ProcessQueue, self).__init__(*args, **kwargs)
+        if shared_memory is None: # pragma: no cover "Python < 3.8"
+            raise NotImplementedError(
+                'C4ProcessQueue requires multiprocessing.shared_memory')
+        self.files = []
+        self.max_processes = multiprocessing.cpu_count()
+        self.ring_size = 4096
+        self.results = None
+        self._records = bytearray()
+        self._workers = []
+
+    def start(self):
+        """ Start the hashing processes.
+        """
+        files = list(self.files)
+        self.files = files
+        self._records = bytearray()
+        count = max(1, min(self.max_processes, len(files)))
+        for start in range(count):
+            ring = C4ResultRing(self.ring_size)
+            process = multiprocessing.Process(target=_process_worker,
+                args=(ring.name, ring.size, files, start, count, self.block_size))
+            process.daemon = True
+            process.start()
+            expected = len(range(start, len(files), count))
+            self._workers.append([process, ring, expected])
+
+    def join(self):
+        """ Block until every file has been hashed.
+
+        Raises:
+            RuntimeError: If a hashing process exited before reporting all
+                of its files.
+        """
+        failed = []
+        try:
+            while self._workers:
+                moved = 0
+                for worker in list(self._workers):
+                    process, ring, expected = worker
+                    alive = process.is_alive()
+                    received = ring.get_all(self._records)
+                    worker[2] -= received
+                    moved += received
+                    if worker[2] and alive:
+                        continue
+                    process.join()
+                    ring.close()
+                    self._workers.remove(worker)
+                    if worker[2]:
+                        failed.append(process.exitcode)
+                if not moved:
+                    time.sleep(0.0005)
+        finally:
+            for process, ring, expected in self._workers: # pragma: no cover "Interrupted"
+                process.terminate()
+                process.join()
+                ring.close()
+            self._workers = []
+        self.results = C4ProcessResults(self._records, self.files)
+        if failed:
+            raise RuntimeError('A hashing process exited with code {}'.format(
+                failed[0]))
+
+    @property
+    def hashes(self):
+        """ dict: The C4id of each file hashed, keyed by path.
+        """
+        if self.results is None:
+            return {}
+        return {c4id.path: c4id for c4id in self.results}
+
+    @property
+    def errors(self):
+        """ list: (path, OSError) for each file that couldn't be hashed.
+        """
+        if self.results is None:
+            return []
+        return list(self.results.errors())
 
 def parseArguments():
     # Parse command line arguments
@@ -455,6 +5039,14 @@ def parseArguments():
     parser.add_argument("-f", "--formatting", default="id", choices=('id', 'path'),
         help='Output formatting options. "id": c4id oriented.'
             ' "path": path oriented. (default "id")')
+    parser.add_argument("-e", "--encoding", default="c4", choices=C4.encodings,
+        help='How ids and digests are encoded. "c4" uses hex for digests '
+            'other than sha512. (default "c4")')
+    parser.add_argument("--digest", action="append", default=[],
+        choices=sorted(hashlib.algorithms_guaranteed) if hasattr(hashlib,
+            'algorithms_guaranteed') else None,
+        help="Also calculate this digest, like md5 or sha256, while reading "
+            "each file once. Can be repeatedly used.")
     parser.add_argument("-l", "--links", action="store_true",
         help="All symbolic links are followed.")
     parser.add_argument("-m", "--metadata", action="store_true",
@@ -467,20 +5059,407 @@ def parseArguments():
     parser.add_argument("-v", "--version", action="version",
         help="Show version information.", version=C4.versionString())
     parser.add_argument("-t", "--target", action="append",
-        help="Specify target directory to copy. Can be repeatedly used.")
+        help="Specify target directory to copy. Can be repeatedly used. Each "
+            "file is read once and written to every target.")
+    parser.add_argument("--copy-mode", default="auto", choices=C4Copy.modes,
+        help='How --target copies are made on the same filesystem. "auto" '
+            'tries a reflink, then copy_file_range, then a buffered copy. '
+            '(default "auto")')
+    parser.add_argument("--verify", action="store_true",
+        help="Flush each copy made with --target to disk and hash it again, "
+            "reading from disk instead of the page cache. Exits with an error "
+            "if a copy doesn't match.")
     parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=0,
         help="Number of threads used to generate hashes.")
+    parser.add_argument("--metrics-json", metavar="PATH",
+        help="Record the time spent in each phase of hashing and write it to "
+            "PATH as json.")
+    parser.add_argument("--metrics-prometheus", metavar="PATH",
+        help="Record the time spent in each phase of hashing and write it to "
+            "PATH in the Prometheus text format.")
+    parser.add_argument("--trace", metavar="PATH",
+        help="Record a timeline of each thread and write it to PATH in the "
+            "Chrome trace event format, viewable in https://ui.perfetto.dev.")
+    parser.add_argument("--profile", metavar="PATH",
+        help="Profile the run with cProfile, including all worker threads, "
+            "and write the pstats file to PATH.")
+    parser.add_argument("--stats", action="store_true",
+        help="Print a summary of files, bytes, throughput and time per phase "
+            "when finished.")
+    parser.add_argument("--stats-json", metavar="PATH",
+        help="Write the --stats summary to PATH as json.")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+        help="Seconds between periodic metrics exports. (default 10)")
+    parser.add_argument("--manifest", metavar="PATH",
+        help='Write the path, size, modification time and c4 id of every '
+            'file to a manifest at PATH, compressed if it ends in .gz or .zst. '
+            'Use "-" to write the manifest to stdout instead of the ids.')
+    parser.add_argument("--sorted", action="store_true",
+        help="Sort the --manifest by path.")
+    parser.add_argument("--journal", metavar="PATH",
+        help="Append each result to a journal at PATH. When run again, files "
+            "in the journal that haven't changed are not hashed again, so an "
+            "interrupted run can be resumed.")
     parser.add_argument('files', nargs='*',
-        help='Generate C4 IDs for the provided files or folders.')
+        help='Generate C4 IDs for the provided files or folders. Use "-" or '
+            'pipe data with no files to generate the C4 ID of stdin.')
     return parser.parse_args()
 
+def diffCommand(argv):
+    """ The "diff" command, print the differences between two manifests.
+
+    Returns:
+        int: The exit code, 1 if the manifests differ.
+    """
+    parser = ArgumentParser(prog='pyc4.py diff',
+        description='Compare two manifests written with --manifest and '
+            '--sorted. Prints a tab separated status and path for each '
+            'change, moved files have their old and new paths.')
+    parser.add_argument('old', help='The earlier manifest.')
+    parser.add_argument('new', help='The later manifest.')
+    parser.add_argument('--summary', action='store_true',
+        help='Only print the number of changes of each kind.')
+    args = parser.parse_args(argv)
+
+    diff = C4Diff(args.old, args.new)
+    try:
+        for change in diff:
+            if args.summary:
+                continue
+            if change.status == 'moved':
+                line = 'moved\t{}\t{}\n'.format(_manifest_escape(change.old.path),
+                    _manifest_escape(change.new.path))
+            else:
+                line = '{}\t{}\n'.format(change.status,
+                    _manifest_escape((change.new or change.old).path))
+            sys.stdout.write(line)
+    except (ValueError, IOError, OSError) as error:
+        parser.error(str(error))
+    if args.summary:
+        for status in C4Diff.statuses + ('unchanged',):
+            print('{}: {}'.format(status, diff.counts[status]))
+    return 1 if any(diff.counts[status] for status in C4Diff.statuses) else 0
+
+def verifyCommand(argv):
+    """ The "verify" command, check files still match a manifest.
+
+    Returns:
+        int: The exit code, 1 if any file doesn't match.
+    """
+    parser = ArgumentParser(prog='pyc4.py verify',
+        description='Verify files against the c4 ids in a manifest written '
+            'with --manifest. Prints a tab separated report of the files that '
+            'are missing, changed size or have a different c4 id.')
+    parser.add_argument('manifest', help='The manifest to verify.')
+    parser.add_argument('--root', metavar='DIR',
+        help='Manifest paths are relative to DIR.')
+    parser.add_argument('--report', metavar='PATH',
+        help='Write the report to PATH instead of stdout.')
+    parser.add_argument('--fail-fast', action='store_true',
+        help='Stop at the first file that does not match.')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=8,
+        help="Number of threads used to generate hashes. (default 8)")
+    parser.add_argument("-p", "--progress", action="store_true",
+        help="Show progress while verifying.")
+    args = parser.parse_args(argv)
+
+    c4 = C4Verify()
+    c4.root = args.root
+    c4.fail_fast = args.fail_fast
+    c4.max_threads = max(1, args.max_threads)
+    c4.show_progress = args.progress
+    try:
+        c4.load(args.manifest)
+    except (ValueError, IOError, OSError) as error:
+        parser.error(str(error))
+    c4.start()
+    c4.join()
+    c4.write_report(args.report or sys.stdout)
+    sys.stderr.write('verified: {}  mismatches: {}\n'.format(c4.verified,
+        len(c4.mismatches)))
+    return 1 if c4.mismatches else 0
+
+def dedupCommand(argv):
+    """ The "dedup" command, print sets of duplicate files.
+
+    Returns:
+        int: The exit code.
+    """
+    parser = ArgumentParser(prog='pyc4.py dedup',
+        description='Find duplicate files, comparing sizes, then the first '
+            'and last bytes, and only then c4 ids. Prints the c4 id, size and '
+            'path of each duplicate separated by tabs, with a blank line '
+            'between each set.')
+    parser.add_argument('files', nargs='+',
+        help='The files or folders to search recursively.')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=16,
+        help="Number of threads used to read files. (default 16)")
+    parser.add_argument("-l", "--links", action="store_true",
+        help="All symbolic links are followed.")
+    args = parser.parse_args(argv)
+
+    def walk():
+        for path in args.files:
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for dirpath, dirs, files in os.walk(path, followlinks=args.links):
+                for f in files:
+                    yield os.path.join(dirpath, f)
+
+    c4 = C4Dedup()
+    c4.max_threads = max(1, args.max_threads)
+    for i, duplicates in enumerate(c4.find(walk())):
+        if i:
+            print('')
+        for path in duplicates.paths:
+            print('{}\t{}\t{}'.format(duplicates.c4id, duplicates.bytes,
+                _manifest_escape(path)))
+    for path, error in sorted(c4.errors.items()):
+        sys.stderr.write('Failed: {}: {}\n'.format(path, error))
+    sys.stderr.write('duplicate sets: {}  reclaimable bytes: {}  '
+        'read {} of {} bytes\n'.format(len(c4.duplicates), c4.reclaimable,
+        c4.bytes_read, c4.bytes_total))
+    return 1 if c4.errors else 0
+
+def ingestCommand(argv):
+    """ The "ingest" command, add files to a C4Store.
+
+    Returns:
+        int: The exit code, 1 if any file couldn't be ingested.
+    """
+    parser = ArgumentParser(prog='pyc4.py ingest',
+        description='Add files to a content addressable store, named by their '
+            'c4 id. Prints the c4 id and path of each file.')
+    parser.add_argument('store', help='The folder of the store.')
+    parser.add_argument('files', nargs='+',
+        help='The files or folders to add recursively.')
+    parser.add_argument('--link', action='store_true',
+        help='Hard link files into the store instead of copying them.')
+    parser.add_argument('--hash-first', action='store_true',
+        help='Hash files before copying them, so files already in the store '
+            'are never written.')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=8,
+        help="Number of threads used to ingest files. (default 8)")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.files:
+        if not os.path.isdir(path):
+            paths.append(path)
+            continue
+        for dirpath, dirs, files in os.walk(path):
+            paths.extend(os.path.join(dirpath, f) for f in files)
+
+    store = C4Store(args.store)
+    store.link = args.link
+    store.hash_first = args.hash_first
+    store.max_threads = max(1, args.max_threads)
+    results = store.ingest_all(paths)
+    for path in paths:
+        if path in results:
+            print('{}\t{}'.format(results[path], _manifest_escape(path)))
+    for path, error in sorted(store.errors.items()):
+        sys.stderr.write('Ingest failed: {}: {}\n'.format(path, error))
+    sys.stderr.write('added: {}  skipped: {}  bytes added: {}\n'.format(
+        store.added, store.skipped, store.bytes_added))
+    return 1 if store.errors else 0
+
+def serveCommand(argv):
+    """ The "serve" command, run a C4Server until interrupted.
+
+    Returns:
+        int: The exit code.
+    """
+    parser = ArgumentParser(prog='pyc4.py serve',
+        description='Hash files for other processes over a Unix socket, '
+            'caching the c4 id of each file. Set PYC4_SERVER to the socket '
+            'path so pyc4 uses the server while it is running.')
+    parser.add_argument('--socket', metavar='PATH',
+        default=os.environ.get('PYC4_SERVER') or os.path.join(
+            tempfile.gettempdir(), 'pyc4-{}.sock'.format(os.getuid())),
+        help='The socket to listen on. (default $PYC4_SERVER or '
+            '{tmp}/pyc4-{uid}.sock)')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=8,
+        help="Number of threads used to generate hashes. (default 8)")
+    parser.add_argument("--cache", type=int, default=1000000,
+        help="The number of c4 ids to cache. (default 1000000)")
+    args = parser.parse_args(argv)
+
+    server = C4Server(args.socket)
+    server.max_threads = max(1, args.max_threads)
+    server.max_cache = args.cache
+    # Remove the socket when the daemon is terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    sys.stderr.write('export PYC4_SERVER={}\n'.format(args.socket))
+    server.serve_forever()
+    return 0
+
+def watchCommand(argv):
+    """ The "watch" command, print the c4 id of files as they are written.
+
+    Returns:
+        int: The exit code.
+    """
+    parser = ArgumentParser(prog='pyc4.py watch',
+        description='Watch folders and print the c4 id and path of each file '
+            'once it has been written, until interrupted.')
+    parser.add_argument('folders', nargs='+', help='The folders to watch.')
+    parser.add_argument('--existing', action='store_true',
+        help='Also hash the files already in the folders.')
+    parser.add_argument('--manifest', metavar='PATH',
+        help='Also write each file to a manifest at PATH.')
+    parser.add_argument('--debounce', type=float, default=0.2,
+        help='Seconds without changes before a file is hashed. (default 0.2)')
+    parser.add_argument('--poll', metavar='SECONDS', type=float,
+        help='Scan the folders every SECONDS instead of using inotify.')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=8,
+        help="Number of threads used to generate hashes. (default 8)")
+    args = parser.parse_args(argv)
+
+    c4 = C4Watch()
+    c4.paths = args.folders
+    c4.existing = args.existing
+    c4.debounce = args.debounce
+    if args.poll is not None:
+        c4.use_inotify = False
+        c4.poll_interval = args.poll
+    c4.max_threads = max(1, args.max_threads)
+    c4.show_path = True
+    c4.worker_finished_callback = c4.worker_finished_default
+    if args.manifest:
+        c4.manifest = C4ManifestWriter(args.manifest)
+    signal.signal(signal.SIGTERM, lambda signum, frame: c4.stop())
+    c4.start()
+    c4.join()
+    if c4.manifest is not None:
+        c4.manifest.close()
+    return 0
+
+def _host_port(value):
+    """ Split a "host:port" argument into a (host, port) tuple.
+    """
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def coordinateCommand(argv):
+    """ The "coordinate" command, share hashing files between workers.
+
+    Returns:
+        int: The exit code, 1 if any file couldn't be hashed.
+    """
+    parser = ArgumentParser(prog='pyc4.py coordinate',
+        description='Hand out leases of files to "pyc4.py work" processes on '
+            'any number of hosts, and write their results to one manifest. '
+            'Workers must see the files at the same paths.')
+    parser.add_argument('files', nargs='+',
+        help='The files or folders to hash recursively.')
+    parser.add_argument('--listen', metavar='HOST:PORT', default='0.0.0.0:4242',
+        help='The address to listen for workers on. (default 0.0.0.0:4242)')
+    parser.add_argument('--manifest', metavar='PATH', required=True,
+        help='Write the c4 id of every file to a sorted manifest at PATH.')
+    parser.add_argument('--lease-size', type=int, default=100,
+        help='The number of files in each lease. (default 100)')
+    parser.add_argument('--lease-timeout', type=float, default=600.0,
+        help='Seconds before an unfinished lease is handed to another '
+            'worker. (default 600)')
+    parser.add_argument('--token', default=os.environ.get('PYC4_TOKEN'),
+        help='Only accept workers with this token. (default $PYC4_TOKEN)')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.files:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            paths.append(path)
+            continue
+        for dirpath, dirs, files in os.walk(path):
+            paths.extend(os.path.join(dirpath, f) for f in files)
+    # Keep the files of a folder together in as few leases as possible.
+    paths.sort()
+
+    try:
+        address = _host_port(args.listen)
+    except ValueError:
+        parser.error('Invalid address "{}"'.format(args.listen))
+    coordinator = C4Coordinator(paths, address, max(1, args.lease_size))
+    coordinator.lease_timeout = args.lease_timeout
+    coordinator.token = args.token
+    coordinator.manifest = C4ManifestWriter(args.manifest, sort=True)
+    coordinator.start()
+    sys.stderr.write('listening on {}:{} with {} leases\n'.format(
+        coordinator.address[0], coordinator.address[1], coordinator.leases))
+    try:
+        coordinator.join()
+    except KeyboardInterrupt: # pragma: no cover "Not testable"
+        coordinator.stop()
+    coordinator.stop()
+    coordinator.manifest.close()
+    for path, error in sorted(coordinator.errors.items()):
+        sys.stderr.write('Failed: {}: {}\n'.format(path, error))
+    sys.stderr.write('hashed: {}  errors: {}  released: {}\n'.format(
+        len(coordinator.hashes), len(coordinator.errors), coordinator.released))
+    return 1 if coordinator.errors else 0
+
+def workCommand(argv):
+    """ The "work" command, hash leases from a coordinator.
+
+    Returns:
+        int: The exit code.
+    """
+    parser = ArgumentParser(prog='pyc4.py work',
+        description='Hash the files handed out by "pyc4.py coordinate" until '
+            'it has no more work.')
+    parser.add_argument('coordinator', metavar='HOST:PORT',
+        help='The address of the coordinator.')
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=8,
+        help="Number of threads used to generate hashes. (default 8)")
+    parser.add_argument('--token', default=os.environ.get('PYC4_TOKEN'),
+        help='The token the coordinator expects. (default $PYC4_TOKEN)')
+    args = parser.parse_args(argv)
+
+    try:
+        worker = C4Worker(_host_port(args.coordinator))
+    except ValueError:
+        parser.error('Invalid address "{}"'.format(args.coordinator))
+    worker.max_threads = max(1, args.max_threads)
+    worker.token = args.token
+    try:
+        files = worker.run()
+    except socket.error as e:
+        parser.error('Could not reach {}: {}'.format(args.coordinator, e))
+    sys.stderr.write('hashed: {}\n'.format(files))
+    return 0
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['watch']:
+        sys.exit(watchCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serveCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['ingest']:
+        sys.exit(ingestCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['dedup']:
+        sys.exit(dedupCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['diff']:
+        sys.exit(diffCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['verify']:
+        sys.exit(verifyCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['coordinate']:
+        sys.exit(coordinateCommand(sys.argv[2:]))
+    if sys.argv[1:2] == ['work']:
+        sys.exit(workCommand(sys.argv[2:]))
     args = parseArguments()
     show_path = args.recursive or len(args.files) > 1
 
+    # Files are copied to each target directory while they are hashed.
+    copier = C4Copy(args.target) if args.target else None
+    if copier is not None:
+        copier.verify = args.verify
+        copier.mode = args.copy_mode
+
     # Configure hashing options
     if args.max_threads <= 1:
-        c4 = C4()
+        c4 = copier or C4()
         if args.progress:
             c4.progress_callback = c4.progress_default
     else:
@@ -488,47 +5467,184 @@ if __name__ == '__main__':
         c4.max_threads = args.max_threads
         # Setup the worker_finished_callback so it prints the results of
         # hashes as they finish.
-        c4.worker_finished_callback = c4.worker_finished_default
+        if args.manifest != '-':
+            c4.worker_finished_callback = c4.worker_finished_default
         c4.show_path = show_path
         c4.show_metadata = args.metadata
         c4.show_absolute = args.absolute
         c4.show_formatting = args.formatting
         if args.progress:
             c4.show_progress = True
+        c4.verify = args.verify
+        c4.copy_mode = args.copy_mode
+        c4.show_encoding = args.encoding
+    c4.digests = args.digest
+
+    if args.trace:
+        c4.tracer = C4Tracer()
+
+    metrics = None
+    if (args.metrics_json or args.metrics_prometheus or args.stats or
+            args.stats_json):
+        metrics = C4Metrics()
+        c4.metrics = metrics
+        metrics.start_export(json_path=args.metrics_json,
+            prometheus_path=args.metrics_prometheus,
+            interval=args.metrics_interval)
+
+    if args.max_threads <= 1:
+        # C4Queue tracks its own progress, the main thread does the hashing.
+        progress = C4Progress()
+        c4.progress_counter = progress.counter()
+        progress.start()
+    else:
+        progress = c4.progress
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        if args.max_threads > 1:
+            c4.profile = True
+
+    manifest = None
+    if args.manifest:
+        output = args.manifest
+        if output == '-':
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+        manifest = C4ManifestWriter(output, sort=args.sorted)
+        if args.max_threads > 1:
+            c4.manifest = manifest
+
+    journal = None
+    if args.journal:
+        journal = C4Journal(args.journal)
+        if args.max_threads > 1:
+            c4.journal = journal
 
-    def print_hash(path):
-        """ Hash and print path.
+    verify_errors = []
+    errors = []
+
+    def print_hash(path, root=None):
+        """ Hash and print path, copying it to each target if requested.
         """
         try:
-            c4id = c4.from_file(path)
+            # Files completed by an earlier run are not hashed or copied again.
+            c4id = None if journal is None else journal.completed(path)
+            if c4id is not None:
+                c4.progress_counter.bytes += c4id.bytes or 0
+            else:
+                if copier is None:
+                    c4id = c4.from_file(path)
+                else:
+                    try:
+                        c4id = c4.copy_file(path, c4.destinations(path, root))
+                    except C4VerifyError as error:
+                        verify_errors.append(error)
+                        return
+                if journal is not None:
+                    journal.write(c4id)
+            c4.progress_counter.files += 1
+            if manifest is not None:
+                manifest.write(c4id)
+                if args.manifest == '-':
+                    return
             output = c4id.format(
                 show_metadata=args.metadata,
                 show_path=show_path,
                 absolute=args.absolute,
-                fmt=args.formatting
+                fmt=args.formatting,
+                encoding=args.encoding,
             )
             print(output)
+        except (IOError, OSError) as error:
+            # Keep going, failures are reported when finished.
+            errors.append((path, error))
         except KeyboardInterrupt:
             sys.exit(0)
 
+    if not args.files and not sys.stdin.isatty():
+        args.files = ['-']
+    if '-' in args.files:
+        # Piped data is always hashed in the main thread and only its id is
+        # printed.
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        piped = C4()
+        piped.digests = args.digest
+        c4id = piped.from_stream(stdin)
+        if manifest is not None:
+            manifest.write(c4id)
+        if args.manifest != '-':
+            print(c4id.format(encoding=args.encoding))
+        args.files = [path for path in args.files if path != '-']
+
     for path in args.files:
+        # Copies of folders keep their paths relative to the folder's parent.
+        root = os.path.dirname(os.path.abspath(path)) if os.path.isdir(path) else None
         if os.path.isdir(path):
             # TODO: generate the same sort order as the go c4
-            for root, dirs, files in os.walk(path, topdown=False, followlinks=args.links):
-                if args.depth > 0 and root[len(path)+1:].count(os.sep) > args.depth:
+            for dirpath, dirs, files in os.walk(path, topdown=False, followlinks=args.links):
+                if args.depth > 0 and dirpath[len(path)+1:].count(os.sep) > args.depth:
                     # TODO: generate the directory c4 id's
                     continue
                 for f in files:
+                    filename = os.path.join(dirpath, f)
                     if args.max_threads <= 1:
-                        print_hash(os.path.join(root, f))
+                        print_hash(filename, root)
                     else:
-                        c4.files.append(os.path.join(root, f))
+                        c4.files.append(filename)
+                        if copier is not None:
+                            c4.destinations[filename] = copier.destinations(filename, root)
         else:
             if args.max_threads <= 1:
                 print_hash(path)
             else:
                 c4.files.append(path)
+                if copier is not None:
+                    c4.destinations[path] = copier.destinations(path)
     # If using threading, start processing the threads and wait for them to finish.
     if args.max_threads > 1:
         c4.start()
         c4.join()
+        verify_errors = c4.verify_errors
+        errors = c4.errors
+    if manifest is not None:
+        manifest.close()
+    if journal is not None:
+        journal.close()
+    if metrics is not None:
+        metrics.stop_export()
+    if args.trace:
+        c4.tracer.write(args.trace)
+    if args.max_threads <= 1:
+        progress.stop()
+    if profiler is not None:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        if args.max_threads > 1:
+            c4.profile_stats(stats)
+        stats.dump_stats(args.profile)
+    if args.stats or args.stats_json:
+        summary = progress.summary()
+        summary['threads'] = max(1, args.max_threads)
+        summary['phases'] = metrics.summary()
+        summary['errors'] = len(errors)
+        # Files completed by an earlier run were reported from the journal.
+        summary['cache_hits'] = 0 if journal is None else journal.resumed
+    if args.stats:
+        sys.stderr.write('files: {files}  bytes: {bytes}  elapsed: {elapsed:.3f}s  '
+            '{mb_per_s:.1f} MB/s  {files_per_s:.1f} files/s  '
+            'cache hits: {cache_hits}  errors: {errors}\n'.format(**summary))
+        for phase in sorted(summary['phases']):
+            info = summary['phases'][phase]
+            sys.stderr.write('  {:<10} {:>10} calls {:>10.3f}s\n'.format(
+                phase, info['count'], info['seconds']))
+    if args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    for path, error in errors:
+        sys.stderr.write('Failed: {}: {}\n'.format(path, error))
+    for error in verify_errors:
+        sys.stderr.write('Verify failed: {}\n'.format(error))
+    if verify_errors or errors:
+        sys.exit(1)
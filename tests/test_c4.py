@@ -1,4 +1,9 @@
+import io
 import re
+import mmap
+import array
+import base64
+import hashlib
 import os
 import pyc4
 import pytest
@@ -102,3 +107,97 @@ def test_c4_format(testdir):
     output = c4id.format(show_metadata=True, fmt='path')
     check = metadata_format.format(key=relative_path, fmt='c4id', value=c4id)
     assert output == check
+
+def test_from_stream(testdir):
+    c4 = pyc4.C4(block_size=4*2**10)
+    for path, c4_check in testdir.values():
+        with open(path, 'rb') as f:
+            c4id = c4.from_stream(f, path='piped')
+        assert str(c4id) == c4_check
+        assert c4id.path == 'piped'
+        assert c4id.bytes == os.path.getsize(path)
+
+    # Streams without readinto are read in blocks.
+    class Stream(object):
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+        def read(self, size):
+            return self.data.read(size)
+
+    path, c4_check = testdir['p10']
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert str(c4.from_stream(Stream(data))) == c4_check
+
+def test_from_buffer(testdir):
+    c4 = pyc4.C4()
+    path, c4_check = testdir['p40']
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert str(c4.from_buffer(data)) == c4_check
+    assert str(c4.from_buffer(bytearray(data))) == c4_check
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert str(c4.from_buffer(mapped)) == c4_check
+        mapped.close()
+    # Multi byte items are hashed as their raw bytes.
+    items = array.array('d', data[:40*2**10])
+    assert str(c4.from_buffer(items)) == str(c4.from_buffer(data[:40*2**10]))
+
+def test_from_buffers(testdir):
+    c4 = pyc4.C4()
+    checks = []
+    buffers = []
+    for path, c4_check in testdir.values():
+        with open(path, 'rb') as f:
+            buffers.append(f.read())
+        checks.append(c4_check)
+    c4ids = c4.from_buffers(buffers)
+    assert [str(c4id) for c4id in c4ids] == checks
+    assert [c4id.bytes for c4id in c4ids] == [len(data) for data in buffers]
+
+def test_digests(testdir):
+    path, c4_check = testdir['p30']
+    with open(path, 'rb') as f:
+        data = f.read()
+    c4 = pyc4.C4(block_size=4*2**10)
+    c4.digests = ['md5', 'sha256']
+    for c4id in (c4.from_file(path), c4.from_stream(io.BytesIO(data)), c4.from_buffer(data)):
+        assert str(c4id) == c4_check
+        assert c4id.digests == {
+            'md5': hashlib.md5(data).digest(),
+            'sha256': hashlib.sha256(data).digest(),
+        }
+    digests, bytes = c4.calculate_hashes(path, ['sha1', 'sha512'])
+    assert digests == {'sha1': hashlib.sha1(data).digest(),
+        'sha512': hashlib.sha512(data).digest()}
+    assert bytes == len(data)
+
+    output = c4.from_file(path).format(encoding='hex')
+    assert output == '{}:\n  md5: {}\n  sha256: {}'.format(hashlib.sha512(data).hexdigest(),
+        hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest())
+
+def test_encode_digest(testdir):
+    path, c4_check = testdir['p10']
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha512(data).digest()
+    hexed = hashlib.sha512(data).hexdigest()
+    c4id = pyc4.C4().from_file(path)
+    # The digest can be recovered from the c4 id.
+    assert c4id.digest == digest
+    checks = {
+        'c4': c4_check,
+        'base10': str(int(hexed, 16)),
+        'base64': base64.urlsafe_b64encode(digest).decode('ascii'),
+        'base64old': base64.b64encode(digest).decode('ascii'),
+        'hex': hexed,
+        'HEX': hexed.upper(),
+        'h:e:x': ':'.join(hexed[i:i + 2] for i in range(0, 128, 2)),
+    }
+    assert sorted(checks) == sorted(pyc4.C4.encodings)
+    for encoding, check in checks.items():
+        assert pyc4.C4.encode_digest(digest, encoding) == check
+        assert c4id.encode(encoding) == check
+    with pytest.raises(ValueError):
+        pyc4.C4.encode_digest(digest, 'base32')
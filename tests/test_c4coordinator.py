@@ -0,0 +1,70 @@
+import socket
+import threading
+import time
+import pyc4
+
+
+def start_workers(coordinator, count):
+    threads = []
+    for i in range(count):
+        worker = pyc4.C4Worker(coordinator.address)
+        worker.max_threads = 2
+        worker.token = coordinator.token
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def test_c4coordinator(testdir, tmpdir):
+    keys = ('p10', 'p20', 'p30', 'p40')
+    missing = str(tmpdir.join('missing'))
+    files = [testdir[key][0] for key in keys] + [missing]
+    coordinator = pyc4.C4Coordinator(files, lease_size=2)
+    coordinator.token = 'secret'
+    manifest = str(tmpdir.join('manifest.c4m'))
+    coordinator.manifest = pyc4.C4ManifestWriter(manifest, sort=True)
+    coordinator.start()
+    assert coordinator.leases == 3
+    threads = start_workers(coordinator, 2)
+    coordinator.join()
+    for thread in threads:
+        thread.join()
+    coordinator.stop()
+    coordinator.manifest.close()
+    assert {path: str(c4id) for path, c4id in coordinator.hashes.items()} == \
+        {testdir[key][0]: testdir[key][1] for key in keys}
+    assert list(coordinator.errors) == [missing]
+    with pyc4.C4ManifestReader(manifest) as reader:
+        assert sorted(entry.path for entry in reader) == \
+            sorted(testdir[key][0] for key in keys)
+
+def test_c4coordinator_lost_worker(testdir):
+    files = [testdir[key][0] for key in ('p10', 'p20')]
+    coordinator = pyc4.C4Coordinator(files, lease_size=1)
+    coordinator.start()
+    # A worker takes a lease and disconnects without returning it.
+    lost = socket.create_connection(coordinator.address)
+    pyc4._send_frame(lost, {'op': 'lease', 'token': None})
+    lease = pyc4._recv_frame(lost)
+    assert lease['paths'] == files[:1]
+    lost.close()
+    while coordinator.released < 1:
+        time.sleep(0.01)
+    # A worker that takes a lease and hangs, it is given the lost lease first.
+    hung = socket.create_connection(coordinator.address)
+    pyc4._send_frame(hung, {'op': 'lease', 'token': None})
+    assert pyc4._recv_frame(hung)['paths'] == files[:1]
+    coordinator.lease_timeout = 0.2
+    threads = start_workers(coordinator, 1)
+    coordinator.join()
+    for thread in threads:
+        thread.join()
+    # Late results for a lease that was handed out again are ignored.
+    pyc4._send_frame(hung, {'op': 'results', 'token': None, 'lease': 0,
+        'results': [{'path': files[0], 'error': 'late'}]})
+    assert pyc4._recv_frame(hung) == {'ok': True}
+    hung.close()
+    coordinator.stop()
+    assert sorted(coordinator.hashes) == sorted(files)
+    assert coordinator.errors == {}
+    assert coordinator.released == 2
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pyc4
+import pytest
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_copy_file(testdir, tmpdir):
+    targets = [str(tmpdir.join('a')), str(tmpdir.join('b')), str(tmpdir.join('c'))]
+    for block_size in (4*2**10, 1*2**20):
+        # Small block sizes use the threaded pipeline, large ones copy the
+        # file in a single block.
+        c4 = pyc4.C4Copy(targets, block_size=block_size, queue_depth=2)
+        for path, c4_check in testdir.values():
+            c4id = c4.copy_file(path)
+            assert str(c4id) == c4_check
+            assert c4id.bytes == os.path.getsize(path)
+            for destination in c4.destinations(path):
+                assert read(destination) == read(path)
+                assert os.path.getmtime(destination) == os.path.getmtime(path)
+        # No temporary files are left behind.
+        for target in targets:
+            assert sorted(os.listdir(target)) == sorted(
+                os.path.basename(path) for path, c4_check in testdir.values())
+
+def test_copy_digests(testdir, tmpdir):
+    path, c4_check = testdir['p40']
+    md5 = hashlib.md5(read(path)).digest()
+    for block_size in (4*2**10, 1*2**20):
+        c4 = pyc4.C4Copy([str(tmpdir)], block_size=block_size)
+        c4.digests = ['md5']
+        # A known c4 id doesn't skip reading the source for other digests.
+        c4id = c4.copy_file(path, c4id=c4_check)
+        assert str(c4id) == c4_check
+        assert c4id.digests == {'md5': md5}
+
+def test_destinations(tmpdir):
+    c4 = pyc4.C4Copy(['a', 'b'])
+    assert c4.destinations('/src/shot/plate.exr') == [
+        os.path.join('a', 'plate.exr'), os.path.join('b', 'plate.exr')]
+    assert c4.destinations('/src/shot/plate.exr', root='/src') == [
+        os.path.join('a', 'shot', 'plate.exr'), os.path.join('b', 'shot', 'plate.exr')]
+
+def test_copy_error(testdir, tmpdir):
+    c4 = pyc4.C4Copy(block_size=4*2**10)
+    path, c4_check = testdir['p40']
+    good = str(tmpdir.join('good.txt'))
+    bad = str(tmpdir.join('bad.txt'))
+    # The writer for this destination fails, the copy stops and cleans up.
+    temps = []
+    def temp_path(destination):
+        temp = pyc4.C4Copy._temp_path(destination)
+        if destination == bad:
+            os.remove(temp)
+            os.makedirs(temp)
+            temps.append(temp)
+        return temp
+    c4._temp_path = temp_path
+    with pytest.raises(EnvironmentError):
+        c4.copy_file(path, [good, bad])
+    assert os.listdir(str(tmpdir)) == [os.path.basename(temps[0])]
+
+def test_temp_path(tmpdir):
+    # Threads copying to the same destination each get their own file.
+    destination = str(tmpdir.join('plate.exr'))
+    temps = [pyc4.C4Copy._temp_path(destination) for i in range(2)]
+    assert temps[0] != temps[1]
+    assert all(os.path.basename(temp).startswith('.plate.exr.') for temp in temps)
+
+def test_c4queue_copy(testdir, tmpdir):
+    checks = {path:c4_check for path, c4_check in testdir.values()}
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.files = checks.keys()
+    for path in c4.files:
+        c4.destinations[path] = [str(tmpdir.join(os.path.basename(path)))]
+    c4.start()
+    c4.join()
+    for path, c4id in c4.hashes.items():
+        assert str(c4id) == checks[path]
+        assert read(c4.destinations[path][0]) == read(path)
+
+def test_verify(testdir, tmpdir):
+    targets = [str(tmpdir.join('a')), str(tmpdir.join('b'))]
+    c4 = pyc4.C4Copy(targets, block_size=4*2**10)
+    c4.verify = True
+    path, c4_check = testdir['p20']
+    c4id = c4.copy_file(path)
+    assert str(c4id) == c4_check
+
+    # Corrupt one of the copies.
+    good, bad = c4.destinations(path)
+    with open(bad, 'r+b') as f:
+        f.seek(100)
+        f.write(b'x')
+    missing = str(tmpdir.join('missing.txt'))
+    mismatches = c4.verify_copies(c4id, [bad, good, missing])
+    assert [path for path, result in mismatches] == [bad, missing]
+    assert str(mismatches[0][1]) != c4_check
+    assert isinstance(mismatches[1][1], EnvironmentError)
+
+def test_verify_error(testdir, tmpdir, monkeypatch):
+    c4 = pyc4.C4Copy([str(tmpdir)])
+    c4.verify = True
+    path, c4_check = testdir['p10']
+    # Simulate a destination that doesn't match the source.
+    monkeypatch.setattr(c4, 'verify_copies', lambda c4id, paths: [(paths[0], None)])
+    with pytest.raises(pyc4.C4VerifyError) as error:
+        c4.copy_file(path)
+    assert error.value.mismatches == [(c4.destinations(path)[0], None)]
+    assert str(error.value.c4id) == c4_check
+    # Copies that fail verification are not left behind.
+    assert os.listdir(str(tmpdir)) == []
+
+@pytest.mark.parametrize('mode', pyc4.C4Copy.modes)
+def test_copy_modes(testdir, tmpdir, mode):
+    c4 = pyc4.C4Copy([str(tmpdir.join('a')), str(tmpdir.join('b'))], block_size=8*2**10)
+    c4.mode = mode
+    for path, c4_check in testdir.values():
+        assert str(c4.copy_file(path)) == c4_check
+        for destination in c4.destinations(path):
+            assert read(destination) == read(path)
+        # Kernel copies fall back to buffered copies if they aren't supported.
+        allowed = ('reflink', 'copy_file_range') if mode == 'auto' else (mode,)
+        for used in c4.copy_modes.values():
+            assert used in allowed + ('buffered',)
+
+def test_copy_known_c4id(testdir, tmpdir):
+    c4 = pyc4.C4Copy([str(tmpdir)])
+    c4.mode = 'buffered'
+    path, c4_check = testdir['p30']
+    # Buffered copies have to read the source, so the id is calculated.
+    c4id = c4.copy_file(path, c4id='c4known')
+    assert str(c4id) == c4_check
+    assert read(c4.destinations(path)[0]) == read(path)
+
+    c4.mode = 'auto'
+    c4id = c4.copy_file(path, c4id=c4_check)
+    assert str(c4id) == c4_check
+    assert c4id.bytes == os.path.getsize(path)
+    assert read(c4.destinations(path)[0]) == read(path)
+
+def test_copy_mode_error(testdir, tmpdir):
+    c4 = pyc4.C4Copy([str(tmpdir)])
+    c4.mode = 'sendfile'
+    path, c4_check = testdir['p10']
+    with pytest.raises(ValueError):
+        c4.copy_file(path)
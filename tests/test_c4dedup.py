@@ -0,0 +1,56 @@
+import os
+import pyc4
+import pytest
+
+
+def test_c4dedup(tmpdir):
+    files = {
+        'a': b'a' * 1000, 'a2': b'a' * 1000, 'a3': b'a' * 1000,
+        # Same size, different content.
+        'b': b'b' * 1000,
+        # Same edges, different middle.
+        'c': b'c' * 100 + b'x' + b'c' * 100, 'c2': b'c' * 100 + b'y' + b'c' * 100,
+        'd': b'd' * 201,
+        'unique': b'u' * 10, 'empty': b'', 'empty2': b'',
+    }
+    for name, data in files.items():
+        tmpdir.join(name).write_binary(data)
+    # Hard links are listed, but not counted as copies.
+    os.link(str(tmpdir.join('d')), str(tmpdir.join('d_link')))
+    tmpdir.join('d2').write_binary(files['d'])
+    c4 = pyc4.C4Dedup()
+    c4.edge_size = 10
+    paths = [str(p) for p in tmpdir.listdir()]
+    duplicates = c4.find(paths + [str(tmpdir.join('missing'))])
+    found = [sorted(os.path.basename(p) for p in d.paths) for d in duplicates]
+    assert found == [['a', 'a2', 'a3'], ['d', 'd2', 'd_link']]
+    assert [d.copies for d in duplicates] == [3, 2]
+    assert str(duplicates[0].c4id) == str(pyc4.C4().from_file(str(tmpdir.join('a'))))
+    assert c4.reclaimable == 2000 + 201
+    assert c4.bytes_total == sum(len(data) for data in files.values()) + 2 * 201
+    # Only the files with the same size and edges are fully read.
+    assert c4.bytes_read == 20 * 8 + 3000 + 4 * 201
+    assert list(c4.errors) == [str(tmpdir.join('missing'))]
+
+def test_c4dedup_small(testdir):
+    c4 = pyc4.C4Dedup()
+    assert c4.find(path for path, c4id in testdir.values()) == []
+    assert c4.reclaimable == 0
+    assert c4.bytes_read == 0
+
+def test_c4dedup_errors(tmpdir, monkeypatch):
+    for name in ('a', 'a2', 'b', 'b2'):
+        tmpdir.join(name).write_binary(name[0].encode() * 1000)
+    c4 = pyc4.C4Dedup()
+    c4.edge_size = 10
+    edge_hash = c4._edge_hash
+    bad = str(tmpdir.join('b'))
+    def fail(path):
+        if path == bad:
+            raise ValueError('bad file')
+        return edge_hash(path)
+    monkeypatch.setattr(c4, '_edge_hash', fail)
+    duplicates = c4.find(sorted(str(p) for p in tmpdir.listdir()))
+    assert [len(d.paths) for d in duplicates] == [2]
+    assert list(c4.errors) == [bad]
+    assert isinstance(c4.errors[bad], ValueError)
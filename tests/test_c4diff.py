@@ -0,0 +1,44 @@
+import io
+import pyc4
+import pytest
+
+
+def manifest(*entries):
+    output = io.BytesIO()
+    writer = pyc4.C4ManifestWriter(output, sort=True)
+    for path, c4id in entries:
+        writer.write(pyc4.C4ManifestEntry(path, c4id, 1, None))
+    writer.close()
+    output.seek(0)
+    return output
+
+def test_c4diff():
+    old = manifest(('a', 'c4a'), ('b', 'c4b'), ('c', 'c4c'), ('d', 'c4d'), ('e', 'c4e'))
+    new = manifest(('a', 'c4a'), ('b', 'c4B'), ('c2', 'c4c'), ('aa', 'c4e'), ('f', 'c4f'))
+    diff = pyc4.C4Diff(old, new)
+    changes = sorted((change.status, change.old and change.old.path,
+        change.new and change.new.path) for change in diff)
+    assert changes == [
+        ('added', None, 'f'),
+        ('modified', 'b', 'b'),
+        ('moved', 'c', 'c2'),
+        ('moved', 'e', 'aa'),
+        ('removed', 'd', None),
+    ]
+    assert diff.counts == {'added': 1, 'removed': 1, 'modified': 1,
+        'moved': 2, 'unchanged': 1}
+
+def test_c4diff_entries():
+    old = [pyc4.C4ManifestEntry('a', 'c4a', 1, None)]
+    diff = pyc4.C4Diff(old, [])
+    assert [change.status for change in diff] == ['removed']
+
+def test_c4diff_unsorted(tmpdir):
+    path = str(tmpdir.join('unsorted.c4m'))
+    with pyc4.C4ManifestWriter(path) as writer:
+        writer.write(pyc4.C4ManifestEntry('a', 'c4a', 1, None))
+    with pytest.raises(ValueError):
+        list(pyc4.C4Diff(path, manifest()))
+    old = [pyc4.C4ManifestEntry(path, 'c4', 1, None) for path in ('b', 'a')]
+    with pytest.raises(ValueError):
+        list(pyc4.C4Diff(old, []))
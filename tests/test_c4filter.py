@@ -0,0 +1,53 @@
+import hashlib
+import pyc4
+import pytest
+
+
+def digests(start, stop):
+    return [hashlib.sha512(str(i).encode()).digest() for i in range(start, stop)]
+
+def test_c4filter():
+    added = digests(0, 1000)
+    c4filter = pyc4.C4Filter(capacity=1000, error_rate=0.01)
+    c4filter.add_many(added)
+    assert len(c4filter) == 1000
+    assert all(c4filter.contains_many(added))
+    false_positives = sum(c4filter.contains_many(digests(1000, 11000)))
+    assert false_positives < 300
+    assert 0.005 < c4filter.error_rate < 0.02
+    # C4ids and c4 id strings use the same bits as their digests.
+    c4id = pyc4.C4.from_digest(added[0])
+    assert c4id in c4filter
+    assert str(c4id) in c4filter
+
+def test_c4filter_merge(tmpdir):
+    a = pyc4.C4Filter(capacity=100)
+    b = pyc4.C4Filter(capacity=100)
+    a.add_many(digests(0, 50))
+    b.add_many(digests(50, 100))
+    path = str(tmpdir.join('b.c4f'))
+    b.save(path)
+    loaded = pyc4.C4Filter.load(path)
+    assert (loaded.bits, loaded.hashes, len(loaded)) == (b.bits, b.hashes, 50)
+    merged = a | loaded
+    assert all(merged.contains_many(digests(0, 100)))
+    assert len(merged) == 100
+    assert not all(a.contains_many(digests(50, 100)))
+    with pytest.raises(ValueError):
+        a.update(pyc4.C4Filter(capacity=1000))
+    tmpdir.join('other.c4f').write('not a filter' * 10)
+    with pytest.raises(ValueError):
+        pyc4.C4Filter.load(str(tmpdir.join('other.c4f')))
+
+def test_c4filter_merge_chunks(monkeypatch):
+    # Several full chunks and a short last one.
+    monkeypatch.setattr(pyc4.C4Filter, '_merge_words', 3)
+    a = pyc4.C4Filter(capacity=50)
+    b = pyc4.C4Filter(capacity=50)
+    assert (len(a._array) // 8) % 3
+    a.add_many(digests(0, 25))
+    b.add_many(digests(25, 50))
+    expected = bytearray(x | y for x, y in zip(a._array, b._array))
+    a |= b
+    assert a._array == expected
+    assert all(a.contains_many(digests(0, 50)))
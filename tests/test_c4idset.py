@@ -0,0 +1,45 @@
+import hashlib
+import pyc4
+import pytest
+
+
+def ids(*values):
+    return [str(pyc4.C4.from_digest(hashlib.sha512(str(v).encode()).digest()))
+        for v in values]
+
+def test_c4idset():
+    a = pyc4.C4IdSet.from_ids(ids(1, 2, 3, 4, 2))
+    b = pyc4.C4IdSet.from_ids(pyc4.C4id(c4id) for c4id in ids(3, 4, 5))
+    c = pyc4.C4IdSet.from_ids(pyc4.C4id(c4id).digest for c4id in ids(4, 5, 6))
+    assert len(a) == 4
+    assert sorted(a.ids()) == sorted(ids(1, 2, 3, 4))
+    assert ids(1)[0] in a and ids(5)[0] not in a
+    assert sorted((a | b).ids()) == sorted(ids(1, 2, 3, 4, 5))
+    assert sorted(a.union(b, c).ids()) == sorted(ids(1, 2, 3, 4, 5, 6))
+    assert sorted((a & b).ids()) == sorted(ids(3, 4))
+    assert list(a.intersection(b, c).ids()) == ids(4)
+    assert sorted((a - b).ids()) == sorted(ids(1, 2))
+    assert sorted(a.difference(b, c).ids()) == sorted(ids(1, 2))
+    assert sorted((a ^ b).ids()) == sorted(ids(1, 2, 5))
+    assert len(a & pyc4.C4IdSet()) == 0
+    assert a | pyc4.C4IdSet() == a
+
+def test_c4idset_files(tmpdir):
+    entries = [pyc4.C4ManifestEntry(str(i), c4id, None, None)
+        for i, c4id in enumerate(ids(1, 2, 2, 3))]
+    index = str(tmpdir.join('ids.c4x'))
+    pyc4.C4Index.build(index, entries)
+    with pyc4.C4Index(index) as c4index:
+        a = pyc4.C4IdSet.from_index(c4index)
+    assert a == pyc4.C4IdSet.from_ids(entries)
+    path = str(tmpdir.join('ids.c4s'))
+    a.save(path)
+    loaded = pyc4.C4IdSet.load(path)
+    assert loaded == a
+    assert sorted((loaded - pyc4.C4IdSet.from_ids(ids(2))).ids()) == sorted(ids(1, 3))
+    loaded.close()
+    empty = str(tmpdir.join('empty.c4s'))
+    pyc4.C4IdSet().save(empty)
+    assert len(pyc4.C4IdSet.load(empty)) == 0
+    with pytest.raises(ValueError):
+        pyc4.C4IdSet(b'short')
@@ -0,0 +1,52 @@
+import os
+import hashlib
+import pyc4
+import pytest
+
+
+def entries(count):
+    # Two paths share each of the first few digests.
+    result = []
+    for i in range(count):
+        c4id = pyc4.C4.from_digest(hashlib.sha512(str(i % (count - 3)).encode()).digest())
+        result.append(pyc4.C4ManifestEntry('dir/file {}'.format(i), str(c4id), i, None))
+    return result
+
+@pytest.mark.parametrize('max_entries', [3, 1000])
+def test_c4index(tmpdir, max_entries):
+    items = entries(50)
+    path = str(tmpdir.join('ids.c4x'))
+    assert pyc4.C4Index.build(path, items, max_entries=max_entries) == len(items)
+    with pyc4.C4Index(path) as index:
+        assert len(index) == len(items)
+        for entry in items[3:]:
+            assert entry.c4id in index
+            paths = index.lookup(entry.c4id)
+            assert entry.path in paths
+        assert sorted(index.lookup(items[0].c4id)) == ['dir/file 0', 'dir/file 47']
+        missing = pyc4.C4.from_digest(hashlib.sha512(b'missing').digest())
+        assert missing not in index
+        assert index.lookup(missing) == []
+        # Raw digests and C4id objects can be looked up too.
+        assert index.lookup(missing.digest) == []
+        assert index.lookup(pyc4.C4id(items[5].c4id).digest) == ['dir/file 5']
+
+def test_c4index_lookup_many(testdir, tmpdir):
+    c4 = pyc4.C4()
+    c4ids = [c4.from_file(testdir[key][0]) for key in ('p10', 'p20', 'p30')]
+    path = str(tmpdir.join('ids.c4x'))
+    pyc4.C4Index.build(path, c4ids)
+    index = pyc4.C4Index(path)
+    queries = [testdir[key][1] for key in ('p40', 'p30', 'p10', 'p10')]
+    results = index.lookup_many(queries)
+    assert results == {
+        testdir['p30'][1]: [testdir['p30'][0]],
+        testdir['p10'][1]: [testdir['p10'][0]],
+    }
+    index.close()
+
+def test_c4index_error(tmpdir):
+    path = tmpdir.join('other.c4x')
+    path.write('not an index' * 10)
+    with pytest.raises(ValueError):
+        pyc4.C4Index(str(path))
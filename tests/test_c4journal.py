@@ -0,0 +1,61 @@
+import os
+import pyc4
+import pytest
+
+
+def test_c4journal(testdir, tmpdir):
+    path = str(tmpdir.join('job.c4j'))
+    c4 = pyc4.C4()
+    with pyc4.C4Journal(path) as journal:
+        assert journal.entries == {}
+        for key in ('p10', 'p20'):
+            journal.write(c4.from_file(testdir[key][0]))
+    # Simulate a crash while writing a line.
+    with open(path, 'ab') as f:
+        f.write(b'c4partial 12')
+    journal = pyc4.C4Journal(path)
+    assert sorted(journal.entries) == sorted(testdir[key][0] for key in ('p10', 'p20'))
+    c4id = journal.completed(testdir['p10'][0])
+    assert str(c4id) == testdir['p10'][1]
+    assert c4id.bytes == os.path.getsize(testdir['p10'][0])
+    assert journal.completed(testdir['p30'][0]) is None
+    journal.write(c4.from_file(testdir['p30'][0]))
+    journal.close()
+    # The partial line was dropped and the journal is a valid manifest.
+    entries = list(pyc4.C4ManifestReader(path))
+    assert [(e.path, e.c4id) for e in entries] == [testdir[key] for key in ('p10', 'p20', 'p30')]
+
+def test_c4journal_changed(tmpdir):
+    path = tmpdir.join('file.txt')
+    path.write_binary(b'one')
+    journal = pyc4.C4Journal(str(tmpdir.join('job.c4j')), sync_interval=0)
+    journal.write(pyc4.C4().from_file(str(path)))
+    journal.close()
+    path.write_binary(b'two')
+    os.utime(str(path), (1, 1))
+    journal = pyc4.C4Journal(str(tmpdir.join('job.c4j')))
+    assert journal.completed(str(path)) is None
+    journal.close()
+    tmpdir.join('other.txt').write('not a journal\n')
+    with pytest.raises(ValueError):
+        pyc4.C4Journal(str(tmpdir.join('other.txt')))
+
+def test_c4journal_c4queue(testdir, tmpdir):
+    path = str(tmpdir.join('job.c4j'))
+    files = [testdir[key][0] for key in ('p10', 'p20', 'p30', 'p40')]
+    with pyc4.C4Journal(path) as journal:
+        journal.write(pyc4.C4().from_file(files[0]))
+    finished = []
+    c4 = pyc4.C4Queue()
+    c4.files = files
+    c4.journal = pyc4.C4Journal(path)
+    c4.worker_finished_callback = finished.append
+    c4.start()
+    c4.join()
+    c4.journal.close()
+    assert c4.journal.resumed == 1
+    assert sorted(c4id.path for c4id in finished) == sorted(files)
+    assert sorted((p, str(c4id)) for p, c4id in c4.hashes.items()) == sorted(testdir.values())
+    # Every file is only in the journal once.
+    entries = list(pyc4.C4ManifestReader(path))
+    assert sorted(e.path for e in entries) == sorted(files)
@@ -0,0 +1,89 @@
+import io
+import os
+import pyc4
+import pytest
+
+
+def test_c4manifest(testdir, tmpdir):
+    c4 = pyc4.C4()
+    output = str(tmpdir.join('files.c4m'))
+    with pyc4.C4ManifestWriter(output) as manifest:
+        for key in ('p30', 'p10'):
+            manifest.write(c4.from_file(testdir[key][0]))
+    with pyc4.C4ManifestReader(output) as manifest:
+        assert not manifest.sorted
+        assert manifest.compression is None
+        entries = list(manifest)
+    assert [(e.path, e.c4id) for e in entries] == [testdir['p30'], testdir['p10']]
+    for entry in entries:
+        statinfo = os.stat(entry.path)
+        assert entry.bytes == statinfo.st_size
+        assert entry.mtime == pyc4.mtime_ns(statinfo)
+
+def test_c4manifest_paths():
+    # Paths with spaces, backslashes and newlines and unknown sizes.
+    paths = ['a b', 'c\\d', 'e\nf\r', '\\n', 'caf\xe9']
+    output = io.BytesIO()
+    manifest = pyc4.C4ManifestWriter(output)
+    for i, path in enumerate(paths):
+        manifest.write(pyc4.C4ManifestEntry(path, 'c4' + str(i), None, i))
+    manifest.close()
+    assert len(output.getvalue().splitlines()) == len(paths) + 1
+    output.seek(0)
+    entries = list(pyc4.C4ManifestReader(output))
+    assert [e.path for e in entries] == paths
+    assert [e.bytes for e in entries] == [None] * len(paths)
+    assert [e.mtime for e in entries] == list(range(len(paths)))
+
+@pytest.mark.parametrize('max_entries', [2, 1000])
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_c4manifest_sorted(tmpdir, max_entries, compression):
+    paths = ['f{:03}'.format(i) for i in range(0, 100, 7)][::-1]
+    output = str(tmpdir.join('sorted.c4m'))
+    manifest = pyc4.C4ManifestWriter(output, sort=True, compression=compression,
+        max_entries=max_entries)
+    for path in paths:
+        manifest.write(pyc4.C4ManifestEntry(path, 'c4' + path, 1, None))
+    manifest.close()
+    assert manifest.entries == len(paths)
+    manifest = pyc4.C4ManifestReader(output)
+    assert manifest.sorted
+    assert manifest.compression == compression
+    assert [e.path for e in manifest] == sorted(paths)
+    manifest.close()
+
+@pytest.mark.parametrize('max_entries', [1, 2, 1000])
+def test_c4manifest_sorted_by_path(tmpdir, max_entries):
+    output = str(tmpdir.join('sorted.c4m'))
+    manifest = pyc4.C4ManifestWriter(output, sort=True, max_entries=max_entries)
+    # Entries with the same path are kept in the order they were written,
+    # whatever their other fields are.
+    manifest.write(pyc4.C4ManifestEntry('b', 'c4z', None, None))
+    manifest.write(pyc4.C4ManifestEntry('a', 'c4y', 1, None))
+    manifest.write(pyc4.C4ManifestEntry('b', 'c4a', 2, 5))
+    manifest.close()
+    with pyc4.C4ManifestReader(output) as manifest:
+        assert [(e.path, e.c4id) for e in manifest] == [
+            ('a', 'c4y'), ('b', 'c4z'), ('b', 'c4a')]
+
+def test_c4manifest_gzip(testdir, tmpdir):
+    output = str(tmpdir.join('files.c4m.gz'))
+    c4 = pyc4.C4Queue()
+    c4.files = [path for path, c4id in testdir.values()]
+    c4.manifest = pyc4.C4ManifestWriter(output)
+    c4.start()
+    c4.join()
+    c4.manifest.close()
+    with open(output, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    with pyc4.C4ManifestReader(output) as manifest:
+        assert manifest.compression == 'gzip'
+        assert sorted((e.path, e.c4id) for e in manifest) == sorted(testdir.values())
+
+def test_c4manifest_errors(tmpdir):
+    with pytest.raises(ValueError):
+        pyc4.C4ManifestWriter(io.BytesIO(), compression='zip')
+    output = tmpdir.join('other.txt')
+    output.write('not a manifest\n')
+    with pytest.raises(ValueError):
+        pyc4.C4ManifestReader(str(output))
@@ -0,0 +1,72 @@
+import json
+import pyc4
+import pytest
+
+
+def test_histogram():
+    histogram = pyc4.C4Histogram()
+    for seconds in (1e-6, 2e-6, 1e-3):
+        histogram.add(seconds)
+    assert histogram.count == 3
+    assert histogram.min == 1e-6
+    assert histogram.max == 1e-3
+    assert histogram.total == pytest.approx(1.003e-3)
+    # Percentiles are estimated from the power of two bucket bounds.
+    assert 2e-6 <= histogram.percentile(50) < 4e-6
+    assert histogram.percentile(100) == 1e-3
+
+    other = pyc4.C4Histogram()
+    other.add(1.0)
+    histogram.merge(other)
+    assert histogram.count == 4
+    assert histogram.max == 1.0
+    assert sum(histogram.buckets) == 4
+
+def test_c4_metrics(testdir, tmpdir):
+    metrics = pyc4.C4Metrics()
+    c4 = pyc4.C4(block_size=10*2**10)
+    c4.metrics = metrics
+    path, c4_check = testdir['p40']
+    # Instrumentation doesn't change the generated id.
+    assert str(c4.from_file(path)) == c4_check
+
+    histograms = metrics.histograms()
+    assert histograms['open'].count == 1
+    assert histograms['encode'].count == 1
+    assert histograms['file'].count == 1
+    # 4 full blocks, 1 partial block and the empty read at the end of the file.
+    assert histograms['read'].count == 6
+    assert histograms['hash'].count == 5
+
+    metrics.json_path = str(tmpdir.join('metrics.json'))
+    metrics.prometheus_path = str(tmpdir.join('metrics.prom'))
+    metrics.export()
+    with open(metrics.json_path) as f:
+        data = json.load(f)
+    assert data['phases']['read']['count'] == 6
+    with open(metrics.prometheus_path) as f:
+        text = f.read()
+    assert '# TYPE pyc4_phase_seconds histogram' in text
+    assert 'pyc4_phase_seconds_bucket{phase="read",le="+Inf"} 6' in text
+    assert 'pyc4_phase_seconds_count{phase="hash"} 5' in text
+
+def test_c4queue_metrics(testdir, tmpdir):
+    checks = {path:c4_check for path, c4_check in testdir.values()}
+    metrics = pyc4.C4Metrics()
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.metrics = metrics
+    c4.worker_finished_callback = lambda c4id: None
+    c4.files = checks.keys()
+    metrics.start_export(json_path=str(tmpdir.join('queue.json')), interval=0.01)
+    c4.start()
+    c4.join()
+    metrics.stop_export()
+
+    histograms = metrics.histograms()
+    # Each worker thread records into its own histograms that are merged.
+    assert histograms['file'].count == len(checks)
+    assert histograms['callback'].count == len(checks)
+    assert histograms['queue_get'].count == len(checks)
+    with open(str(tmpdir.join('queue.json'))) as f:
+        assert json.load(f)['phases']['file']['count'] == len(checks)
@@ -0,0 +1,42 @@
+import os
+import pyc4
+
+
+def test_c4processqueue(testdir, tmpdir):
+    keys = ('p10', 'p20', 'p30', 'p40')
+    missing = str(tmpdir.join('missing'))
+    c4 = pyc4.C4ProcessQueue()
+    c4.max_processes = 2
+    # A small ring so the workers have to wait for the parent.
+    c4.ring_size = 2
+    c4.files = [testdir[key][0] for key in keys] * 3 + [missing]
+    c4.start()
+    c4.join()
+    assert len(c4.results) == 13
+    hashes = c4.hashes
+    assert {path: str(c4id) for path, c4id in hashes.items()} == \
+        {testdir[key][0]: testdir[key][1] for key in keys}
+    c4id = hashes[testdir['p10'][0]]
+    assert c4id.bytes == os.path.getsize(testdir['p10'][0])
+    assert c4id.mtime == pyc4.mtime_ns(os.stat(testdir['p10'][0]))
+    [(path, error)] = c4.errors
+    assert path == missing
+    assert isinstance(error, OSError)
+
+def test_c4resultring():
+    ring = pyc4.C4ResultRing(4)
+    other = pyc4.C4ResultRing(4, ring.name)
+    records = bytearray()
+    for i in range(3):
+        other.put(b'\1' * 64, i, 0, i)
+    assert ring.get_all(records) == 3
+    # Records wrap around the end of the ring.
+    for i in range(4):
+        other.put(b'\2' * 64, i, 0, i)
+    assert ring.get_all(records) == 4
+    assert ring.get_all(records) == 0
+    other.close()
+    ring.close()
+    indexes = [index for digest, bytes, mtime, index, error
+        in pyc4.C4ResultRing.record.iter_unpack(records)]
+    assert indexes == [0, 1, 2, 0, 1, 2, 3]
@@ -0,0 +1,58 @@
+import re
+import time
+import pyc4
+import pytest
+
+
+def test_progress_counters(testdir):
+    progress = pyc4.C4Progress()
+    for path, c4_check in testdir.values():
+        progress.add_file(path)
+    assert progress.total_files == len(testdir)
+    assert progress.total_bytes == sum(size*2**10 + 1 for size in (10, 20, 30, 40))
+
+    # Each thread hashing files gets its own counter.
+    c4 = pyc4.C4()
+    c4.progress_counter = progress.counter()
+    progress.start()
+    path, c4_check = testdir['p10']
+    c4.from_file(path)
+    assert progress.bytes_done == 10*2**10 + 1
+    progress.stop()
+
+    assert 0 < progress.percent < 100
+    assert progress.eta is not None
+    # The time is frozen when stopped.
+    assert progress.elapsed == progress.elapsed
+
+def test_progress_add_files(testdir):
+    progress = pyc4.C4Progress()
+    paths = [path for path, c4_check in testdir.values()]
+    progress.add_files(paths + ['missing'])
+    # Files are counted right away, their sizes are added in the background.
+    assert progress.total_files == len(testdir) + 1
+    while progress.sizing:
+        time.sleep(0.01)
+    assert progress.total_bytes == sum(size*2**10 + 1 for size in (10, 20, 30, 40))
+    counter = progress.counter()
+    counter.bytes = progress.total_bytes // 2
+    assert progress.percent == 50.0
+
+def test_progress_format():
+    progress = pyc4.C4Progress(total_bytes=100)
+    counter = progress.counter()
+    counter.bytes = 50
+    output = progress.format(barLen=10)
+    assert output.startswith('[ =====      ] 50.00% ')
+    assert re.search(r'MB/s [\d.]+ files/s ETA --:--:--$', output)
+
+def test_progress_callback():
+    reports = []
+    progress = pyc4.C4Progress(total_files=2, refresh_rate=0.01)
+    progress.callback = lambda p: reports.append(p.percent)
+    progress.start()
+    counter = progress.counter()
+    counter.files = 2
+    progress.stop()
+    # stop always sends a final report from the calling thread.
+    assert reports[-1] == 100.0
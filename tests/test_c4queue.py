@@ -1,4 +1,6 @@
 import sys
+import errno
+import hashlib
 import pyc4
 import pytest
 
@@ -71,3 +73,76 @@ def test_worker_finished_default(testdir, capsys):
 
     # Check that the worker_started_callback output was generated.
     assert len(started) == len(checks)
+
+def test_progress_callback(testdir):
+    checks = buildChecks(testdir)
+    reports = []
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.progress_callback = reports.append
+    c4.files = checks.keys()
+    c4.start()
+    c4.join()
+
+    # Progress is weighted by bytes hashed, so it only reaches 100 when done.
+    assert reports[-1] == 100
+    assert c4.progress.bytes_done == c4.progress.total_bytes
+    assert c4.progress.files_done == len(checks)
+
+def test_profile(testdir):
+    checks = buildChecks(testdir)
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.files = checks.keys()
+    assert c4.profile_stats() is None
+    c4.profile = True
+    c4.start()
+    c4.join()
+
+    # The profiles of every worker thread are combined.
+    stats = c4.profile_stats()
+    functions = [func for filename, line, func in stats.stats]
+    assert functions.count('from_file') == 1
+    calls = [value[1] for key, value in stats.stats.items() if key[2] == 'from_file']
+    assert calls == [len(checks)]
+
+def test_digests(testdir):
+    checks = buildChecks(testdir)
+    c4 = pyc4.C4Queue()
+    c4.digests = ['md5']
+    c4.files = checks.keys()
+    c4.start()
+    c4.join()
+    for path, c4id in c4.hashes.items():
+        with open(path, 'rb') as f:
+            assert c4id.digests == {'md5': hashlib.md5(f.read()).digest()}
+
+def test_errors(testdir, tmpdir, monkeypatch):
+    checks = buildChecks(testdir)
+    missing = str(tmpdir.join('missing'))
+    folder = str(tmpdir)
+    flaky = list(checks)[0]
+    # Fail the first read of one file with a transient error.
+    from_file = pyc4.C4.from_file
+    failures = []
+    def flaky_from_file(c4, path):
+        if path == flaky and not failures:
+            failures.append(path)
+            raise IOError(errno.EIO, 'Input/output error', path)
+        return from_file(c4, path)
+    monkeypatch.setattr(pyc4.C4, 'from_file', flaky_from_file)
+    reported = []
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.retry_delay = 0.01
+    c4.error_callback = lambda path, error: reported.append(path)
+    c4.files = list(checks) + [missing, folder]
+    c4.start()
+    c4.join()
+    assert failures == [flaky]
+    assert c4.queue.unfinished_tasks == 0
+    assert sorted(path for path, error in c4.errors) == sorted([missing, folder])
+    assert sorted(reported) == sorted([missing, folder])
+    for path, c4id in c4.hashes.items():
+        assert str(c4id) == checks[path]
+    assert len(c4.hashes) == len(checks)
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+import pyc4
+import pytest
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = pyc4.C4Server(str(tmpdir.join('pyc4.sock')))
+    server.max_threads = 2
+    server.start()
+    yield server
+    server.stop()
+
+def test_c4server(testdir, tmpdir, server):
+    paths = [testdir[key][0] for key in ('p10', 'p20')]
+    missing = str(tmpdir.join('missing'))
+    with pyc4.C4Client(server.path) as client:
+        assert client.lookup(paths[:1]) == [None]
+        results = client.hash(paths + [missing])
+        assert [str(c4id) for c4id in results[:2]] == \
+            [testdir[key][1] for key in ('p10', 'p20')]
+        assert results[0].path == paths[0]
+        assert results[0].bytes == os.path.getsize(paths[0])
+        assert isinstance(results[2], OSError)
+        # Cached ids are returned without hashing again.
+        assert str(client.hash(paths[:1])[0]) == testdir['p10'][1]
+        assert str(client.lookup(paths[:1])[0]) == testdir['p10'][1]
+        stats = client.stats()
+    assert stats['misses'] == 2
+    assert stats['hits'] == 2
+    assert stats['cached'] == 2
+
+def test_c4server_changed(tmpdir, server):
+    path = tmpdir.join('file.txt')
+    path.write_binary(b'one')
+    c4 = pyc4.C4()
+    client = pyc4.C4Client(server.path)
+    assert str(client.hash([str(path)])[0]) == str(c4.from_file(str(path)))
+    path.write_binary(b'changed')
+    os.utime(str(path), (1, 1))
+    assert client.lookup([str(path)]) == [None]
+    assert str(client.hash([str(path)])[0]) == str(c4.from_file(str(path)))
+    client.close()
+
+def test_c4server_coalesce(testdir, server):
+    path = testdir['p40'][0]
+    results = []
+    def request():
+        with pyc4.C4Client(server.path) as client:
+            results.append(str(client.hash([path])[0]))
+    threads = [threading.Thread(target=request) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [testdir['p40'][1]] * 8
+    assert server.misses == 1
+
+def test_c4server_delegate(testdir, tmpdir, server):
+    c4 = pyc4.C4()
+    c4.server = server.path
+    path, c4_check = testdir['p30']
+    assert str(c4.from_file(path)) == c4_check
+    assert server.misses == 1
+    with pytest.raises(OSError):
+        c4.from_file(str(tmpdir.join('missing')))
+    # Files are hashed locally when the server isn't running.
+    server.stop()
+    assert str(c4.from_file(path)) == c4_check
+    c4.server = str(tmpdir.join('other.sock'))
+    assert str(c4.from_file(path)) == c4_check
+
+def test_c4server_failures(testdir, server, monkeypatch):
+    from_file = pyc4.C4.from_file
+    blocked = [testdir[key][0] for key in ('p20', 'p30', 'p40')]
+    release = threading.Event()
+    def failing_from_file(c4, path):
+        if path == testdir['p10'][0]:
+            raise ValueError('unexpected')
+        if path in blocked:
+            release.wait(10)
+        return from_file(c4, path)
+    monkeypatch.setattr(pyc4.C4, 'from_file', failing_from_file)
+    client = pyc4.C4Client(server.path)
+    # Unexpected errors are returned instead of killing the worker.
+    [error] = client.hash([testdir['p10'][0]])
+    assert isinstance(error, OSError)
+    client.close()
+    # Requests being hashed, or waiting for a worker, are answered when the
+    # server stops.
+    results = []
+    def request(path):
+        with pyc4.C4Client(server.path) as client:
+            results.extend(client.hash([path]))
+    threads = [threading.Thread(target=request, args=(path,)) for path in blocked]
+    for thread in threads:
+        thread.start()
+    while server.stats()['pending'] < len(blocked):
+        time.sleep(0.01)
+    server.stop()
+    for thread in threads:
+        thread.join(10)
+    release.set()
+    assert len(results) == len(blocked)
+    assert all(isinstance(result, OSError) for result in results)
+
+def test_c4server_not_used(tmpdir, server, monkeypatch):
+    monkeypatch.setenv('PYC4_SERVER', server.path)
+    path = tmpdir.join('file.bin')
+    path.write_binary(b'a' * 4096)
+    with pyc4.C4Client(server.path) as client:
+        [cached] = client.hash([str(path)])
+    # Change the content without changing the size or mtime.
+    stat = os.stat(str(path))
+    path.write_binary(b'b' + b'a' * 4095)
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    c4 = pyc4.C4Verify()
+    c4.load([pyc4.C4ManifestEntry(str(path), str(cached), 4096, pyc4.mtime_ns(stat))])
+    c4.start()
+    c4.join()
+    # Verifying reads the file instead of asking the server.
+    assert c4.verified == 0
+    assert [m.reason for m in c4.mismatches] == ['c4id']
+    c4 = pyc4.C4Queue()
+    c4.server = None
+    c4.files = [str(path)]
+    c4.start()
+    c4.join()
+    assert str(c4.hashes[str(path)]) != str(cached)
+    assert server.misses == 1
+    # Delegated results are counted in progress.
+    c4 = pyc4.C4Queue()
+    c4.files = [str(path)]
+    c4.start()
+    c4.join()
+    assert str(c4.hashes[str(path)]) == str(cached)
+    assert c4.progress.bytes_done == 4096
+
+def test_c4server_stopped(testdir, server, monkeypatch):
+    hash_file = pyc4.C4._hash_file
+    release = threading.Event()
+    calls = []
+    def blocking_hash_file(c4, path, algorithms):
+        calls.append(path)
+        if len(calls) == 1:
+            # The server's worker waits until it is stopped.
+            release.wait(10)
+        return hash_file(c4, path, algorithms)
+    monkeypatch.setattr(pyc4.C4, '_hash_file', blocking_hash_file)
+    c4 = pyc4.C4()
+    c4.server = server.path
+    path, c4_check = testdir['p10']
+    results = []
+    thread = threading.Thread(target=lambda: results.append(c4.from_file(path)))
+    thread.start()
+    while server.stats()['pending'] < 1:
+        time.sleep(0.01)
+    server.stop()
+    thread.join(10)
+    release.set()
+    # The file is hashed locally when the server stops mid request.
+    assert [str(c4id) for c4id in results] == [c4_check]
+    assert len(calls) == 2
@@ -0,0 +1,61 @@
+import os
+import stat
+import pyc4
+import pytest
+
+
+def test_c4store(testdir, tmpdir):
+    store = pyc4.C4Store(str(tmpdir.join('store')))
+    path, c4_check = testdir['p10']
+    c4id = store.ingest(path)
+    assert str(c4id) == c4_check
+    stored = store.path(c4id)
+    assert stored == str(tmpdir.join('store', 'c4', c4_check[3:5], c4_check[5:7], c4_check))
+    assert c4id in store
+    assert str(pyc4.C4().from_file(stored)) == c4_check
+    assert not os.stat(stored).st_mode & stat.S_IWUSR
+    # The same content is only stored once.
+    copy = tmpdir.join('copy.txt')
+    copy.write_binary(open(path, 'rb').read())
+    assert str(store.ingest(str(copy))) == c4_check
+    assert (store.added, store.skipped, store.bytes_added) == (1, 1, c4id.bytes)
+    assert os.listdir(str(tmpdir.join('store', 'tmp'))) == []
+
+@pytest.mark.parametrize('option', ['link', 'hash_first'])
+def test_c4store_options(testdir, tmpdir, option):
+    store = pyc4.C4Store(str(tmpdir.join('store')))
+    setattr(store, option, True)
+    path = tmpdir.join('file.txt')
+    path.write_binary(b'content')
+    c4id = store.ingest(str(path))
+    assert c4id in store
+    linked = os.path.samefile(str(path), store.path(c4id))
+    assert linked == (option == 'link')
+    store.ingest(str(path))
+    assert (store.added, store.skipped) == (1, 1)
+
+def test_c4store_ingest_all(testdir, tmpdir):
+    store = pyc4.C4Store(str(tmpdir.join('store')))
+    paths = [path for path, c4id in testdir.values()]
+    missing = str(tmpdir.join('missing'))
+    results = store.ingest_all(paths * 3 + [missing])
+    assert sorted((path, str(c4id)) for path, c4id in results.items()) == \
+        sorted(testdir.values())
+    assert list(store.errors) == [missing]
+    assert store.added == 4
+    for path, c4id in testdir.values():
+        assert c4id in store
+
+def test_c4store_ingest_all_errors(testdir, tmpdir, monkeypatch):
+    store = pyc4.C4Store(str(tmpdir.join('store')))
+    paths = sorted(path for path, c4id in testdir.values())
+    ingest = store.ingest
+    def fail(path):
+        if path == paths[0]:
+            raise ValueError('bad file')
+        return ingest(path)
+    monkeypatch.setattr(store, 'ingest', fail)
+    results = store.ingest_all(paths)
+    assert sorted(results) == paths[1:]
+    assert list(store.errors) == [paths[0]]
+    assert isinstance(store.errors[paths[0]], ValueError)
@@ -0,0 +1,46 @@
+import json
+import pyc4
+import pytest
+
+
+def test_c4_tracer(testdir, tmpdir):
+    tracer = pyc4.C4Tracer()
+    c4 = pyc4.C4(block_size=20*2**10)
+    c4.tracer = tracer
+    c4.metrics = pyc4.C4Metrics()
+    path, c4_check = testdir['p40']
+    assert str(c4.from_file(path)) == c4_check
+
+    events = [event for event in tracer.events() if event['ph'] == 'X']
+    names = [event['name'] for event in events]
+    assert names == ['open', 'read', 'hash', 'read', 'hash', 'read', 'hash',
+        'read', 'encode', 'file']
+    assert events[-1]['args'] == {'path': path, 'bytes': 40*2**10 + 1}
+    for event in events:
+        assert event['dur'] >= 0
+    # Metrics are recorded when both are enabled.
+    assert c4.metrics.histograms()['read'].count == 4
+
+    trace = str(tmpdir.join('trace.json'))
+    tracer.write(trace)
+    with open(trace) as f:
+        data = json.load(f)
+    assert len(data['traceEvents']) == len(events) + 1
+    assert data['otherData']['dropped'] == 0
+
+def test_c4queue_tracer(testdir):
+    checks = {path:c4_check for path, c4_check in testdir.values()}
+    tracer = pyc4.C4Tracer(max_events=2)
+    c4 = pyc4.C4Queue()
+    c4.max_threads = 2
+    c4.tracer = tracer
+    c4.files = checks.keys()
+    c4.start()
+    c4.join()
+
+    # Each worker thread gets its own named timeline.
+    threads = [event for event in tracer.events() if event['ph'] == 'M']
+    assert len(threads) == 2
+    assert len(set(event['tid'] for event in threads)) == 2
+    # Events over max_events are dropped rather than growing forever.
+    assert tracer.dropped > 0
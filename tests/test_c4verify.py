@@ -0,0 +1,60 @@
+import os
+import pyc4
+import pytest
+
+
+def write_manifest(tmpdir, files):
+    c4 = pyc4.C4()
+    path = str(tmpdir.join('files.c4m'))
+    with pyc4.C4ManifestWriter(path) as manifest:
+        for key, data in sorted(files.items()):
+            p = tmpdir.join(key)
+            p.write_binary(data)
+            manifest.write(c4.from_file(str(p)))
+    return path
+
+def test_c4verify(tmpdir):
+    manifest = write_manifest(tmpdir, {'a': b'a' * 10, 'b': b'b' * 20,
+        'c': b'c' * 30, 'd': b'd' * 40})
+    tmpdir.join('a').remove()
+    tmpdir.join('b').write_binary(b'b' * 19)
+    tmpdir.join('c').write_binary(b'C' * 30)
+    c4 = pyc4.C4Verify()
+    c4.load(manifest)
+    c4.start()
+    c4.join()
+    assert c4.verified == 1
+    reasons = sorted((m.reason, os.path.basename(m.path)) for m in c4.mismatches)
+    assert reasons == [('c4id', 'c'), ('missing', 'a'), ('size', 'b')]
+    # Truncated files are never read.
+    assert str(tmpdir.join('b')) not in c4.hashes
+    report = str(tmpdir.join('report.tsv'))
+    c4.write_report(report)
+    lines = tmpdir.join('report.tsv').read().splitlines()
+    assert lines[0] == 'reason\tpath\texpected\tactual'
+    assert len(lines) == 4
+
+def test_c4verify_order(testdir):
+    # Files are hashed largest first.
+    started = []
+    c4 = pyc4.C4Verify()
+    c4.max_threads = 1
+    c4.load(pyc4.C4ManifestEntry(path, c4id, None, None)
+        for path, c4id in testdir.values())
+    c4.worker_started_callback = lambda queue, path: started.append(path)
+    c4.start()
+    c4.join()
+    assert c4.verified == 4 and not c4.mismatches
+    assert started == [testdir[key][0] for key in ('p40', 'p30', 'p20', 'p10')]
+
+def test_c4verify_fail_fast(testdir, tmpdir):
+    c4 = pyc4.C4Verify()
+    c4.fail_fast = True
+    c4.root = str(tmpdir)
+    c4.load([pyc4.C4ManifestEntry('missing', 'c4', 1, None)] + [
+        pyc4.C4ManifestEntry(path, c4id, None, None)
+        for path, c4id in testdir.values()])
+    c4.start()
+    c4.join()
+    assert len(c4.mismatches) == 1
+    assert c4.verified == 0
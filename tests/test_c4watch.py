@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+import pyc4
+import pytest
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.02)
+    return condition()
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_c4watch(tmpdir, use_inotify):
+    tmpdir.join('existing.txt').write_binary(b'existing')
+    results = {}
+    c4 = pyc4.C4Watch()
+    c4.paths = [str(tmpdir)]
+    c4.max_threads = 2
+    c4.debounce = 0.05
+    c4.poll_interval = 0.05
+    c4.use_inotify = use_inotify
+    c4.worker_finished_callback = lambda c4id: results.__setitem__(c4id.path, str(c4id))
+    c4.start()
+    try:
+        new = tmpdir.join('new.txt')
+        new.write_binary(b'new frame')
+        # Files moved into place and written to new folders are found too.
+        tmpdir.join('sub').mkdir()
+        moved = tmpdir.join('sub', 'moved.txt')
+        tmpdir.join('.moved.tmp').write_binary(b'moved frame')
+        os.rename(str(tmpdir.join('.moved.tmp')), str(moved))
+        assert wait_for(lambda: str(new) in results and str(moved) in results)
+        check = pyc4.C4()
+        assert results[str(new)] == str(check.from_file(str(new)))
+        assert results[str(moved)] == str(check.from_file(str(moved)))
+        # Files that change are hashed again.
+        new.write_binary(b'new frame, again')
+        assert wait_for(lambda: results[str(new)] == str(check.from_file(str(new))))
+    finally:
+        c4.stop()
+        c4.join()
+    assert str(tmpdir.join('existing.txt')) not in results
+
+def test_c4watch_existing(testdir, tmpdir):
+    path, c4_check = testdir['p10']
+    c4 = pyc4.C4Watch()
+    c4.paths = [os.path.dirname(path)]
+    c4.existing = True
+    c4.debounce = 0.01
+    c4.start()
+    try:
+        assert wait_for(lambda: len(c4.hashes) == len(testdir))
+    finally:
+        c4.stop()
+        c4.join()
+    assert str(c4.hashes[path]) == c4_check
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_c4watch_recreated(tmpdir, use_inotify):
+    shot = tmpdir.mkdir('shot')
+    c4 = pyc4.C4Watch()
+    c4.paths = [str(tmpdir)]
+    c4.debounce = 0.05
+    c4.poll_interval = 0.05
+    c4.use_inotify = use_inotify
+    c4.start()
+    try:
+        shot.join('a.exr').write_binary(b'a')
+        assert wait_for(lambda: str(shot.join('a.exr')) in c4.hashes)
+        # Files written to a folder that was removed and created again are
+        # still found.
+        shot.remove()
+        assert wait_for(lambda: str(shot) not in c4._watched)
+        shot = tmpdir.mkdir('shot')
+        # Let the new folder be found before the file is written to it.
+        time.sleep(0.3)
+        shot.join('b.exr').write_binary(b'b')
+        assert wait_for(lambda: str(shot.join('b.exr')) in c4.hashes)
+    finally:
+        c4.stop()
+        c4.join()
@@ -0,0 +1,48 @@
+import io
+import array
+import pyc4
+import pytest
+
+
+def test_c4writer(testdir, tmpdir):
+    path, c4_check = testdir['p30']
+    with open(path, 'rb') as f:
+        data = f.read()
+    output = str(tmpdir.join('output.bin'))
+    with pyc4.C4Writer.open(output) as f:
+        # Write in uneven chunks using several buffer types.
+        f.write(data[:1000])
+        f.write(bytearray(data[1000:5000]))
+        f.write(memoryview(data)[5000:])
+        assert f.c4id is None
+    assert str(f.c4id) == c4_check
+    assert f.c4id.path == output
+    assert f.c4id.bytes == len(data)
+    with open(output, 'rb') as check:
+        assert check.read() == data
+
+def test_c4writer_raw(testdir):
+    path, c4_check = testdir['p10']
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Multi byte items are hashed as their raw bytes.
+    items = array.array('i', data[:len(data) - len(data) % 4])
+    raw = io.BytesIO()
+    writer = pyc4.C4Writer(raw, close_raw=False)
+    writer.write(items)
+    writer.write(data[len(items) * items.itemsize:])
+    writer.close()
+    assert str(writer.c4id) == c4_check
+    assert raw.getvalue() == data
+    assert writer.c4id.path is None
+
+def test_c4writer_buffered(testdir):
+    path, c4_check = testdir['p20']
+    with open(path, 'rb') as f:
+        data = f.read()
+    raw = io.BytesIO()
+    writer = pyc4.C4Writer(raw, close_raw=False)
+    with io.BufferedWriter(writer, buffer_size=4096) as f:
+        for i in range(0, len(data), 100):
+            f.write(data[i:i + 100])
+    assert str(writer.c4id) == c4_check
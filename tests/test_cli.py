@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import pyc4
+
+PYC4 = os.path.abspath(pyc4.__file__)
+
+
+def run(*args):
+    return subprocess.run([sys.executable, PYC4] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+def test_stats(testdir, tmpdir):
+    paths = [testdir['p10'][0], testdir['p20'][0]]
+    before = [os.path.getsize(path) for path in paths]
+    stats = str(tmpdir.join('stats.json'))
+    # Files after --stats are hashed, not taken as a path to write to.
+    result = run('-T', '4', '--stats', '--stats-json', stats, *paths)
+    assert result.returncode == 0
+    assert [os.path.getsize(path) for path in paths] == before
+    assert testdir['p10'][1] in result.stdout
+    assert testdir['p20'][1] in result.stdout
+    assert 'files: 2' in result.stderr
+    with open(stats) as f:
+        assert json.load(f)['files'] == 2
+
+def test_digest_copy(testdir, tmpdir):
+    path = testdir['p10'][0]
+    with open(path, 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    for threads in ('1', '4'):
+        target = tmpdir.mkdir(threads)
+        result = run('-T', threads, '--digest', 'md5', '-t', str(target), path)
+        assert result.returncode == 0
+        assert md5 in result.stdout
+
+def test_journal_stats(testdir, tmpdir):
+    paths = [testdir['p10'][0], testdir['p20'][0]]
+    for threads in ('1', '4'):
+        journal = str(tmpdir.join('job{}.c4j'.format(threads)))
+        stats = str(tmpdir.join('stats.json'))
+        assert run('-T', threads, '--journal', journal, *paths).returncode == 0
+        # Files resumed from the journal are counted as cache hits.
+        result = run('-T', threads, '--journal', journal, '--stats',
+            '--stats-json', stats, *paths)
+        assert result.returncode == 0
+        assert 'cache hits: 2' in result.stderr
+        with open(stats) as f:
+            summary = json.load(f)
+        assert summary['files'] == 2
+        assert summary['bytes'] == sum(os.path.getsize(path) for path in paths)
+        assert summary['cache_hits'] == 2